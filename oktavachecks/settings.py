@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 from . import config
 
@@ -29,6 +30,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'webhook.middleware.WebhookCaptureMiddleware',
 ]
 
 ROOT_URLCONF = 'oktavachecks.urls'
@@ -52,6 +54,8 @@ TEMPLATES = [
 WSGI_APPLICATION = 'oktavachecks.wsgi.application'
 
 
+DB_PROFILE = getattr(config, 'DB_PROFILE', 'production')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -59,6 +63,21 @@ DATABASES = {
     }
 }
 
+# production: WAL и synchronous=NORMAL (их ставит webhook.db при открытии
+# соединения), постоянные соединения и BEGIN IMMEDIATE - параллельные воркеры
+# ждут блокировку до busy_timeout, а не падают с "database is locked"
+if DB_PROFILE == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': getattr(config, 'DB_CONN_MAX_AGE', 600),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+    })
+    SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 20000}
+else:
+    SQLITE_PRAGMAS = {}
+
+DB_SLOW_WRITE_THRESHOLD = 0.1
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -104,25 +123,104 @@ AMOCRM_CLIENT_ID = config.AMOCRM_CLIENT_ID
 AMOCRM_CLIENT_SECRET = config.AMOCRM_CLIENT_SECRET
 AMOCRM_ACCESS_TOKEN = config.AMOCRM_ACCESS_TOKEN
 AMOCRM_REDIRECT_URI = config.AMOCRM_REDIRECT_URI
+# Например, http://127.0.0.1:8765/api/v4 для manage.py fake_amocrm
+AMOCRM_BASE_URL = getattr(config, 'AMOCRM_BASE_URL', None)
+AMOCRM_POOL_SIZE = getattr(config, 'AMOCRM_POOL_SIZE', 10)
+AMOCRM_CONNECT_TIMEOUT = getattr(config, 'AMOCRM_CONNECT_TIMEOUT', 5)
+AMOCRM_READ_TIMEOUT = getattr(config, 'AMOCRM_READ_TIMEOUT', 30)
+AMOCRM_STATE_DIR = getattr(config, 'AMOCRM_STATE_DIR', os.path.join(tempfile.gettempdir(), 'oktavachecks'))
+AMOCRM_RATE_LIMIT = getattr(config, 'AMOCRM_RATE_LIMIT', 7)
+AMOCRM_RATE_BURST = getattr(config, 'AMOCRM_RATE_BURST', 7)
+AMOCRM_MAX_RETRIES = 4
+AMOCRM_BACKOFF_BASE = 0.5
+AMOCRM_BACKOFF_MAX = 30
+# Circuit breaker: после N сбоев подряд (сеть, 5xx, ответ дольше SLOW_CALL
+# секунд) запросы к amoCRM не идут RESET_TIMEOUT секунд, вебхуки копятся в
+# очереди; затем PROBES удачных пробных запросов закрывают его
+AMOCRM_BREAKER_FAILURES = getattr(config, 'AMOCRM_BREAKER_FAILURES', 5)
+AMOCRM_BREAKER_SLOW_CALL = getattr(config, 'AMOCRM_BREAKER_SLOW_CALL', 10)
+AMOCRM_BREAKER_RESET_TIMEOUT = getattr(config, 'AMOCRM_BREAKER_RESET_TIMEOUT', 30)
+AMOCRM_BREAKER_PROBES = 3
+
+CONTACT_CACHE_SIZE = 10000
+CONTACT_CACHE_TTL = 3600
 
 
 RADARIO_WEBHOOK_SECRET = config.RADARIO_WEBHOOK_SECRET
 
 
+WEBHOOK_ASYNC_INGEST = getattr(config, 'WEBHOOK_ASYNC_INGEST', False)
+WEBHOOK_WORKER_BATCH_SIZE = 20
+WEBHOOK_WORKER_POLL_INTERVAL = 1.0
+WEBHOOK_WORKER_STALE_TIMEOUT = 300
+# process_webhooks нужен и без WEBHOOK_ASYNC_INGEST: он разбирает вебхуки,
+# отложенные при открытом breaker, и повторы. Воркер отмечается в
+# AMOCRM_STATE_DIR; /health/ отвечает degraded, если очередь не пуста, а
+# живого воркера нет дольше HEARTBEAT_TIMEOUT секунд.
+WEBHOOK_WORKER_HEARTBEAT_TIMEOUT = 120
+WEBHOOK_LEAD_BATCH_SIZE = 50
+WEBHOOK_LEAD_BATCH_WINDOW = 2.0
+# Повторы после временных ошибок (сеть, 429, 5xx): экспоненциальная пауза
+# от BASE_DELAY до MAX_DELAY, после MAX_ATTEMPTS - статус dead
+WEBHOOK_RETRY_MAX_ATTEMPTS = getattr(config, 'WEBHOOK_RETRY_MAX_ATTEMPTS', 8)
+WEBHOOK_RETRY_BASE_DELAY = 60
+WEBHOOK_RETRY_MAX_DELAY = 6 * 3600
+WEBHOOK_REQUEUE_CHUNK_SIZE = 500
+WEBHOOK_DEDUP_RETENTION = 72 * 3600
+WEBHOOK_DEDUP_PURGE_INTERVAL = 600
+WEBHOOK_COMPRESS_BODY = getattr(config, 'WEBHOOK_COMPRESS_BODY', True)
+WEBHOOK_COMPRESS_MIN_SIZE = 1024
+WEBHOOK_ARCHIVE_DIR = getattr(config, 'WEBHOOK_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive'))
+WEBHOOK_ARCHIVE_AFTER_DAYS = getattr(config, 'WEBHOOK_ARCHIVE_AFTER_DAYS', 30)
+# dead ждут ручного разбора, поэтому хранятся в БД дольше
+WEBHOOK_ARCHIVE_DEAD_AFTER_DAYS = getattr(config, 'WEBHOOK_ARCHIVE_DEAD_AFTER_DAYS', 90)
+WEBHOOK_ARCHIVE_SEGMENT_SIZE = 10000
+WEBHOOK_ARCHIVE_CHUNK_SIZE = 500
+WEBHOOK_ARCHIVE_INTERVAL = 3600
+WEBHOOK_CAPTURE_DIR = getattr(config, 'WEBHOOK_CAPTURE_DIR', None)
+WEBHOOK_CAPTURE_PATH = '/webhook/radario/'
+WEBHOOK_CAPTURE_MAX_BYTES = 50 * 1024 * 1024
+WEBHOOK_CAPTURE_BACKUPS = 10
+
+# Метрики Prometheus: файл на процесс, /metrics/ их складывает
+METRICS_DIR = getattr(config, 'METRICS_DIR', os.path.join(AMOCRM_STATE_DIR, 'metrics'))
+METRICS_FLUSH_INTERVAL = 1.0
+
+
+# Лог пишет фоновый поток (webhook.log.QueueFileHandler) JSON-строками.
+# LOG_ROTATE_WHEN ('midnight', 'H' и т.д.) включает ротацию по времени
+# вместо ротации по размеру.
+LOG_LEVEL = getattr(config, 'LOG_LEVEL', 'INFO')
+LOG_FILE = getattr(config, 'LOG_FILE', BASE_DIR / 'webhook.log')
+LOG_ROTATE_WHEN = getattr(config, 'LOG_ROTATE_WHEN', None)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'sampling': {
+            '()': 'webhook.log.SamplingFilter',
+            'burst': 20,
+            'window': 60,
+            'every': 100,
+        },
+    },
     'handlers': {
         'file': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': BASE_DIR / 'webhook.log',
+            'level': LOG_LEVEL,
+            'class': 'webhook.log.QueueFileHandler',
+            'filename': LOG_FILE,
+            'max_bytes': 50 * 1024 * 1024,
+            'backup_count': 10,
+            'when': LOG_ROTATE_WHEN,
+            'queue_size': 10000,
+            'filters': ['sampling'],
         },
     },
     'loggers': {
         'webhook': {
             'handlers': ['file'],
-            'level': 'INFO',
+            'level': LOG_LEVEL,
             'propagate': True,
         },
     },
@@ -1,23 +1,75 @@
+import json
 from django.contrib import admin
-from .models import WebhookLog
+from django.db.models import Q
+from django.utils.html import format_html
+from .ingest import requeue
+from .models import WebhookLog, ContactIndex, LeadIndex
 
 
 @admin.register(WebhookLog)
 class WebhookLogAdmin(admin.ModelAdmin):
-    list_display = ['id', 'status', 'amocrm_contact_id', 'amocrm_lead_id', 'created_at', 'processed_at']
-    list_filter = ['status', 'created_at']
-    search_fields = ['amocrm_contact_id', 'amocrm_lead_id', 'error_message']
-    readonly_fields = ['created_at', 'processed_at']
+    list_display = ['id', 'status', 'order_id', 'email', 'event_title', 'amount', 'amocrm_contact_id', 'amocrm_lead_id', 'attempts', 'created_at', 'processed_at']
+    list_filter = ['status', 'radario_status', 'last_error_class', 'created_at']
+    search_fields = ['order_id', 'email', 'event_title', 'amocrm_contact_id', 'amocrm_lead_id', 'error_message']
+    readonly_fields = ['created_at', 'processed_at', 'superseded_by', 'payload_display', 'attempts', 'next_attempt_at', 'last_error_class']
+    actions = ['requeue_selected']
 
     fieldsets = (
         ('Основная информация', {
-            'fields': ('status', 'created_at', 'processed_at')
+            'fields': ('status', 'created_at', 'processed_at', 'superseded_by')
+        }),
+        ('Заказ', {
+            'fields': ('order_id', 'email', 'event_title', 'radario_status', 'amount')
         }),
         ('AmoCRM IDs', {
             'fields': ('amocrm_contact_id', 'amocrm_lead_id')
         }),
+        ('Повторы', {
+            'fields': ('attempts', 'next_attempt_at', 'last_error_class')
+        }),
         ('Данные вебхука', {
-            'fields': ('payload', 'error_message'),
+            'fields': ('payload_display', 'error_message'),
             'classes': ('collapse',)
         }),
-    )
\ No newline at end of file
+    )
+
+    def get_search_results(self, request, queryset, search_term):
+        # Номер заказа или email ищем точным совпадением по индексам, а не
+        # LIKE '%...%' по всей таблице
+        term = search_term.strip()
+        if term and ' ' not in term:
+            exact = queryset.filter(Q(order_id=term) | Q(email=term.lower()))
+            if exact.exists():
+                return exact, False
+        return super().get_search_results(request, queryset, search_term)
+
+    @admin.action(description='Повторить обработку выбранных')
+    def requeue_selected(self, request, queryset):
+        ids = list(queryset.values_list('id', flat=True))
+        requeued = requeue(ids)
+        skipped = len(ids) - requeued
+        message = f"Возвращено в очередь: {requeued}, обработает process_webhooks"
+        if skipped:
+            message += f". Пропущено (не ошибка и не повтор): {skipped}"
+        self.message_user(request, message)
+
+    @admin.display(description='Данные вебхука')
+    def payload_display(self, obj):
+        payload = obj.get_payload()
+        if payload is None:
+            return '-'
+        return format_html('<pre>{}</pre>', json.dumps(payload, ensure_ascii=False, indent=2))
+
+
+@admin.register(ContactIndex)
+class ContactIndexAdmin(admin.ModelAdmin):
+    list_display = ['email', 'amocrm_contact_id', 'last_seen_at']
+    search_fields = ['email', 'amocrm_contact_id']
+    readonly_fields = ['last_seen_at']
+
+
+@admin.register(LeadIndex)
+class LeadIndexAdmin(admin.ModelAdmin):
+    list_display = ['order_id', 'amocrm_lead_id', 'amocrm_contact_id', 'created_at']
+    search_fields = ['order_id', 'amocrm_lead_id']
+    readonly_fields = ['created_at']
@@ -1,44 +1,66 @@
-import requests
 import logging
 import json
+import requests
 import time
 from datetime import datetime
 from django.conf import settings
-from .utils import format_name_for_amocrm
+from . import taxonomy
+from .breaker import CircuitOpenError
+from .contacts import lookup_contact_id, remember_contact
+from .fastjson import dumps, loads
+from .leads import lookup_lead_id, remember_lead
+from .paging import MAX_PAGE_SIZE, PageStream
+from .retry import is_retryable
+from .transport import get_transport
+from .utils import format_name_for_amocrm, make_order_key, lead_matches_order
 logger = logging.getLogger(__name__)
 from .utils import create_lead_name
 
 
-class AmoCRMClient:
-    def __init__(self):
+def lookup_failed(error):
+    # Поиск не состоялся, а не "ничего не найдено": сеть, таймаут, ответ
+    # 4xx/5xx, исчерпанные 429, открытый breaker. Такую ошибку поднимаем -
+    # её разберёт apply_failure, - иначе обработка создала бы второй контакт
+    # или сделку вместо повтора.
+    return isinstance(error, requests.RequestException) or is_retryable(error)
+
+
+# Сборка запросов и разбор ответов amoCRM без ввода-вывода: общая часть
+# AmoCRMClient и AsyncAmoCRMClient. Методы, которые ходят в amoCRM, у
+# каждого клиента свои - синхронные или корутины.
+class AmoCRMRequestsMixin:
+    def __init__(self, transport=None):
         self.subdomain = settings.AMOCRM_SUBDOMAIN
-        self.base_url = f"https://{self.subdomain}.amocrm.ru/api/v4"
+        self.base_url = settings.AMOCRM_BASE_URL or f"https://{self.subdomain}.amocrm.ru/api/v4"
         self.access_token = settings.AMOCRM_ACCESS_TOKEN
+        self.transport = transport or get_transport()
 
-    def _make_request(self, method, endpoint, data=None):
-        url = f"{self.base_url}/{endpoint}"
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
+    def _handle_response(self, response):
+        if response.status_code == 401:
+            logger.error("Долгосрочный токен истек или неверный! Нужно обновить токен в amoCRM.")
+            logger.error("Полный ответ: %s", response.text)
+            raise Exception(f"Token invalid: {response.text}")
 
-        try:
-            response = requests.request(method, url, headers=headers, json=data, timeout=30)
+        self._raise_for_status(response)
 
-            if response.status_code == 401:
-                logger.error("Долгосрочный токен истек или неверный! Нужно обновить токен в amoCRM.")
-                logger.error(f"Полный ответ: {response.text}")
-                raise Exception(f"Token invalid: {response.text}")
+        if response.content:
+            return loads(response.content)
+        return {}
 
-            response.raise_for_status()
+    def _raise_for_status(self, response):
+        response.raise_for_status()
 
-            if response.content:
-                return response.json()
-            return {}
+    def iter_leads(self, filters=None, with_=None, cursor=None, limit=MAX_PAGE_SIZE, prefetch=2):
+        # for lead in client.iter_leads({'pipeline_id': 9713218}, with_=['contacts'])
+        return self._page_stream('leads', filters, with_, cursor, limit, prefetch)
 
-        except Exception as e:
-            logger.error(f"AmoCRM API error: {e}")
-            raise
+    def iter_contacts(self, filters=None, with_=None, cursor=None, limit=MAX_PAGE_SIZE, prefetch=2):
+        return self._page_stream('contacts', filters, with_, cursor, limit, prefetch)
+
+    def _page_stream(self, collection, filters, with_, cursor, limit, prefetch):
+        return self.page_stream_class(
+            self._get_page, collection, filters=filters, with_=with_, limit=limit, prefetch=prefetch, cursor=cursor
+        )
 
     def _create_compact_description(self, customer_info, event_type, payment_status):
 
@@ -82,44 +104,10 @@ class AmoCRMClient:
 
         return description
 
-    def find_contact_by_email(self, email):
-        try:
-            endpoint = f"contacts?query={email}"
-            data = self._make_request('GET', endpoint)
-            return data['_embedded']['contacts'][0] if data.get('_embedded', {}).get('contacts') else None
-        except Exception as e:
-            logger.error(f"Error finding contact by email {email}: {e}")
-            return None
-
-    def create_lead(self, contact_id, lead_name, amount):
-        price = int(float(amount))
+    def _first_contact(self, data):
+        return data['_embedded']['contacts'][0] if data.get('_embedded', {}).get('contacts') else None
 
-        lead_data = {
-            "name": lead_name,
-            "price": price,
-            "pipeline_id": 9713218,
-            "status_id": 77419554,
-            "_embedded": {
-                "contacts": [{"id": contact_id}]
-            }
-        }
-
-        try:
-            data = self._make_request('POST', 'leads', [lead_data])
-            return data['_embedded']['leads'][0]
-        except Exception as e:
-            logger.error(f"Error creating lead: {e}")
-            raise
-
-    def find_contact_by_phone(self, phone):
-        try:
-            return None
-        except Exception as e:
-            logger.error(f"Error finding contact by phone {phone}: {e}")
-            return None
-
-
-    def create_contact(self, email, name, phone=None):
+    def build_contact_data(self, email, name, phone=None):
         formatted_name = format_name_for_amocrm(name)
 
         contact_data = {
@@ -138,94 +126,26 @@ class AmoCRMClient:
                 "values": [{"value": phone, "enum_code": "WORK"}]
             })
 
-        try:
-            data = self._make_request('POST', 'contacts', [contact_data])
-            return data['_embedded']['contacts'][0]
-        except Exception as e:
-            logger.error(f"Error creating contact: {e}")
-            raise
-
+        return contact_data
 
-    def find_lead_by_order_id(self, order_id):
-        try:
-            logger.info(f"🔍 Поиск сделки: {order_id}")
-
-            clean_order_id = str(order_id).replace('$(date +%s)', '').replace('$(date)', '')
-
-            endpoint = f"leads?query={clean_order_id}&with=custom_fields"
-            data = self._make_request('GET', endpoint)
-
-            if not data or '_embedded' not in data or 'leads' not in data['_embedded']:
-                logger.info(f"Не найдено сделок для: {clean_order_id}")
-                return None
-
-            leads = data['_embedded']['leads']
-
-            if leads:
-                logger.info(f"Найдено сделок: {len(leads)}, беру первую")
-                return leads[0]
+    def _clean_order_id(self, order_id):
+        return str(order_id).replace('$(date +%s)', '').replace('$(date)', '')
 
+    def _select_lead(self, data, clean_order_id):
+        if not data or '_embedded' not in data or 'leads' not in data['_embedded']:
+            logger.info("Не найдено сделок для: %s", clean_order_id)
             return None
 
-        except Exception as e:
-            logger.error(f"Ошибка поиска: {e}")
+        leads = data['_embedded']['leads']
+        matched = [lead for lead in leads if lead_matches_order(lead, clean_order_id)]
+        logger.info("Найдено сделок: %s, из них по заказу %s: %s", len(leads), clean_order_id, len(matched))
+
+        if not matched:
             return None
+        return min(matched, key=lambda item: item['id'])
 
     def _map_event_type(self, event_title):
-        event_title_lower = event_title.lower()
-
-        mapping = {
-            'мастер-класс': 'Мастер-класс',
-            'мастер класс': 'Мастер-класс',
-            'программа': 'Программа',
-            'лекция': 'Лекция',
-            'театральное занятие': 'Театральное занятие',
-            'игра': 'Игра',
-            'резиденция': 'Резиденция',
-            'выставка': 'Выставка',
-            'спектакль': 'Спектакль',
-            'экскурсия': 'Экскурсия',
-            'концерт': 'Концерт',
-            'шоу': 'Шоу',
-            'комбо': 'Комбо',
-            'кинопоказ': 'Кинопоказ',
-            'конференция': 'Конференция',
-            'фестиваль': 'Фестиваль',
-            'творческая встреча': 'Творческая встреча',
-            'кинофестиваль': 'Кинофестиваль',
-            'открытый разговор': 'Открытый разговор',
-            'митап': 'Митап',
-            'мит-ап': 'Митап',
-            'дискуссия': 'Дискуссия',
-            'встреча': 'Встреча',
-            'перформанс': 'Перформанс',
-            'workshop': 'Workshop',
-            'воркшоп': 'Воркшоп',
-            'арт-терапия': 'Арт-терапия',
-            'занятие': 'Занятие',
-            'паблик-ток': 'Паблик-топ',
-            'ted-talk': 'TED-talk',
-            'показ': 'Показ',
-            'диалог': 'Диалог',
-            'книжный клуб': 'Книжный клуб',
-            'book club': 'Книжный клуб',
-            'bookclub': 'Книжный клуб',
-            'литературный клуб': 'Книжный клуб',
-            'литературная встреча': 'Книжный клуб',
-            'чтение': 'Книжный клуб',
-            'литературный вечер': 'Книжный клуб',
-            'обсуждение книги': 'Книжный клуб'
-        }
-
-        for key, value in mapping.items():
-            if key in event_title_lower:
-                return value
-
-        for key in mapping.keys():
-            if key.replace('-', ' ') in event_title_lower:
-                return mapping[key]
-
-        return 'Другое'
+        return taxonomy.event_type(event_title)
 
     def _convert_to_timestamp(self, date_string):
         if not date_string:
@@ -251,10 +171,9 @@ class AmoCRMClient:
         except Exception:
             return int(time.time())
 
-    def create_lead_with_custom_fields(self, contact_id, customer_info):
+    def build_lead_data(self, contact_id, customer_info):
 
-        event_type = self._map_event_type(customer_info.get('event_title', ''))
-        event_enum_id = self._get_event_type_enum_id(event_type)
+        event_type, event_enum_id = taxonomy.classify_event(customer_info.get('event_title', ''))
 
         payment_status = self._map_status_for_field(
             customer_info.get('status', ''),
@@ -273,7 +192,14 @@ class AmoCRMClient:
         is_paid = (customer_info.get('status') == 'Paid' and
                    customer_info.get('payment_system_status') == 'Paid')
         pipeline_id = 9713218
-        status_id = 77419554 if is_paid else 142
+        is_refund = (customer_info.get('status') == 'Refunded' or
+                     customer_info.get('payment_system_status') == 'Refund')
+        if is_paid:
+            status_id = 77419554
+        elif is_refund:
+            status_id = 143
+        else:
+            status_id = 142
 
         compact_description = self._create_compact_description(
             customer_info, event_type, payment_status
@@ -283,22 +209,9 @@ class AmoCRMClient:
 
         if customer_info.get('order_id'):
             order_id_str = str(customer_info['order_id'])
+            order_id_value = make_order_key(order_id_str)
 
-
-            order_id_value = order_id_str
-
-            import re
-
-            if re.search(r'[A-Za-z]+-\d+', order_id_str):
-                parts = order_id_str.split('-')
-                if len(parts) > 1:
-                    order_id_value = parts[-1]
-                else:
-                    order_id_value = order_id_str
-            else:
-                order_id_value = str(abs(hash(order_id_str)) % 1000000)
-
-            logger.info(f"Сохраняю order_id: '{order_id_str}' -> '{order_id_value}'")
+            logger.info("Сохраняю order_id: '%s' -> '%s'", order_id_str, order_id_value)
 
             custom_fields.append({
                 "field_id": 986103,
@@ -399,18 +312,39 @@ class AmoCRMClient:
             }
         }]
 
-        logger.info(f"Создаю сделку '{lead_name}' с {len(custom_fields)} полями")
+        return lead_data
 
+    def build_complex_lead_data(self, customer_info):
+        lead_data = self.build_lead_data(None, customer_info)
+        lead_data["_embedded"] = {
+            "contacts": [self.build_contact_data(
+                customer_info['email'],
+                customer_info.get('name'),
+                customer_info.get('phone')
+            )]
+        }
+        return lead_data
+
+    def _parse_complex_leads(self, data):
+        # leads/complex отвечает списком {id, contact_id, request_id: [...]}
+        leads = []
+        for item in data or []:
+            request_id = item.get('request_id')
+            if isinstance(request_id, list):
+                request_id = request_id[0] if request_id else None
+            leads.append({'id': item['id'], 'contact_id': item.get('contact_id'), 'request_id': request_id})
+        return leads
+
+    def _rejected_request_ids(self, response):
         try:
-            data = self._make_request('POST', 'leads', [lead_data])
-            lead = data['_embedded']['leads'][0]
-            logger.info(f"✅ Сделка создана: {lead['id']}")
-            return lead
-        except Exception as e:
-            logger.error(f"❌ Ошибка: {e}")
-            raise
+            body = loads(response.content)
+        except (AttributeError, TypeError, ValueError):
+            return set()
 
-    def update_lead_for_refund(self, lead_id, customer_info):
+        errors = body.get('validation-errors') or body.get('validation_errors') or []
+        return {str(item.get('request_id')) for item in errors if item.get('request_id') is not None}
+
+    def build_refund_update_data(self, lead_id, customer_info):
 
         payment_status = self._map_status_for_field(
             customer_info.get('status', ''),
@@ -438,16 +372,9 @@ class AmoCRMClient:
                 "values": [{"value": self._convert_to_timestamp(customer_info.get('refund_date'))}]
             })
 
-        logger.info(f"Обновляю сделку {lead_id} для возврата")
-
-        try:
-            data = self._make_request('PATCH', f'leads/{lead_id}', update_data)
-            return data
-        except Exception as e:
-            logger.error(f"Error updating lead for refund {lead_id}: {e}")
-            raise
+        return update_data
 
-    def update_lead(self, lead_id, customer_info, status_id=None):
+    def build_update_data(self, lead_id, customer_info, status_id=None):
         status_value = self._map_status_for_field(
             customer_info['status'],
             customer_info['payment_system_status']
@@ -468,14 +395,7 @@ class AmoCRMClient:
                 "values": [{"enum_id": status_enum_id}]
             }]
 
-        logger.info(f"Обновляю сделку {lead_id}")
-
-        try:
-            data = self._make_request('PATCH', f'leads/{lead_id}', update_data)
-            return data
-        except Exception as e:
-            logger.error(f"Error updating lead {lead_id}: {e}")
-            raise
+        return update_data
 
     def _map_status_for_field(self, status, payment_system_status):
         if status == 'Paid' and payment_system_status == 'Paid':
@@ -490,70 +410,241 @@ class AmoCRMClient:
             return 'Неизвестно'
 
     def _get_event_type_enum_id(self, event_type):
-        mapping = {
-            'Мастер-класс': 985177,
-            'Программа': 985179,
-            'Лекция': 985181,
-            'Театральное занятие': 985183,
-            'Игра': 985185,
-            'Резиденция': 985187,
-            'Выставка': 985189,
-            'Спектакль': 985191,
-            'Экскурсия': 985193,
-            'Концерт': 985195,
-            'Шоу': 985197,
-            'Комбо': 985199,
-            'Кинопоказ': 985201,
-            'Конференция': 985203,
-            'Фестиваль': 985205,
-            'Творческая встреча': 985207,
-            'Кинофестиваль': 985209,
-            'Открытый разговор': 985211,
-            'Митап': 985213,
-            'Дискуссия': 985215,
-            'Встреча': 985217,
-            'Перформанс': 985219,
-            'Workshop': 985221,
-            'Воркшоп': 985223,
-            'Арт-терапия': 985225,
-            'Занятие': 985227,
-            'Паблик-топ': 985229,
-            'TED-talk': 985231,
-            'Показ': 985233,
-            'Диалог': 985235,
-            'Книжный клуб': 986271,
-            'Другое': None
-        }
-
-        if event_type in mapping:
-            return mapping[event_type]
-
-        for key, enum_id in mapping.items():
-            if key.lower() == event_type.lower():
-                return enum_id
-
-        logger.warning(f"Не найден enum_id для типа события: {event_type}, использую 'Мастер-класс'")
-        return 985177
+        return taxonomy.event_type_enum_id(event_type)
 
     def _get_source_enum_id(self, source):
         return 1
 
     def _get_status_enum_id(self, status):
-        mapping = {
-            'Оплачен': 985097,
-            'Возврат': 985099,
-            'В обработке': None,
-            'Отменен': None,
-            'Неизвестно': None
+        return taxonomy.payment_status_enum_id(status)
+
+
+class AmoCRMClient(AmoCRMRequestsMixin):
+    page_stream_class = PageStream
+
+    def _make_request(self, method, endpoint, data=None):
+        url = f"{self.base_url}/{endpoint}"
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json'
         }
 
-        status_to_amo = {
-            'Оплачен': 'Оплачено',
-            'Возврат': 'Возврат',
-            'В обработке': 'Оплачено',
-            'Отменен': 'Оплачено',
-            'Неизвестно': 'Оплачено'
+        try:
+            body = dumps(data) if data is not None else None
+            response = self.transport.request(method, url, endpoint, headers=headers, body=body)
+            return self._handle_response(response)
+        except Exception as e:
+            logger.error("AmoCRM API error: %s", e)
+            raise
+
+    def _get_page(self, endpoint):
+        return self._make_request('GET', endpoint)
+
+    def find_contact_by_email(self, email, use_index=True):
+        if use_index:
+            contact_id = lookup_contact_id(email)
+            if contact_id:
+                return {'id': contact_id}
+
+        try:
+            endpoint = f"contacts?query={email}"
+            data = self._make_request('GET', endpoint)
+            contact = self._first_contact(data)
+        except Exception as e:
+            logger.error("Error finding contact by email %s: %s", email, e)
+            if lookup_failed(e):
+                raise
+            return None
+
+        if contact:
+            remember_contact(email, contact['id'])
+        return contact
+
+    def get_contact(self, contact_id):
+        try:
+            data = self._make_request('GET', f'contacts/{contact_id}')
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+        return data or None
+
+    def create_lead(self, contact_id, lead_name, amount):
+        price = int(float(amount))
+
+        lead_data = {
+            "name": lead_name,
+            "price": price,
+            "pipeline_id": 9713218,
+            "status_id": 77419554,
+            "_embedded": {
+                "contacts": [{"id": contact_id}]
+            }
         }
 
-        mapped_status = status_to_amo.get(status, 'Оплачено')
-        return mapping.get(mapped_status, 985097)
\ No newline at end of file
+        try:
+            data = self._make_request('POST', 'leads', [lead_data])
+            return data['_embedded']['leads'][0]
+        except Exception as e:
+            logger.error("Error creating lead: %s", e)
+            raise
+
+    def find_contact_by_phone(self, phone):
+        try:
+            return None
+        except Exception as e:
+            logger.error("Error finding contact by phone %s: %s", phone, e)
+            return None
+
+    def create_contact(self, email, name, phone=None):
+        contact_data = self.build_contact_data(email, name, phone)
+
+        try:
+            data = self._make_request('POST', 'contacts', [contact_data])
+            contact = data['_embedded']['contacts'][0]
+        except Exception as e:
+            logger.error("Error creating contact: %s", e)
+            raise
+
+        remember_contact(email, contact['id'])
+        return contact
+
+    def find_lead_by_order_id(self, order_id, use_index=True):
+        if use_index:
+            lead_id = lookup_lead_id(order_id)
+            if lead_id:
+                return {'id': lead_id}
+
+        try:
+            logger.info("🔍 Поиск сделки: %s", order_id)
+
+            clean_order_id = self._clean_order_id(order_id)
+            data = self._make_request('GET', f"leads?query={clean_order_id}&with=custom_fields")
+            lead = self._select_lead(data, clean_order_id)
+        except Exception as e:
+            logger.error("Ошибка поиска: %s", e)
+            if lookup_failed(e):
+                raise
+            return None
+
+        if lead:
+            remember_lead(clean_order_id, lead['id'])
+        return lead
+
+    def create_lead_with_custom_fields(self, contact_id, customer_info):
+        lead_data = self.build_lead_data(contact_id, customer_info)
+
+        logger.info("Создаю сделку '%s' с %s полями", lead_data['name'], len(lead_data['custom_fields_values']))
+
+        try:
+            data = self._make_request('POST', 'leads', [lead_data])
+            lead = data['_embedded']['leads'][0]
+            logger.info("✅ Сделка создана: %s", lead['id'])
+        except Exception as e:
+            logger.error("❌ Ошибка: %s", e)
+            raise
+
+        remember_lead(customer_info.get('order_id'), lead['id'], contact_id)
+        return lead
+
+    def create_lead_with_contact(self, customer_info):
+        lead_data = self.build_complex_lead_data(customer_info)
+
+        logger.info("Создаю контакт и сделку '%s' одним запросом", lead_data['name'])
+
+        try:
+            data = self._make_request('POST', 'leads/complex', [lead_data])
+            lead = self._parse_complex_leads(data)[0]
+            logger.info("✅ Сделка %s и контакт %s созданы", lead['id'], lead['contact_id'])
+        except Exception as e:
+            logger.error("❌ Ошибка: %s", e)
+            raise
+
+        remember_contact(customer_info['email'], lead['contact_id'])
+        remember_lead(customer_info.get('order_id'), lead['id'], lead['contact_id'])
+        return lead
+
+    def create_leads_batch(self, items, with_contacts=False):
+        # items: список (request_id, lead_data), не больше 50 за запрос.
+        # with_contacts=True - отправка через leads/complex, где в lead_data
+        # вложены новые контакты. Возвращает {request_id: сделка или
+        # исключение}: ошибка валидации одной сделки не роняет остальные.
+        endpoint = 'leads/complex' if with_contacts else 'leads'
+        results = {}
+        pending = {str(request_id): lead_data for request_id, lead_data in items}
+
+        while pending:
+            payload = [dict(lead_data, request_id=request_id) for request_id, lead_data in pending.items()]
+
+            try:
+                data = self._make_request('POST', endpoint, payload)
+            except requests.HTTPError as e:
+                rejected = self._rejected_request_ids(e.response)
+                if e.response is None or e.response.status_code != 400 or not rejected & pending.keys():
+                    for request_id in pending:
+                        results[request_id] = e
+                    return results
+
+                logger.warning("Пакет сделок: amoCRM отклонил %s из %s", len(rejected & pending.keys()), len(pending))
+                for request_id in rejected & pending.keys():
+                    results[request_id] = e
+                    del pending[request_id]
+                continue
+
+            leads = self._parse_complex_leads(data) if with_contacts else data.get('_embedded', {}).get('leads', [])
+            for lead in leads:
+                request_id = str(lead.get('request_id'))
+                if request_id in pending:
+                    results[request_id] = lead
+                    del pending[request_id]
+
+            for request_id in pending:
+                results[request_id] = Exception('amoCRM не вернул сделку для request_id ' + request_id)
+            pending = {}
+
+        logger.info("✅ Пакет сделок: создано %s из %s", sum(1 for r in results.values() if isinstance(r, dict)), len(results))
+        return results
+
+    def update_lead_for_refund(self, lead_id, customer_info):
+        update_data = self.build_refund_update_data(lead_id, customer_info)
+
+        logger.info("Обновляю сделку %s для возврата", lead_id)
+
+        try:
+            data = self._make_request('PATCH', f'leads/{lead_id}', update_data)
+            return data
+        except Exception as e:
+            logger.error("Error updating lead for refund %s: %s", lead_id, e)
+            raise
+
+    def update_lead(self, lead_id, customer_info, status_id=None):
+        update_data = self.build_update_data(lead_id, customer_info, status_id)
+
+        logger.info("Обновляю сделку %s", lead_id)
+
+        try:
+            data = self._make_request('PATCH', f'leads/{lead_id}', update_data)
+            return data
+        except Exception as e:
+            logger.error("Error updating lead %s: %s", lead_id, e)
+            raise
+
+    def update_leads_batch(self, updates, batch_size=50):
+        # updates - данные build_update_data/build_refund_update_data с id
+        # сделки; один PATCH leads на batch_size сделок. Возвращает
+        # (обновлено, [ошибки]): упавший пакет не останавливает остальные.
+        updated = 0
+        errors = []
+        for start in range(0, len(updates), batch_size):
+            chunk = updates[start:start + batch_size]
+            try:
+                self._make_request('PATCH', 'leads', chunk)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                errors.append(f"сделки {chunk[0]['id']}..{chunk[-1]['id']}: {e}")
+                continue
+            updated += len(chunk)
+
+        logger.info("✅ Пакетное обновление сделок: %s из %s", updated, len(updates))
+        return updated, errors
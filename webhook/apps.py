@@ -1,6 +1,11 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class WebhookConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'webhook'
+
+    def ready(self):
+        from .db import configure_connection
+        connection_created.connect(configure_connection, dispatch_uid='webhook.db.configure_connection')
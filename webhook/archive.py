@@ -0,0 +1,307 @@
+import gzip
+import logging
+import os
+import zlib
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .fastjson import dumps, loads
+from .models import WebhookLog
+from .sharedstate import locked_state
+
+logger = logging.getLogger(__name__)
+
+# В архив уходят только строки с итоговым статусом: pending/processing
+# ещё нужны воркеру. dead лежат в БД дольше (WEBHOOK_ARCHIVE_DEAD_AFTER_DAYS):
+# их разбирают вручную и переотправляют через requeue_webhooks.
+ARCHIVE_STATUSES = ('success', 'error', 'coalesced', 'dead')
+DEAD_STATUS = 'dead'
+INDEX_FILE = 'index.json'
+
+
+def archive_cutoff(days=None):
+    return timezone.now() - timedelta(days=settings.WEBHOOK_ARCHIVE_AFTER_DAYS if days is None else days)
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def archive_record(webhook_log):
+    record = {
+        'id': webhook_log.id,
+        'order_id': None,
+        'status': webhook_log.status,
+        'error_message': webhook_log.error_message,
+        'amocrm_contact_id': webhook_log.amocrm_contact_id,
+        'amocrm_lead_id': webhook_log.amocrm_lead_id,
+        'superseded_by': webhook_log.superseded_by_id,
+        'created_at': _isoformat(webhook_log.created_at),
+        'processed_at': _isoformat(webhook_log.processed_at),
+    }
+
+    try:
+        payload = webhook_log.get_payload()
+    except (ValueError, zlib.error):
+        # битое тело сохраняем как текст, чтобы не потерять его при удалении
+        record['raw_body'] = (webhook_log.get_raw_body() or b'').decode('utf-8', 'replace')
+        return record
+
+    model = payload.get('model') if isinstance(payload, dict) else None
+    if isinstance(model, dict):
+        record['order_id'] = model.get('Id') or model.get('id')
+    record['payload'] = payload
+    return record
+
+
+def _idx_path(path):
+    return path[:-len('.jsonl.gz')] + '.idx.json'
+
+
+class SegmentWriter:
+    # Пишет сегмент во временный файл и переименовывает его только в
+    # commit(), после записи в index.json: файл *.jsonl.gz в каталоге архива
+    # всегда целый и всегда известен индексу.
+    def __init__(self, archive_dir, first):
+        self.archive_dir = archive_dir
+        self.name = f"webhooks-{first.created_at:%Y%m%d-%H%M%S}-{first.id}.jsonl.gz"
+        self.path = os.path.join(archive_dir, self.name)
+        self.tmp_path = self.path + '.tmp'
+
+        self.file = gzip.open(self.tmp_path, 'wb')
+        self.ids = []
+        self.orders = {}
+        self.first_at = first.created_at
+        self.last_at = first.created_at
+
+    def write(self, webhook_log):
+        record = archive_record(webhook_log)
+        self.file.write(dumps(record) + b'\n')
+
+        self.ids.append(webhook_log.id)
+        self.last_at = webhook_log.created_at
+        if record['order_id'] is not None:
+            self.orders.setdefault(str(record['order_id']), []).append(webhook_log.id)
+
+    def close(self):
+        self.file.close()
+        with open(_idx_path(self.path), 'wb') as f:
+            f.write(dumps(self.orders))
+
+        return {
+            'file': self.name,
+            'count': len(self.ids),
+            'first_id': min(self.ids),
+            'last_id': max(self.ids),
+            'from': _isoformat(self.first_at),
+            'to': _isoformat(self.last_at),
+            'deleted': False,
+        }
+
+    def commit(self):
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def _update_index(archive_dir, name, **changes):
+    # locked_state сравнивает с неглубокой копией состояния, поэтому
+    # записи сегментов не меняем на месте, а собираем заново
+    with locked_state(os.path.join(archive_dir, INDEX_FILE)) as state:
+        segments = state.get('segments', [])
+        if any(segment['file'] == name for segment in segments):
+            segments = [dict(segment, **changes) if segment['file'] == name else segment for segment in segments]
+        else:
+            segments = segments + [dict(changes, file=name)]
+        state['segments'] = segments
+
+
+def _drop_from_index(archive_dir, name):
+    with locked_state(os.path.join(archive_dir, INDEX_FILE)) as state:
+        state['segments'] = [segment for segment in state.get('segments', []) if segment['file'] != name]
+
+
+def read_index(archive_dir=None):
+    archive_dir = archive_dir or settings.WEBHOOK_ARCHIVE_DIR
+    with locked_state(os.path.join(archive_dir, INDEX_FILE)) as state:
+        return list(state.get('segments', []))
+
+
+def read_segment(archive_dir, name):
+    with gzip.open(os.path.join(archive_dir, name), 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+def delete_archived(ids, chunk_size):
+    # Короткие транзакции по chunk_size строк: SQLite не держит блокировку
+    # на запись, пока удаляется весь сегмент, и вебхуки продолжают писаться.
+    deleted = 0
+    for start in range(0, len(ids), chunk_size):
+        with transaction.atomic():
+            count, _ = WebhookLog.objects.filter(
+                id__in=ids[start:start + chunk_size], status__in=ARCHIVE_STATUSES
+            ).delete()
+        deleted += count
+    return deleted
+
+
+def _segment_entry(archive_dir, name):
+    # запись индекса по самому файлу - для сегментов, которых индекс не знает
+    ids, orders, first_at, last_at = [], {}, None, None
+    for record in read_segment(archive_dir, name):
+        ids.append(record['id'])
+        first_at = first_at or record['created_at']
+        last_at = record['created_at']
+        if record.get('order_id') is not None:
+            orders.setdefault(str(record['order_id']), []).append(record['id'])
+
+    with open(_idx_path(os.path.join(archive_dir, name)), 'wb') as f:
+        f.write(dumps(orders))
+    return {
+        'count': len(ids),
+        'first_id': min(ids) if ids else None,
+        'last_id': max(ids) if ids else None,
+        'from': first_at,
+        'to': last_at,
+        'deleted': False,
+    }
+
+
+def recover_segments(archive_dir):
+    # Порядок записи: tmp -> index.json -> rename -> удаление строк.
+    # После падения на любом шаге:
+    # - tmp без записи в индексе - сегмент не дописан, файл удаляется;
+    # - запись в индексе без файла - переименование не успело, доводим его;
+    # - *.jsonl.gz без записи в индексе (сегменты до этого порядка записи) -
+    #   добавляем в индекс, строки дочистит finish_pending_deletes.
+    known = {segment['file'] for segment in read_index(archive_dir)}
+    for filename in sorted(os.listdir(archive_dir)):
+        if filename.endswith('.jsonl.gz.tmp') and filename[:-len('.tmp')] not in known:
+            os.remove(os.path.join(archive_dir, filename))
+            logger.warning("Архив: удалён недописанный сегмент %s", filename)
+        elif filename.endswith('.jsonl.gz') and filename not in known:
+            _update_index(archive_dir, filename, **_segment_entry(archive_dir, filename))
+            logger.warning("Архив: сегмент %s не был в индексе, добавлен", filename)
+
+    for segment in read_index(archive_dir):
+        if segment.get('deleted'):
+            continue
+        path = os.path.join(archive_dir, segment['file'])
+        if os.path.exists(path):
+            continue
+        if os.path.exists(path + '.tmp'):
+            os.replace(path + '.tmp', path)
+            logger.warning("Архив: сегмент %s переименован после сбоя", segment['file'])
+        else:
+            _drop_from_index(archive_dir, segment['file'])
+            logger.warning("Архив: файла сегмента %s нет, запись удалена из индекса", segment['file'])
+
+
+def finish_pending_deletes(archive_dir, chunk_size):
+    # Сегмент записан, но процесс упал до удаления строк: дочищаем по id
+    # из самого файла, иначе строки попали бы в архив повторно.
+    for segment in read_index(archive_dir):
+        if segment.get('deleted'):
+            continue
+        ids = [record['id'] for record in read_segment(archive_dir, segment['file'])]
+        delete_archived(ids, chunk_size)
+        _update_index(archive_dir, segment['file'], deleted=True)
+        logger.info("Архив: дочищен сегмент %s (%s строк)", segment['file'], len(ids))
+
+
+def _archivable_page(cutoff, dead_cutoff, after, chunk_size):
+    final_statuses = [status for status in ARCHIVE_STATUSES if status != DEAD_STATUS]
+    queryset = WebhookLog.objects.filter(
+        Q(status__in=final_statuses, created_at__lt=cutoff) | Q(status=DEAD_STATUS, created_at__lt=dead_cutoff)
+    )
+    if after is not None:
+        created_at, last_id = after
+        queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=last_id))
+    return list(queryset.order_by('created_at', 'id')[:chunk_size])
+
+
+def archive_segment(cutoff, dead_cutoff, archive_dir, segment_size, chunk_size):
+    writer = None
+    after = None
+
+    try:
+        while writer is None or len(writer.ids) < segment_size:
+            limit = chunk_size if writer is None else min(chunk_size, segment_size - len(writer.ids))
+            page = _archivable_page(cutoff, dead_cutoff, after, limit)
+            if not page:
+                break
+
+            if writer is None:
+                writer = SegmentWriter(archive_dir, page[0])
+            for webhook_log in page:
+                writer.write(webhook_log)
+            after = (page[-1].created_at, page[-1].id)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is None:
+        return None
+
+    entry = writer.close()
+    _update_index(archive_dir, entry.pop('file'), **entry)
+    writer.commit()
+    delete_archived(writer.ids, chunk_size)
+    _update_index(archive_dir, writer.name, deleted=True)
+
+    logger.info("Архив: %s, %s вебхуков за %s - %s", writer.name, len(writer.ids), entry['from'], entry['to'])
+    return writer.name
+
+
+def archive_webhooks(cutoff=None, archive_dir=None, segment_size=None, chunk_size=None, max_segments=None, dead_cutoff=None):
+    cutoff = cutoff or archive_cutoff()
+    # dead не уходят в архив раньше остальных, даже если --days больше
+    dead_cutoff = min(cutoff, dead_cutoff or archive_cutoff(settings.WEBHOOK_ARCHIVE_DEAD_AFTER_DAYS))
+    archive_dir = archive_dir or settings.WEBHOOK_ARCHIVE_DIR
+    segment_size = segment_size or settings.WEBHOOK_ARCHIVE_SEGMENT_SIZE
+    chunk_size = chunk_size or settings.WEBHOOK_ARCHIVE_CHUNK_SIZE
+    os.makedirs(archive_dir, exist_ok=True)
+
+    recover_segments(archive_dir)
+    finish_pending_deletes(archive_dir, chunk_size)
+
+    segments = []
+    while max_segments is None or len(segments) < max_segments:
+        name = archive_segment(cutoff, dead_cutoff, archive_dir, segment_size, chunk_size)
+        if name is None:
+            break
+        segments.append(name)
+    return segments
+
+
+def find_archived(order_id=None, date=None, archive_dir=None):
+    # date - строка 'YYYY-MM-DD'; для поиска по заказу сначала смотрим
+    # *.idx.json и открываем только сегменты, где заказ есть.
+    archive_dir = archive_dir or settings.WEBHOOK_ARCHIVE_DIR
+    order_id = str(order_id) if order_id is not None else None
+
+    for segment in read_index(archive_dir):
+        if date is not None and not (segment['from'][:10] <= date <= segment['to'][:10]):
+            continue
+
+        ids = None
+        if order_id is not None:
+            with open(_idx_path(os.path.join(archive_dir, segment['file'])), 'rb') as f:
+                ids = set(loads(f.read()).get(order_id, ()))
+            if not ids:
+                continue
+
+        for record in read_segment(archive_dir, segment['file']):
+            if ids is not None and record['id'] not in ids:
+                continue
+            if date is not None and not (record['created_at'] or '').startswith(date):
+                continue
+            yield record
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import time
+import weakref
+import httpx
+import requests
+from .amocrm_client import AmoCRMRequestsMixin, lookup_failed
+from .fastjson import dumps
+from .contacts import alookup_contact_id, aremember_contact
+from .leads import alookup_lead_id, aremember_lead
+from .paging import AsyncPageStream
+from .transport import BaseTransport, endpoint_name
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAmoCRMTransport(BaseTransport):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+        )
+
+    def _admit(self):
+        self.breaker.before_request()
+        return self.limiter.reserve()
+
+    async def request(self, method, url, endpoint, headers=None, body=None):
+        key = f"{method} {endpoint_name(endpoint)}"
+
+        # breaker, лимитер и метрики держат общее состояние под flock: эти
+        # вызовы уходят в поток, чтобы не блокировать event loop
+        for attempt in range(self.max_retries + 1):
+            waited = await asyncio.to_thread(self._admit)
+            if waited > 0:
+                await asyncio.sleep(waited)
+
+            started = time.monotonic()
+            status = 'error'
+            try:
+                response = await self.client.request(method, url, headers=headers, content=body)
+                status = response.status_code
+            finally:
+                await asyncio.to_thread(self._record, key, waited, time.monotonic() - started, status)
+
+            if await asyncio.to_thread(self._retry_delay, key, response, attempt) is None:
+                return response
+
+        return response
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# httpx.AsyncClient привязан к event loop, в котором открыл соединения:
+# под ASGI loop один на процесс, но async_to_sync создаёт свой на вызов
+_transports = weakref.WeakKeyDictionary()
+
+
+async def _close_with_loop(transport):
+    # Задача ждёт до конца loop: asyncio.run - через него свой loop
+    # запускает и async_to_sync - перед закрытием отменяет оставшиеся
+    # задачи, и клиент закрывается в своём loop
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        await transport.aclose()
+
+
+def get_async_transport():
+    loop = asyncio.get_running_loop()
+    transport = _transports.get(loop)
+    if transport is None:
+        transport = _transports[loop] = AsyncAmoCRMTransport()
+        # loop держит на задачу только слабую ссылку
+        transport.closer = loop.create_task(_close_with_loop(transport))
+    return transport
+
+
+# Сборка запросов (build_*, разбор ответов) общая с AmoCRMClient через
+# AmoCRMRequestsMixin, а методы, которые ходят в amoCRM, здесь - корутины.
+# Пакетных методов нет: пакеты собирает фоновый воркер, а не async-view.
+class AsyncAmoCRMClient(AmoCRMRequestsMixin):
+    # iter_leads/iter_contacts отдают AsyncPageStream: async for lead in ...
+    page_stream_class = AsyncPageStream
+
+    def __init__(self, transport=None):
+        super().__init__(transport=transport or get_async_transport())
+
+    async def _get_page(self, endpoint):
+        return await self._make_request('GET', endpoint)
+
+    async def _make_request(self, method, endpoint, data=None):
+        url = f"{self.base_url}/{endpoint}"
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json'
+        }
+
+        try:
+            body = dumps(data) if data is not None else None
+            response = await self.transport.request(method, url, endpoint, headers=headers, body=body)
+            return self._handle_response(response)
+        except Exception as e:
+            logger.error("AmoCRM API error: %s", e)
+            raise
+
+    def _raise_for_status(self, response):
+        # тот же тип ошибки, что и у синхронного клиента: обработка
+        # 400/404/429 в processing не должна зависеть от HTTP-библиотеки
+        if response.status_code >= 400:
+            reason = 'Client Error' if response.status_code < 500 else 'Server Error'
+            raise requests.HTTPError(
+                f"{response.status_code} {reason}: {response.reason_phrase} for url: {response.url}",
+                response=response
+            )
+
+    async def find_contact_by_email(self, email, use_index=True):
+        if use_index:
+            contact_id = await alookup_contact_id(email)
+            if contact_id:
+                return {'id': contact_id}
+
+        try:
+            data = await self._make_request('GET', f"contacts?query={email}")
+            contact = self._first_contact(data)
+        except Exception as e:
+            logger.error("Error finding contact by email %s: %s", email, e)
+            if lookup_failed(e):
+                raise
+            return None
+
+        if contact:
+            await aremember_contact(email, contact['id'])
+        return contact
+
+    async def get_contact(self, contact_id):
+        try:
+            data = await self._make_request('GET', f'contacts/{contact_id}')
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+        return data or None
+
+    async def create_contact(self, email, name, phone=None):
+        contact_data = self.build_contact_data(email, name, phone)
+
+        try:
+            data = await self._make_request('POST', 'contacts', [contact_data])
+            contact = data['_embedded']['contacts'][0]
+        except Exception as e:
+            logger.error("Error creating contact: %s", e)
+            raise
+
+        await aremember_contact(email, contact['id'])
+        return contact
+
+    async def find_lead_by_order_id(self, order_id, use_index=True):
+        if use_index:
+            lead_id = await alookup_lead_id(order_id)
+            if lead_id:
+                return {'id': lead_id}
+
+        try:
+            logger.info("🔍 Поиск сделки: %s", order_id)
+
+            clean_order_id = self._clean_order_id(order_id)
+            data = await self._make_request('GET', f"leads?query={clean_order_id}&with=custom_fields")
+            lead = self._select_lead(data, clean_order_id)
+        except Exception as e:
+            logger.error("Ошибка поиска: %s", e)
+            if lookup_failed(e):
+                raise
+            return None
+
+        if lead:
+            await aremember_lead(clean_order_id, lead['id'])
+        return lead
+
+    async def create_lead_with_custom_fields(self, contact_id, customer_info):
+        lead_data = self.build_lead_data(contact_id, customer_info)
+
+        logger.info("Создаю сделку '%s' с %s полями", lead_data['name'], len(lead_data['custom_fields_values']))
+
+        try:
+            data = await self._make_request('POST', 'leads', [lead_data])
+            lead = data['_embedded']['leads'][0]
+            logger.info("✅ Сделка создана: %s", lead['id'])
+        except Exception as e:
+            logger.error("❌ Ошибка: %s", e)
+            raise
+
+        await aremember_lead(customer_info.get('order_id'), lead['id'], contact_id)
+        return lead
+
+    async def create_lead_with_contact(self, customer_info):
+        lead_data = self.build_complex_lead_data(customer_info)
+
+        logger.info("Создаю контакт и сделку '%s' одним запросом", lead_data['name'])
+
+        try:
+            data = await self._make_request('POST', 'leads/complex', [lead_data])
+            lead = self._parse_complex_leads(data)[0]
+            logger.info("✅ Сделка %s и контакт %s созданы", lead['id'], lead['contact_id'])
+        except Exception as e:
+            logger.error("❌ Ошибка: %s", e)
+            raise
+
+        await aremember_contact(customer_info['email'], lead['contact_id'])
+        await aremember_lead(customer_info.get('order_id'), lead['id'], lead['contact_id'])
+        return lead
+
+    async def update_lead_for_refund(self, lead_id, customer_info):
+        update_data = self.build_refund_update_data(lead_id, customer_info)
+
+        logger.info("Обновляю сделку %s для возврата", lead_id)
+
+        try:
+            return await self._make_request('PATCH', f'leads/{lead_id}', update_data)
+        except Exception as e:
+            logger.error("Error updating lead for refund %s: %s", lead_id, e)
+            raise
+
+    async def update_lead(self, lead_id, customer_info, status_id=None):
+        update_data = self.build_update_data(lead_id, customer_info, status_id)
+
+        logger.info("Обновляю сделку %s", lead_id)
+
+        try:
+            return await self._make_request('PATCH', f'leads/{lead_id}', update_data)
+        except Exception as e:
+            logger.error("Error updating lead %s: %s", lead_id, e)
+            raise
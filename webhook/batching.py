@@ -0,0 +1,115 @@
+import logging
+import time
+import requests
+from . import metrics
+from .breaker import CircuitOpenError
+from .contacts import lookup_contact_id, normalize_email, remember_contact
+from .leads import remember_lead
+from .processing import create_lead, mark_success, mark_error, spool
+
+logger = logging.getLogger(__name__)
+
+
+class LeadBatcher:
+    def __init__(self, amocrm, max_size=50, window=2.0):
+        self.amocrm = amocrm
+        self.max_size = min(max_size, 50)
+        self.window = window
+        self.items = []
+        self.first_added_at = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, webhook_log, contact_id, customer_info):
+        if contact_id is None and self.has_new_contact(customer_info['email']):
+            # второй заказ нового покупателя в том же окне: сначала создаём
+            # контакт с первым заказом, иначе leads/complex заведёт по
+            # контакту на каждый заказ
+            self.flush()
+            contact_id = lookup_contact_id(customer_info['email'])
+
+        if not self.items:
+            self.first_added_at = time.monotonic()
+        self.items.append((webhook_log, contact_id, customer_info))
+
+    def has_order(self, order_id):
+        return any(str(info['order_id']) == str(order_id) for _, _, info in self.items)
+
+    def has_new_contact(self, email):
+        key = normalize_email(email)
+        return any(
+            contact_id is None and normalize_email(info['email']) == key
+            for _, contact_id, info in self.items
+        )
+
+    def time_left(self):
+        if not self.items:
+            return None
+        return max(0.0, self.window - (time.monotonic() - self.first_added_at))
+
+    def is_due(self):
+        return len(self.items) >= self.max_size or (bool(self.items) and self.time_left() == 0)
+
+    def flush(self):
+        items, self.items = self.items, []
+        self.first_added_at = None
+        if not items:
+            return
+
+        # покупатели без контакта в amoCRM уходят в leads/complex вместе с контактом
+        with_contact = [item for item in items if item[1] is not None]
+        without_contact = [item for item in items if item[1] is None]
+
+        results = {}
+        if with_contact:
+            results.update(self._send([
+                (webhook_log.id, self.amocrm.build_lead_data(contact_id, customer_info))
+                for webhook_log, contact_id, customer_info in with_contact
+            ]))
+        if without_contact:
+            results.update(self._send([
+                (webhook_log.id, self.amocrm.build_complex_lead_data(customer_info))
+                for webhook_log, contact_id, customer_info in without_contact
+            ], with_contacts=True))
+
+        for webhook_log, contact_id, customer_info in items:
+            result = results.get(str(webhook_log.id))
+
+            if isinstance(result, dict):
+                if contact_id is None:
+                    contact_id = result['contact_id']
+                    remember_contact(customer_info['email'], contact_id)
+                remember_lead(customer_info['order_id'], result['id'], contact_id)
+                mark_success(webhook_log, contact_id, result['id'])
+                metrics.inc('webhook_results_total', result='created')
+            elif isinstance(result, CircuitOpenError):
+                spool(webhook_log, result)
+            elif isinstance(result, requests.HTTPError) and result.response is not None and result.response.status_code == 400:
+                # отклонённую сделку повторяем по одной: там же проверяется,
+                # не удалён ли контакт из индекса
+                self._create_single(webhook_log, contact_id, customer_info)
+            else:
+                logger.error("Webhook %s: сделка не создана в пакете: %s", webhook_log.id, result)
+                mark_error(webhook_log, result)
+
+    def _send(self, batch, with_contacts=False):
+        try:
+            return self.amocrm.create_leads_batch(batch, with_contacts=with_contacts)
+        except Exception as e:
+            # пакет целиком не дошёл до amoCRM (breaker, сеть): ошибка
+            # достаётся каждой строке и решает, спулить её или повторять
+            return {str(request_id): e for request_id, _ in batch}
+
+    def _create_single(self, webhook_log, contact_id, customer_info):
+        try:
+            lead, contact_id = create_lead(self.amocrm, contact_id, customer_info)
+        except CircuitOpenError as e:
+            spool(webhook_log, e)
+            return
+        except Exception as e:
+            logger.error("Webhook %s processing error: %s", webhook_log.id, e)
+            mark_error(webhook_log, e)
+            return
+        mark_success(webhook_log, contact_id, lead['id'])
+        metrics.inc('webhook_results_total', result='created')
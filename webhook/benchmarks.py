@@ -0,0 +1,265 @@
+import itertools
+import json
+import logging
+import random
+import time
+import requests
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from . import taxonomy, views
+from .amocrm_client import AmoCRMClient
+from .fastjson import dumps, loads
+from .replay import percentile
+from .sandbox import isolated_environment
+from .transport import override_transport
+from .utils import verify_radario_webhook, extract_customer_info
+
+# Размеры заказа: (билетов в payload, вызовов на один замер). small - только
+# обязательные поля, typical - обычная покупка, large - 500 билетов разом.
+PAYLOAD_SIZES = {
+    'small': (0, 5000),
+    'typical': (2, 2000),
+    'large': (500, 50),
+}
+
+
+def measure(func, inputs, repeat=5):
+    # лучший из repeat прогонов по всем inputs, в микросекундах на вызов
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for args in inputs:
+            func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    per_call = best / len(inputs)
+    return {'calls': len(inputs), 'us_per_call': round(per_call * 1e6, 3), 'ops_per_sec': round(1 / per_call)}
+
+
+def legacy_map_event_type(event_title):
+    # Прежняя реализация AmoCRMClient._map_event_type, только для сравнения
+    event_title_lower = event_title.lower()
+
+    mapping = {
+        'мастер-класс': 'Мастер-класс', 'мастер класс': 'Мастер-класс', 'программа': 'Программа',
+        'лекция': 'Лекция', 'театральное занятие': 'Театральное занятие', 'игра': 'Игра',
+        'резиденция': 'Резиденция', 'выставка': 'Выставка', 'спектакль': 'Спектакль',
+        'экскурсия': 'Экскурсия', 'концерт': 'Концерт', 'шоу': 'Шоу', 'комбо': 'Комбо',
+        'кинопоказ': 'Кинопоказ', 'конференция': 'Конференция', 'фестиваль': 'Фестиваль',
+        'творческая встреча': 'Творческая встреча', 'кинофестиваль': 'Кинофестиваль',
+        'открытый разговор': 'Открытый разговор', 'митап': 'Митап', 'мит-ап': 'Митап',
+        'дискуссия': 'Дискуссия', 'встреча': 'Встреча', 'перформанс': 'Перформанс',
+        'workshop': 'Workshop', 'воркшоп': 'Воркшоп', 'арт-терапия': 'Арт-терапия',
+        'занятие': 'Занятие', 'паблик-ток': 'Паблик-топ', 'ted-talk': 'TED-talk', 'показ': 'Показ',
+        'диалог': 'Диалог', 'книжный клуб': 'Книжный клуб', 'book club': 'Книжный клуб',
+        'bookclub': 'Книжный клуб', 'литературный клуб': 'Книжный клуб',
+        'литературная встреча': 'Книжный клуб', 'чтение': 'Книжный клуб',
+        'литературный вечер': 'Книжный клуб', 'обсуждение книги': 'Книжный клуб',
+    }
+
+    for key, value in mapping.items():
+        if key in event_title_lower:
+            return value
+
+    for key in mapping.keys():
+        if key.replace('-', ' ') in event_title_lower:
+            return mapping[key]
+
+    return 'Другое'
+
+
+def sample_event_titles(count=300, seed=1):
+    rng = random.Random(seed)
+    prefixes = ['', 'Большой ', 'Семейный ', 'Вечерний ', 'Авторский ']
+    subjects = [keyword for keyword, _ in taxonomy.EVENT_KEYWORDS] + ['вечер джаза', 'день открытых дверей']
+    suffixes = ['', ' в Октаве', ' для детей', ' «Осень в Туле»', ' и ужин с шефом', ' 18+']
+    return [
+        f"{rng.choice(prefixes)}{rng.choice(subjects)}{rng.choice(suffixes)} #{index}".capitalize()
+        for index in range(count)
+    ]
+
+
+def run_taxonomy(orders=20000):
+    # Как в проде: несколько сотен названий повторяются на тысячах заказов
+    titles = sample_event_titles()
+    inputs = [(titles[index % len(titles)],) for index in range(orders)]
+    unique = [(title,) for title in titles]
+
+    compiled_cold = taxonomy.event_type.__wrapped__
+
+    results = {
+        'legacy': measure(legacy_map_event_type, inputs),
+        'compiled': measure(compiled_cold, inputs),
+        'memoized': measure(taxonomy.event_type, inputs),
+        'legacy_unique_titles': measure(legacy_map_event_type, unique),
+        'compiled_unique_titles': measure(compiled_cold, unique),
+    }
+    results['speedup_memoized'] = round(results['legacy']['us_per_call'] / results['memoized']['us_per_call'], 1)
+    results['speedup_compiled'] = round(results['legacy']['us_per_call'] / results['compiled']['us_per_call'], 1)
+    return results
+
+
+def sample_payload(tickets, order_id=1765169600, email='bench@bench.invalid'):
+    model = {
+        'Id': order_id,
+        'Email': email,
+        'Status': 'Paid',
+        'PaymentSystemStatus': 'Paid',
+        'Event': {'Title': 'Мастер-класс по керамике «Осень в Туле»', 'BeginDate': '2025-12-20T18:00:00Z'},
+    }
+    if not tickets:
+        return {'model': model}
+
+    model.update({
+        'PaymentSystemStatusDescription': 'Оплачен',
+        'Amount': 2500.0 * tickets,
+        'HostProfit': 2300.0 * tickets,
+        'CreationDate': '2025-12-08T02:55:00Z',
+        'PaymentDate': '2025-12-08T03:00:00.123Z',
+        'UpdateDate': '2025-12-08T03:00:00Z',
+        'User': {'Name': 'Иванов Иван', 'Phone': '+79001234567', 'Email': email},
+        'PaymentType': 'Card',
+        'Promocode': 'AUTUMN',
+        'DistributionType': 'Site',
+        'Currency': 'RUB',
+        'UtmData': {'utm_source': 'vk', 'utm_campaign': 'autumn'},
+        'CustomData': json.dumps({'fio': 'Иванов Иван Иванович'}, ensure_ascii=False),
+        'Tickets': [
+            {'Id': index, 'OwnerName': 'Иванов Иван Иванович', 'Barcode': f"{4600000000000 + index}",
+             'Price': 2500.0, 'Seat': {'Row': 1 + index // 20, 'Place': 1 + index % 20}, 'TariffTitle': 'Взрослый'}
+            for index in range(tickets)
+        ],
+    })
+    return {'model': model}
+
+
+def _by_size(stage):
+    return {size: stage(sample_payload(tickets), calls) for size, (tickets, calls) in PAYLOAD_SIZES.items()}
+
+
+def run_json_decode():
+    def stage(payload, calls):
+        inputs = [(dumps(payload),)] * calls
+        return {'fastjson': measure(loads, inputs), 'stdlib': measure(json.loads, inputs)}
+    return _by_size(stage)
+
+
+def run_verify():
+    return _by_size(lambda payload, calls: measure(verify_radario_webhook, [(payload,)] * calls))
+
+
+def _extract_for_lead(payload):
+    # поля, которые нужны синхронизации: ленивые поля Order тоже считаются
+    info = extract_customer_info(payload)
+    return info['email'], info['name'], info['tickets_count'], info['order_id']
+
+
+def run_extract():
+    return _by_size(lambda payload, calls: measure(_extract_for_lead, [(payload,)] * calls))
+
+
+def run_event_type(calls=20000):
+    client = AmoCRMClient(transport=object())
+    titles = sample_event_titles()
+    return measure(client._map_event_type, [(titles[index % len(titles)],) for index in range(calls)])
+
+
+def run_description():
+    client = AmoCRMClient(transport=object())
+
+    def stage(payload, calls):
+        info = extract_customer_info(payload)
+        return measure(client._create_compact_description, [(info, 'Мастер-класс', 'Оплачено')] * calls)
+    return _by_size(stage)
+
+
+def run_lead_payload():
+    # то, что собирает create_lead_with_custom_fields перед POST leads
+    client = AmoCRMClient(transport=object())
+
+    def stage(payload, calls):
+        return measure(client.build_lead_data, [(12345678, extract_customer_info(payload))] * calls)
+    return _by_size(stage)
+
+
+def run_timestamp(calls=5000):
+    client = AmoCRMClient(transport=object())
+    formats = {
+        'iso_z': '2025-12-20T18:00:00Z',
+        'iso_ms': '2025-12-20T18:00:00.123Z',
+        'russian': '20.12.2025 18:00:00',
+        'unparsed': '2025-12-20T18:00:00+03:00',
+    }
+    return {name: measure(client._convert_to_timestamp, [(value,)] * calls) for name, value in formats.items()}
+
+
+class BenchTransport:
+    # Отвечает как amoCRM, но из памяти и без сети и лимитера: в
+    # end-to-end остаётся только наш код и SQLite
+    def __init__(self):
+        self.ids = itertools.count(50000001)
+
+    def _response(self, status_code, body=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = dumps(body) if body is not None else b''
+        return response
+
+    def request(self, method, url, endpoint, headers=None, body=None):
+        if method == 'GET':
+            return self._response(204)
+
+        items = loads(body) if body else []
+        if endpoint == 'leads/complex':
+            return self._response(200, [
+                {'id': next(self.ids), 'contact_id': next(self.ids), 'request_id': [str(item.get('request_id', index))]}
+                for index, item in enumerate(items)
+            ])
+        if endpoint in ('leads', 'contacts'):
+            return self._response(200, {'_embedded': {endpoint: [
+                {'id': next(self.ids), 'request_id': str(item.get('request_id', index))}
+                for index, item in enumerate(items)
+            ]}})
+        return self._response(200, {'id': next(self.ids)})
+
+
+def run_end_to_end():
+    # Полный запрос через radario_webhook: разбор, дедупликация, запись в
+    # БД, синхронизация с amoCRM через BenchTransport. Всё пишется в
+    # одноразовую БД (isolated_environment): рабочая БД не блокируется, а
+    # breaker и метрики процесса не затрагиваются. Вебхуки обрабатываются
+    # сразу, даже если в рабочих настройках включён WEBHOOK_ASYNC_INGEST.
+    # INFO-логи на время прогона отключены, чтобы не засорять webhook.log
+    # тысячами строк.
+    factory = RequestFactory()
+    results = {}
+
+    logging.disable(logging.INFO)
+    try:
+        with isolated_environment(), override_settings(WEBHOOK_ASYNC_INGEST=False), override_transport(BenchTransport()):
+            for size, (tickets, calls) in PAYLOAD_SIZES.items():
+                calls = max(1, calls // 10)
+                timings = []
+                for index in range(calls):
+                    payload = sample_payload(tickets, order_id=f"BENCH-{size}-{index}", email=f"{size}{index}@bench.invalid")
+                    request = factory.post('/webhook/radario/', data=dumps(payload), content_type='application/json')
+
+                    started = time.perf_counter()
+                    response = views.radario_webhook(request)
+                    timings.append(time.perf_counter() - started)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"end_to_end {size}: {response.status_code} {response.content[:200]!r}")
+
+                timings.sort()
+                results[size] = {
+                    'calls': calls,
+                    'us_per_call': round(sum(timings) / calls * 1e6, 3),
+                    'p50_us': round(percentile(timings, 0.50) * 1e6, 3),
+                    'p95_us': round(percentile(timings, 0.95) * 1e6, 3),
+                    'p99_us': round(percentile(timings, 0.99) * 1e6, 3),
+                }
+    finally:
+        logging.disable(logging.NOTSET)
+
+    return results
@@ -0,0 +1,126 @@
+import logging
+import os
+import time
+from django.conf import settings
+from .sharedstate import locked_state
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Circuit breaker, общий для всех процессов на хосте, как и лимитер.
+# closed: запросы идут, подряд идущие сбои (ошибка сети, 5xx или ответ
+# дольше slow_call) считаются; после failures штук - open.
+# open: запросы сразу падают с CircuitOpenError, вебхуки откладываются в
+# очередь. Через reset_timeout - half_open.
+# half_open: пропускается по одному пробному запросу; probes успешных подряд
+# возвращают closed, любой сбой - снова open.
+class CircuitBreaker:
+    def __init__(self, path, failures=5, slow_call=10.0, reset_timeout=30.0, probes=3, probe_timeout=60.0):
+        self.path = path
+        self.failures = failures
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.probe_timeout = probe_timeout
+
+    def _current(self, state, now):
+        if state.get('state', CLOSED) == OPEN and now - state.get('opened_at', 0) >= self.reset_timeout:
+            state['state'] = HALF_OPEN
+            state['successes'] = 0
+            state['probe_until'] = 0
+            logger.warning("amoCRM: breaker half-open, пробные запросы")
+        return state.get('state', CLOSED)
+
+    def before_request(self):
+        with locked_state(self.path) as state:
+            now = time.time()
+            current = self._current(state, now)
+            if current == CLOSED:
+                return
+            if current == HALF_OPEN and state.get('probe_until', 0) <= now:
+                # пробный запрос один на все процессы; если его процесс
+                # умер, через probe_timeout пропустим следующий
+                state['probe_until'] = now + self.probe_timeout
+                return
+            retry_in = max(0.0, state.get('opened_at', now) + self.reset_timeout - now)
+
+        raise CircuitOpenError(f"amoCRM недоступен (breaker {current}), повтор через {retry_in:.0f} с")
+
+    def record(self, elapsed, failed):
+        failed = failed or elapsed >= self.slow_call
+        with locked_state(self.path) as state:
+            now = time.time()
+            current = self._current(state, now)
+
+            if not failed:
+                if current == HALF_OPEN:
+                    state['successes'] = state.get('successes', 0) + 1
+                    state['probe_until'] = 0
+                    if state['successes'] >= self.probes:
+                        self._close(state)
+                elif state.get('consecutive'):
+                    state['consecutive'] = 0
+                return
+
+            state['consecutive'] = state.get('consecutive', 0) + 1
+            if current == HALF_OPEN or (current == CLOSED and state['consecutive'] >= self.failures):
+                self._open(state, now)
+
+    def _open(self, state, now):
+        state['state'] = OPEN
+        state['opened_at'] = now
+        state['probe_until'] = 0
+        state['trips'] = state.get('trips', 0) + 1
+        logger.error("amoCRM: breaker открыт после %s сбоев подряд", state['consecutive'])
+
+    def _close(self, state):
+        state['state'] = CLOSED
+        state['consecutive'] = 0
+        state['successes'] = 0
+        logger.warning("amoCRM: breaker закрыт, запросы идут в обычном режиме")
+
+    def snapshot(self):
+        with locked_state(self.path) as state:
+            now = time.time()
+            current = self._current(state, now)
+            snapshot = {
+                'state': current,
+                'consecutive_failures': state.get('consecutive', 0),
+                'trips': state.get('trips', 0),
+            }
+            if current == OPEN:
+                snapshot['retry_in'] = round(max(0.0, state['opened_at'] + self.reset_timeout - now), 1)
+            return snapshot
+
+    @property
+    def state(self):
+        return self.snapshot()['state']
+
+    def is_closed(self):
+        return self.state == CLOSED
+
+
+_breaker = None
+
+
+def get_breaker():
+    global _breaker
+    if _breaker is None:
+        path = os.path.join(settings.AMOCRM_STATE_DIR, f"{settings.AMOCRM_SUBDOMAIN}.breaker")
+        _breaker = CircuitBreaker(
+            path,
+            failures=settings.AMOCRM_BREAKER_FAILURES,
+            slow_call=settings.AMOCRM_BREAKER_SLOW_CALL,
+            reset_timeout=settings.AMOCRM_BREAKER_RESET_TIMEOUT,
+            probes=settings.AMOCRM_BREAKER_PROBES,
+            probe_timeout=settings.AMOCRM_CONNECT_TIMEOUT + settings.AMOCRM_READ_TIMEOUT,
+        )
+    return _breaker
@@ -0,0 +1,129 @@
+import logging
+from datetime import datetime
+from django.utils import timezone
+from . import metrics
+from .models import WebhookLog
+from .utils import parse_radario_date
+
+logger = logging.getLogger(__name__)
+
+
+def _order_state(webhook_log):
+    model = (webhook_log.get_payload() or {}).get('model', {})
+    order_id = webhook_log.order_id or model.get('Id') or model.get('id')
+    update_date = parse_radario_date(model.get('UpdateDate') or model.get('updateDate'))
+    return (str(order_id) if order_id else None), (update_date or datetime.min, webhook_log.created_at, webhook_log.id)
+
+
+def latest_by_order(webhook_logs, states=None):
+    # заказ -> его последний вебхук по UpdateDate, при равных - по приходу
+    if states is None:
+        states = {webhook_log.id: _order_state(webhook_log) for webhook_log in webhook_logs}
+    latest = {}
+    for webhook_log in webhook_logs:
+        order_id, sort_key = states[webhook_log.id]
+        if order_id is None:
+            continue
+        current = latest.get(order_id)
+        if current is None or sort_key > states[current.id][1]:
+            latest[order_id] = webhook_log
+    return latest
+
+
+CLAIM_STATUSES = ['pending', 'retry']
+
+
+def _newer_finished(latest, states):
+    # заказ -> успешно обработанный вебхук новее последнего из пачки: его
+    # состояние уже в amoCRM, и пачка по этому заказу ничего не меняет
+    if not latest:
+        return {}
+    finished = latest_by_order(list(WebhookLog.objects.filter(order_id__in=list(latest), status='success')))
+    newer = {}
+    for order_id, webhook_log in finished.items():
+        states[webhook_log.id] = _order_state(webhook_log)
+        if states[webhook_log.id][1] > states[latest[order_id].id][1]:
+            newer[order_id] = webhook_log
+    return newer
+
+
+def _mark_coalesced(superseded):
+    now = timezone.now()
+    for winner_id, ids in superseded.items():
+        WebhookLog.objects.filter(id__in=ids).update(
+            status='coalesced',
+            superseded_by_id=winner_id,
+            processed_at=now,
+        )
+        metrics.inc('webhook_results_total', len(ids), result='coalesced')
+        logger.info("Вебхуки %s объединены в %s", ids, winner_id)
+
+
+def drop_superseded(webhook_logs):
+    # Повторы, у заказа которых уже применён вебхук с более поздним
+    # UpdateDate, помечаются coalesced; возвращаются остальные
+    states = {webhook_log.id: _order_state(webhook_log) for webhook_log in webhook_logs}
+    newer = _newer_finished(latest_by_order(webhook_logs, states), states)
+
+    rest = []
+    superseded = {}
+    for webhook_log in webhook_logs:
+        winner = newer.get(states[webhook_log.id][0])
+        if winner is None:
+            rest.append(webhook_log)
+        else:
+            superseded.setdefault(winner.id, []).append(webhook_log.id)
+    _mark_coalesced(superseded)
+    return rest
+
+
+def _claim_same_orders(batch):
+    # Вебхуки тех же заказов, не попавшие в пачку: по индексу (order_id,
+    # created_at) забираем все ожидающие строки этих заказов тем же
+    # воркером, иначе итоговое состояние зависело бы от границ пачки.
+    # Повторы (retry) тоже: старый повтор, дождавшись срока, затёр бы более
+    # новое состояние.
+    order_ids = {webhook_log.order_id for webhook_log in batch if webhook_log.order_id}
+    worker_id = batch[0].claimed_by if batch else None
+    if not order_ids or not worker_id:
+        return []
+
+    ids = list(
+        WebhookLog.objects.filter(order_id__in=order_ids, status__in=CLAIM_STATUSES)
+        .values_list('id', flat=True)
+    )
+    if not ids:
+        return []
+
+    WebhookLog.objects.filter(id__in=ids, status__in=CLAIM_STATUSES).update(
+        status='processing',
+        claimed_by=worker_id,
+        claimed_at=timezone.now(),
+    )
+    return list(WebhookLog.objects.filter(id__in=ids, status='processing', claimed_by=worker_id))
+
+
+def coalesce_batch(batch):
+    # Из нескольких вебхуков одного заказа обрабатываем только последний по
+    # UpdateDate: он несёт итоговое состояние, и сделка сразу создаётся или
+    # обновляется в нём, без промежуточных PATCH.
+    batch = list(batch)
+    extra = _claim_same_orders(batch)
+    if extra:
+        batch = sorted(batch + extra, key=lambda webhook_log: (webhook_log.created_at, webhook_log.id))
+    states = {webhook_log.id: _order_state(webhook_log) for webhook_log in batch}
+    latest = latest_by_order(batch, states)
+    latest.update(_newer_finished(latest, states))
+
+    result = []
+    superseded = {}
+    for webhook_log in batch:
+        order_id, _ = states[webhook_log.id]
+        winner = latest.get(order_id, webhook_log)
+        if winner is webhook_log:
+            result.append(webhook_log)
+        else:
+            superseded.setdefault(winner.id, []).append(webhook_log.id)
+
+    _mark_coalesced(superseded)
+    return result
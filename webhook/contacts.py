@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import ContactIndex
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+class ContactCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            contact_id, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return contact_id
+
+    def put(self, key, contact_id):
+        with self._lock:
+            self._data[key] = (contact_id, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_cache = ContactCache(settings.CONTACT_CACHE_SIZE, settings.CONTACT_CACHE_TTL)
+
+
+def lookup_contact_id(email):
+    key = normalize_email(email)
+    if not key:
+        return None
+
+    contact_id = _cache.get(key)
+    if contact_id is not None:
+        return contact_id
+
+    entry = ContactIndex.objects.filter(email=key).only('amocrm_contact_id', 'last_seen_at').first()
+    if entry is None:
+        return None
+
+    now = timezone.now()
+    if now - entry.last_seen_at > timedelta(days=1):
+        ContactIndex.objects.filter(pk=entry.pk).update(last_seen_at=now)
+
+    _cache.put(key, entry.amocrm_contact_id)
+    return entry.amocrm_contact_id
+
+
+async def alookup_contact_id(email):
+    key = normalize_email(email)
+    if not key:
+        return None
+
+    contact_id = _cache.get(key)
+    if contact_id is not None:
+        return contact_id
+
+    entry = await ContactIndex.objects.filter(email=key).only('amocrm_contact_id', 'last_seen_at').afirst()
+    if entry is None:
+        return None
+
+    now = timezone.now()
+    if now - entry.last_seen_at > timedelta(days=1):
+        await ContactIndex.objects.filter(pk=entry.pk).aupdate(last_seen_at=now)
+
+    _cache.put(key, entry.amocrm_contact_id)
+    return entry.amocrm_contact_id
+
+
+def remember_contact(email, contact_id):
+    key = normalize_email(email)
+    if not key or not contact_id:
+        return
+
+    ContactIndex.objects.update_or_create(
+        email=key,
+        defaults={'amocrm_contact_id': contact_id, 'last_seen_at': timezone.now()},
+    )
+    _cache.put(key, contact_id)
+
+
+async def aremember_contact(email, contact_id):
+    key = normalize_email(email)
+    if not key or not contact_id:
+        return
+
+    await ContactIndex.objects.aupdate_or_create(
+        email=key,
+        defaults={'amocrm_contact_id': contact_id, 'last_seen_at': timezone.now()},
+    )
+    _cache.put(key, contact_id)
+
+
+def forget_contact(email):
+    key = normalize_email(email)
+    _cache.discard(key)
+    deleted, _ = ContactIndex.objects.filter(email=key).delete()
+    if deleted:
+        logger.info("Контакт %s удалён из индекса", key)
+
+
+async def aforget_contact(email):
+    key = normalize_email(email)
+    _cache.discard(key)
+    deleted, _ = await ContactIndex.objects.filter(email=key).adelete()
+    if deleted:
+        logger.info("Контакт %s удалён из индекса", key)
@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import OperationalError
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'REPLACE')
+
+_stats_lock = threading.Lock()
+_stats = {'writes': 0, 'slow': 0, 'locked': 0, 'total': 0.0, 'max': 0.0}
+
+
+def _record_write(elapsed, locked):
+    with _stats_lock:
+        _stats['writes'] += 1
+        _stats['total'] += elapsed
+        if elapsed > _stats['max']:
+            _stats['max'] = elapsed
+        if elapsed >= settings.DB_SLOW_WRITE_THRESHOLD:
+            _stats['slow'] += 1
+        if locked:
+            _stats['locked'] += 1
+
+    metrics.observe('sqlite_write_duration_seconds', elapsed)
+    if locked:
+        metrics.inc('sqlite_locked_total')
+
+
+def write_stats_snapshot():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def instrument_writes(execute, sql, params, many, context):
+    # SQLite не сообщает, сколько запрос ждал блокировку; долгий INSERT,
+    # UPDATE или BEGIN IMMEDIATE почти всегда означает ожидание чужой записи.
+    if not sql.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+        return execute(sql, params, many, context)
+
+    locked = False
+    started = time.monotonic()
+    try:
+        return execute(sql, params, many, context)
+    except OperationalError as e:
+        locked = 'locked' in str(e)
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        _record_write(elapsed, locked)
+        if locked:
+            logger.error("SQLite: база заблокирована через %.1f с: %s", elapsed, sql[:100])
+        elif elapsed >= settings.DB_SLOW_WRITE_THRESHOLD:
+            logger.warning("SQLite: запись заняла %.0f мс: %s", elapsed * 1000, sql[:100])
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+    # сигнал приходит на каждое переподключение, а список обёрток живёт
+    # вместе с DatabaseWrapper
+    if instrument_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrument_writes)
@@ -0,0 +1,71 @@
+import hashlib
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import WebhookFingerprint
+
+logger = logging.getLogger(__name__)
+
+_last_purge = 0.0
+
+
+def webhook_fingerprint(customer_info):
+    parts = [
+        customer_info.get('order_id'),
+        customer_info.get('status'),
+        customer_info.get('payment_system_status'),
+        customer_info.get('update_date'),
+    ]
+    raw = '|'.join('' if part is None else str(part) for part in parts)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _cutoff():
+    return timezone.now() - timedelta(seconds=settings.WEBHOOK_DEDUP_RETENTION)
+
+
+def find_duplicate(fingerprint):
+    return (
+        WebhookFingerprint.objects.select_related('webhook_log')
+        .filter(fingerprint=fingerprint, created_at__gte=_cutoff())
+        .first()
+    )
+
+
+def register_fingerprint(fingerprint, webhook_log):
+    # старый отпечаток за пределами окна хранения мешал бы unique-индексу
+    WebhookFingerprint.objects.filter(fingerprint=fingerprint, created_at__lt=_cutoff()).delete()
+    return WebhookFingerprint.objects.create(fingerprint=fingerprint, webhook_log=webhook_log)
+
+
+def release_fingerprint(webhook_log):
+    # после ошибки повтор от Radario должен обработаться заново
+    WebhookFingerprint.objects.filter(webhook_log=webhook_log).delete()
+
+
+async def afind_duplicate(fingerprint):
+    return await (
+        WebhookFingerprint.objects.select_related('webhook_log')
+        .filter(fingerprint=fingerprint, created_at__gte=_cutoff())
+        .afirst()
+    )
+
+
+async def arelease_fingerprint(webhook_log):
+    await WebhookFingerprint.objects.filter(webhook_log=webhook_log).adelete()
+
+
+def purge_expired(force=False):
+    global _last_purge
+
+    now = time.monotonic()
+    if not force and now - _last_purge < settings.WEBHOOK_DEDUP_PURGE_INTERVAL:
+        return 0
+    _last_purge = now
+
+    deleted, _ = WebhookFingerprint.objects.filter(created_at__lt=_cutoff()).delete()
+    if deleted:
+        logger.info("Удалено устаревших отпечатков вебхуков: %s", deleted)
+    return deleted
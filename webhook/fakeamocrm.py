@@ -0,0 +1,360 @@
+import itertools
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Заменитель amoCRM API v4 для нагрузочных прогонов и бенчмарков: те же
+# эндпоинты и формат ответов, что использует AmoCRMClient, состояние в
+# памяти процесса. Клиент переключается на него через AMOCRM_BASE_URL.
+
+API_PREFIX = '/api/v4/'
+DEFAULT_PIPELINE_ID = 9713218
+DEFAULT_STATUS_ID = 142
+MAX_PAGE_SIZE = 250
+
+
+def parse_latency(spec):
+    # fixed:50 | uniform:20:200 | lognormal:80:0.5 (медиана в мс и sigma)
+    if not spec:
+        return lambda: 0.0
+
+    kind, *args = spec.split(':')
+    args = [float(arg) for arg in args]
+    if kind == 'fixed':
+        return lambda: args[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(args[0], args[1]) / 1000
+    if kind == 'lognormal':
+        mu = math.log(args[0])
+        return lambda: random.lognormvariate(mu, args[1]) / 1000
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+class FaultConfig:
+    def __init__(self, latency=None, error_429=0.0, error_5xx=0.0, rate_limit=None, retry_after=1):
+        self.latency = parse_latency(latency)
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._tokens = float(rate_limit or 0)
+        self._updated = time.monotonic()
+
+    def take_token(self):
+        # тот же token bucket, что у настоящего amoCRM: rate_limit запросов в
+        # секунду, сверх лимита - 429
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._updated) * self.rate_limit)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class FakeAmoCRMState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contacts = {}
+        self.leads = {}
+        self._ids = itertools.count(10000001)
+        self.requests = 0
+
+    def _contact(self, data):
+        now = int(time.time())
+        contact = {
+            'id': next(self._ids),
+            'name': data.get('name') or '',
+            'custom_fields_values': data.get('custom_fields_values') or [],
+            'created_at': now,
+            'updated_at': now,
+        }
+        self.contacts[contact['id']] = contact
+        return contact
+
+    def _lead(self, data, contact_ids):
+        now = int(time.time())
+        lead = {
+            'id': next(self._ids),
+            'name': data.get('name') or '',
+            'price': data.get('price') or 0,
+            'pipeline_id': data.get('pipeline_id') or DEFAULT_PIPELINE_ID,
+            'status_id': data.get('status_id') or DEFAULT_STATUS_ID,
+            'custom_fields_values': data.get('custom_fields_values') or [],
+            'created_at': now,
+            'updated_at': now,
+            '_embedded': {'contacts': [{'id': contact_id} for contact_id in contact_ids]},
+        }
+        self.leads[lead['id']] = lead
+        return lead
+
+    def validate_lead(self, data):
+        errors = []
+        if not isinstance(data.get('name', ''), str):
+            errors.append({'code': 'FieldInvalidType', 'path': 'name', 'detail': 'This value should be of type string.'})
+        if (data.get('price') or 0) < 0:
+            errors.append({'code': 'FieldInvalidValue', 'path': 'price', 'detail': 'This value should be positive.'})
+        return errors
+
+    def add_contacts(self, items):
+        with self.lock:
+            return [self._contact(item) for item in items]
+
+    def add_leads(self, items):
+        with self.lock:
+            return [
+                self._lead(item, [c['id'] for c in (item.get('_embedded') or {}).get('contacts') or [] if c.get('id')])
+                for item in items
+            ]
+
+    def add_complex(self, items):
+        with self.lock:
+            created = []
+            for item in items:
+                contacts = [self._contact(c) for c in (item.get('_embedded') or {}).get('contacts') or []]
+                lead = self._lead(item, [c['id'] for c in contacts])
+                created.append((lead, contacts[0]['id'] if contacts else None))
+            return created
+
+    def update_lead(self, lead_id, data):
+        with self.lock:
+            lead = self.leads.get(lead_id)
+            if lead is None:
+                return None
+            for key in ('name', 'price', 'status_id', 'pipeline_id'):
+                if key in data:
+                    lead[key] = data[key]
+            if data.get('custom_fields_values'):
+                fields = {field.get('field_id'): field for field in lead['custom_fields_values']}
+                for field in data['custom_fields_values']:
+                    fields[field.get('field_id')] = field
+                lead['custom_fields_values'] = list(fields.values())
+            lead['updated_at'] = int(time.time())
+            return lead
+
+    def _matches(self, entity, query):
+        query = query.lower()
+        if query in entity['name'].lower():
+            return True
+        return any(
+            query in str(value.get('value', '')).lower()
+            for field in entity['custom_fields_values']
+            for value in field.get('values') or []
+        )
+
+    def search(self, collection, query):
+        with self.lock:
+            items = list(getattr(self, collection).values())
+        if query:
+            items = [item for item in items if self._matches(item, query)]
+        return items
+
+
+class FakeAmoCRMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeAmoCRM/1.0'
+
+    def log_message(self, format, *args):
+        logger.debug("fake amoCRM: " + format, *args)
+
+    def _send(self, status, body=None, headers=None):
+        content = json.dumps(body, ensure_ascii=False).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/hal+json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _dispatch(self, method):
+        state, faults = self.server.state, self.server.faults
+        with state.lock:
+            state.requests += 1
+
+        # тело читаем до любого ответа, иначе keep-alive соединение собьётся
+        try:
+            body = self._read_json() if method in ('POST', 'PATCH') else None
+        except ValueError:
+            return self._send(400, {'title': 'Bad Request', 'detail': 'Invalid JSON'})
+
+        delay = faults.latency()
+        if delay > 0:
+            time.sleep(delay)
+
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self._send(401, {'title': 'Unauthorized', 'status': 401})
+        if not faults.take_token() or random.random() < faults.error_429:
+            return self._send(429, {'title': 'Too Many Requests', 'status': 429}, {'Retry-After': str(faults.retry_after)})
+        if random.random() < faults.error_5xx:
+            status = random.choice((500, 502, 503))
+            return self._send(status, {'title': 'Server Error', 'status': status})
+
+        url = urlsplit(self.path)
+        if not url.path.startswith(API_PREFIX):
+            return self._send(404, {'title': 'Not Found', 'status': 404})
+        endpoint = url.path[len(API_PREFIX):].strip('/')
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        for pattern, handler_method, handler in ROUTES:
+            match = re.fullmatch(pattern, endpoint)
+            if match and handler_method == method:
+                return handler(self, state, query, body, *match.groups())
+        return self._send(404, {'title': 'Not Found', 'status': 404})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def _page(self, collection, items, query):
+        items = sorted(items, key=lambda item: item['id'])
+        limit = min(int(query.get('limit') or 50), MAX_PAGE_SIZE)
+        page = max(int(query.get('page') or 1), 1)
+        chunk = items[(page - 1) * limit:page * limit]
+        if not chunk:
+            return self._send(204)
+
+        links = {'self': {'href': self.path}}
+        if page * limit < len(items):
+            next_query = urlencode(dict(query, page=page + 1, limit=limit))
+            links['next'] = {'href': f"{urlsplit(self.path).path}?{next_query}"}
+        return self._send(200, {'_page': page, '_links': links, '_embedded': {collection: chunk}})
+
+    def get_contacts(self, state, query, body):
+        return self._page('contacts', state.search('contacts', query.get('query')), query)
+
+    def get_contact(self, state, query, body, contact_id):
+        contact = state.contacts.get(int(contact_id))
+        if contact is None:
+            return self._send(204)
+        return self._send(200, contact)
+
+    def get_leads(self, state, query, body):
+        leads = state.search('leads', query.get('query'))
+        pipeline_id = query.get('filter[pipeline_id]')
+        if pipeline_id:
+            leads = [lead for lead in leads if str(lead['pipeline_id']) == pipeline_id]
+        return self._page('leads', leads, query)
+
+    def get_lead(self, state, query, body, lead_id):
+        lead = state.leads.get(int(lead_id))
+        if lead is None:
+            return self._send(204)
+        return self._send(200, lead)
+
+    def post_contacts(self, state, query, body):
+        contacts = state.add_contacts(body or [])
+        return self._send(200, {'_embedded': {'contacts': [
+            {'id': contact['id'], 'request_id': str(index)} for index, contact in enumerate(contacts)
+        ]}})
+
+    def _validation_errors(self, state, items):
+        errors = []
+        for index, item in enumerate(items):
+            item_errors = state.validate_lead(item)
+            if item_errors:
+                errors.append({'request_id': str(item.get('request_id', index)), 'errors': item_errors})
+        return errors
+
+    def post_leads(self, state, query, body):
+        items = body or []
+        errors = self._validation_errors(state, items)
+        if errors:
+            return self._send(400, {'title': 'Bad Request', 'status': 400, 'validation-errors': errors})
+
+        leads = state.add_leads(items)
+        return self._send(200, {'_embedded': {'leads': [
+            {'id': lead['id'], 'request_id': str(item.get('request_id', index))}
+            for index, (lead, item) in enumerate(zip(leads, items))
+        ]}})
+
+    def post_complex(self, state, query, body):
+        items = body or []
+        errors = self._validation_errors(state, items)
+        if errors:
+            return self._send(400, {'title': 'Bad Request', 'status': 400, 'validation-errors': errors})
+
+        created = state.add_complex(items)
+        return self._send(200, [
+            {'id': lead['id'], 'contact_id': contact_id, 'company_id': None,
+             'request_id': [str(item.get('request_id', index))], 'merged': False}
+            for index, ((lead, contact_id), item) in enumerate(zip(created, items))
+        ])
+
+    def patch_leads(self, state, query, body):
+        items = body or []
+        if any('id' not in item for item in items):
+            return self._send(400, {'title': 'Bad Request', 'status': 400, 'detail': 'id is required'})
+
+        updated = [state.update_lead(int(item['id']), item) for item in items]
+        if any(lead is None for lead in updated):
+            return self._send(404, {'title': 'Not Found', 'status': 404})
+        return self._send(200, {'_embedded': {'leads': [
+            {'id': lead['id'], 'updated_at': lead['updated_at']} for lead in updated
+        ]}})
+
+    def patch_lead(self, state, query, body, lead_id):
+        lead = state.update_lead(int(lead_id), body or {})
+        if lead is None:
+            return self._send(404, {'title': 'Not Found', 'status': 404})
+        return self._send(200, {'id': lead['id'], 'updated_at': lead['updated_at']})
+
+
+ROUTES = (
+    (r'contacts', 'GET', FakeAmoCRMHandler.get_contacts),
+    (r'contacts/(\d+)', 'GET', FakeAmoCRMHandler.get_contact),
+    (r'contacts', 'POST', FakeAmoCRMHandler.post_contacts),
+    (r'leads', 'GET', FakeAmoCRMHandler.get_leads),
+    (r'leads/(\d+)', 'GET', FakeAmoCRMHandler.get_lead),
+    (r'leads', 'POST', FakeAmoCRMHandler.post_leads),
+    (r'leads/complex', 'POST', FakeAmoCRMHandler.post_complex),
+    (r'leads', 'PATCH', FakeAmoCRMHandler.patch_leads),
+    (r'leads/(\d+)', 'PATCH', FakeAmoCRMHandler.patch_lead),
+)
+
+
+class FakeAmoCRMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, faults=None, state=None):
+        super().__init__(address, FakeAmoCRMHandler)
+        self.faults = faults or FaultConfig()
+        self.state = state or FakeAmoCRMState()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{API_PREFIX.rstrip('/')}"
+
+
+def start_fake_server(host='127.0.0.1', port=0, faults=None):
+    # port=0 - свободный порт; сервер крутится в фоновом потоке, адрес для
+    # AMOCRM_BASE_URL - server.base_url
+    server = FakeAmoCRMServer((host, port), faults)
+    thread = threading.Thread(target=server.serve_forever, name='fake-amocrm', daemon=True)
+    thread.start()
+    return server
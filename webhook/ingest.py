@@ -0,0 +1,154 @@
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .coalesce import drop_superseded
+from .models import WebhookLog
+from .sharedstate import locked_state
+
+logger = logging.getLogger(__name__)
+
+
+def make_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+HEARTBEAT_INTERVAL = 5.0
+
+_heartbeats = {}
+
+
+def _workers_path():
+    return os.path.join(settings.AMOCRM_STATE_DIR, 'workers.json')
+
+
+def worker_heartbeat(worker_id, force=False):
+    # Отметка "воркер жив" не чаще HEARTBEAT_INTERVAL: файл общий для всех
+    # процессов и пишется под flock
+    now = time.time()
+    if not force and now - _heartbeats.get(worker_id, 0) < HEARTBEAT_INTERVAL:
+        return
+    _heartbeats[worker_id] = now
+
+    cutoff = now - settings.WEBHOOK_WORKER_HEARTBEAT_TIMEOUT
+    with locked_state(_workers_path()) as state:
+        for stale in [key for key, seen_at in state.items() if seen_at < cutoff]:
+            del state[stale]
+        state[worker_id] = now
+
+
+def worker_stopped(worker_id):
+    _heartbeats.pop(worker_id, None)
+    with locked_state(_workers_path()) as state:
+        state.pop(worker_id, None)
+
+
+def live_workers():
+    cutoff = time.time() - settings.WEBHOOK_WORKER_HEARTBEAT_TIMEOUT
+    with locked_state(_workers_path()) as state:
+        return sorted(key for key, seen_at in state.items() if seen_at >= cutoff)
+
+
+# вебхуки заказа, ещё не дошедшие до amoCRM: в очереди, у воркера (в том
+# числе в пакете LeadBatcher) и ждущие повтора
+IN_FLIGHT_STATUSES = ['pending', 'processing', 'retry']
+
+
+def has_pending(order_id):
+    # индекс (order_id, created_at)
+    if not order_id:
+        return False
+    return WebhookLog.objects.filter(order_id=str(order_id)[:100], status__in=IN_FLIGHT_STATUSES).exists()
+
+
+def enqueue(raw_body, customer_info):
+    return WebhookLog.objects.create(
+        **WebhookLog.pack_body(raw_body), **WebhookLog.lookup_fields(customer_info), status='pending'
+    )
+
+
+def claim_pending(worker_id, batch_size):
+    ids = list(
+        WebhookLog.objects.filter(status='pending')
+        .order_by('created_at')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if not ids:
+        return []
+
+    # UPDATE ... WHERE status='pending' атомарен: строку, которую уже забрал
+    # другой воркер, мы просто не обновим и не увидим в выборке ниже.
+    WebhookLog.objects.filter(id__in=ids, status='pending').update(
+        status='processing',
+        claimed_by=worker_id,
+        claimed_at=timezone.now(),
+    )
+
+    return list(
+        WebhookLog.objects.filter(id__in=ids, status='processing', claimed_by=worker_id)
+        .order_by('created_at')
+    )
+
+
+def release_claims(worker_id, ids):
+    if not ids:
+        return 0
+    return WebhookLog.objects.filter(id__in=ids, status='processing', claimed_by=worker_id).update(
+        status='pending',
+        claimed_by=None,
+        claimed_at=None,
+    )
+
+
+def release_stale_claims(timeout_seconds):
+    cutoff = timezone.now() - timedelta(seconds=timeout_seconds)
+    released = WebhookLog.objects.filter(status='processing', claimed_at__lt=cutoff).update(
+        status='pending',
+        claimed_by=None,
+        claimed_at=None,
+    )
+    if released:
+        logger.warning("Возвращено в очередь зависших вебхуков: %s", released)
+    return released
+
+
+def requeue_due_retries():
+    # индекс (status, next_attempt_at): дошедшие до срока повторы находятся
+    # без просмотра всей таблицы. Повтор, который устарел - по заказу уже
+    # применён вебхук новее, - в очередь не возвращается.
+    due = list(WebhookLog.objects.filter(status='retry', next_attempt_at__lte=timezone.now()))
+    if not due:
+        return 0
+    ids = [webhook_log.id for webhook_log in drop_superseded(due)]
+    requeued = WebhookLog.objects.filter(id__in=ids, status='retry').update(
+        status='pending',
+        claimed_by=None,
+        claimed_at=None,
+    )
+    if requeued:
+        logger.info("Возвращено в очередь вебхуков на повтор: %s", requeued)
+    return requeued
+
+
+REQUEUE_STATUSES = ['error', 'retry', 'dead']
+
+
+def requeue(ids, chunk_size=None, statuses=REQUEUE_STATUSES):
+    # Ручной повтор из админки: UPDATE пачками по chunk_size id, а не save()
+    # на строку; дальше строки забирает process_webhooks своими пакетами
+    chunk_size = chunk_size or settings.WEBHOOK_REQUEUE_CHUNK_SIZE
+    ids = list(ids)
+    requeued = 0
+    for start in range(0, len(ids), chunk_size):
+        requeued += WebhookLog.objects.filter(id__in=ids[start:start + chunk_size], status__in=statuses).update(
+            status='pending',
+            attempts=0,
+            next_attempt_at=None,
+            claimed_by=None,
+            claimed_at=None,
+        )
+    return requeued
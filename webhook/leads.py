@@ -0,0 +1,42 @@
+import logging
+from .models import LeadIndex
+
+logger = logging.getLogger(__name__)
+
+
+def lookup_lead_id(order_id):
+    if not order_id:
+        return None
+    return LeadIndex.objects.filter(order_id=str(order_id)).values_list('amocrm_lead_id', flat=True).first()
+
+
+async def alookup_lead_id(order_id):
+    if not order_id:
+        return None
+    return await LeadIndex.objects.filter(order_id=str(order_id)).values_list('amocrm_lead_id', flat=True).afirst()
+
+
+def remember_lead(order_id, lead_id, contact_id=None):
+    if not order_id or not lead_id:
+        return
+
+    LeadIndex.objects.update_or_create(
+        order_id=str(order_id),
+        defaults={'amocrm_lead_id': lead_id, 'amocrm_contact_id': contact_id},
+    )
+
+
+async def aremember_lead(order_id, lead_id, contact_id=None):
+    if not order_id or not lead_id:
+        return
+
+    await LeadIndex.objects.aupdate_or_create(
+        order_id=str(order_id),
+        defaults={'amocrm_lead_id': lead_id, 'amocrm_contact_id': contact_id},
+    )
+
+
+def forget_lead(order_id):
+    deleted, _ = LeadIndex.objects.filter(order_id=str(order_id)).delete()
+    if deleted:
+        logger.info("Заказ %s удалён из индекса сделок", order_id)
@@ -0,0 +1,211 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# атрибуты LogRecord; всё остальное пришло через extra= и попадает в JSON
+_RECORD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'suppressed', 'dropped'}
+
+
+class JsonFormatter(logging.Formatter):
+    # Одна компактная JSON-строка на запись. Вызывается в потоке listener,
+    # поэтому %-подстановка аргументов и traceback запросу ничего не стоят.
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+        }
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRS:
+                data[name] = value
+        if getattr(record, 'suppressed', 0):
+            data['suppressed'] = record.suppressed
+        if getattr(record, 'dropped', 0):
+            data['dropped'] = record.dropped
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # INFO с одинаковым шаблоном сообщения: первые burst записей за window
+    # секунд проходят, дальше - каждая every-я. Пропущенные не теряются
+    # бесследно: их число уходит в поле suppressed следующей записи.
+    # WARNING и выше проходят всегда.
+    def __init__(self, burst=20, window=60, every=100):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.every = every
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno != logging.INFO:
+            return True
+
+        # шаблон, а не готовая строка: "Found existing contact: %s" - одна
+        # и та же запись для любых контактов
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                if len(self._windows) > 10000:
+                    self._windows.clear()
+                self._windows[key] = [now, 1, 0]
+                record.suppressed = suppressed
+                return True
+
+            state[1] += 1
+            if state[1] <= self.burst or state[1] % self.every == 0:
+                record.suppressed, state[2] = state[2], 0
+                return True
+            state[2] += 1
+            return False
+
+
+class _SharedRolloverMixin:
+    # Файл пишут все воркеры gunicorn. Ротацию делает тот, кто первым взял
+    # flock; остальные видят, что файл под их дескриптором уже переименован,
+    # и просто открывают новый.
+    def _lock_path(self):
+        return self.baseFilename + '.lock'
+
+    def _stream_rotated(self):
+        if self.stream is None:
+            return False
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _reopen(self):
+        if self.stream:
+            self.stream.close()
+        self.stream = self._open()
+
+    def shouldRollover(self, record):
+        if self._stream_rotated():
+            self._reopen()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if fcntl is None:
+            return super().doRollover()
+
+        with open(self._lock_path(), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._stream_rotated():
+                self._reopen()
+                self._after_foreign_rollover()
+                return
+            super().doRollover()
+
+    def _after_foreign_rollover(self):
+        pass
+
+
+class SharedRotatingFileHandler(_SharedRolloverMixin, RotatingFileHandler):
+    pass
+
+
+class SharedTimedRotatingFileHandler(_SharedRolloverMixin, TimedRotatingFileHandler):
+    def _after_foreign_rollover(self):
+        self.rolloverAt = self.computeRollover(int(time.time()))
+
+
+class QueueFileHandler(logging.Handler):
+    # emit() только кладёт запись в очередь, в файл пишет фоновый поток.
+    # Если диск не успевает и очередь полна, запись отбрасывается: задержка
+    # диска не должна попадать в время ответа на вебхук.
+    def __init__(self, filename, max_bytes=0, backup_count=0, when=None, interval=1, queue_size=10000, encoding='utf-8'):
+        super().__init__()
+        self.queue_size = queue_size
+        if when:
+            self.target = SharedTimedRotatingFileHandler(
+                filename, when=when, interval=interval, backupCount=backup_count, encoding=encoding, delay=True
+            )
+        else:
+            self.target = SharedRotatingFileHandler(
+                filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding, delay=True
+            )
+        self.target.setFormatter(JsonFormatter())
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def _ensure_listener(self):
+        # поток не переживает fork: воркер gunicorn запускает свой
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._thread = threading.Thread(target=self._listen, name='log-listener', daemon=True)
+            self._thread.start()
+            self._pid = pid
+
+    def emit(self, record):
+        self._ensure_listener()
+        # exc_info форматируем сразу: traceback держит кадры стека живыми,
+        # пока запись стоит в очереди
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _listen(self):
+        q = self._queue
+        while True:
+            record = q.get()
+            if record is None:
+                break
+            if self.dropped:
+                record.dropped, self.dropped = self.dropped, 0
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=5)
+            except queue.Full:
+                pass
+            self._thread.join(timeout=5)
+        self._thread = None
+        self._pid = None
+        self.target.close()
+        super().close()
@@ -0,0 +1,58 @@
+import json
+import logging
+import signal
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from webhook.archive import archive_cutoff, archive_webhooks, find_archived
+
+logger = logging.getLogger('webhook.archive')
+
+
+class Command(BaseCommand):
+    help = 'Переносит старые WebhookLog в сжатые JSONL-сегменты и удаляет их из БД'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.WEBHOOK_ARCHIVE_AFTER_DAYS,
+                            help='Архивировать вебхуки старше стольких дней')
+        parser.add_argument('--dead-days', type=int, default=settings.WEBHOOK_ARCHIVE_DEAD_AFTER_DAYS,
+                            help='Архивировать dead-вебхуки старше стольких дней')
+        parser.add_argument('--dir', default=settings.WEBHOOK_ARCHIVE_DIR)
+        parser.add_argument('--segment-size', type=int, default=settings.WEBHOOK_ARCHIVE_SEGMENT_SIZE)
+        parser.add_argument('--chunk-size', type=int, default=settings.WEBHOOK_ARCHIVE_CHUNK_SIZE,
+                            help='Строк на одну транзакцию удаления')
+        parser.add_argument('--loop', action='store_true', help='Работать постоянно, запуская архивацию по расписанию')
+        parser.add_argument('--interval', type=int, default=settings.WEBHOOK_ARCHIVE_INTERVAL)
+        parser.add_argument('--find-order', help='Найти в архиве вебхуки заказа')
+        parser.add_argument('--find-date', help='Найти в архиве вебхуки за дату YYYY-MM-DD')
+
+    def handle(self, *args, **options):
+        if options['find_order'] or options['find_date']:
+            for record in find_archived(options['find_order'], options['find_date'], options['dir']):
+                self.stdout.write(json.dumps(record, ensure_ascii=False))
+            return
+
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        while not self.stopping:
+            segments = archive_webhooks(
+                cutoff=archive_cutoff(options['days']),
+                dead_cutoff=archive_cutoff(options['dead_days']),
+                archive_dir=options['dir'],
+                segment_size=options['segment_size'],
+                chunk_size=options['chunk_size'],
+            )
+            logger.info("Архивация завершена, новых сегментов: %s", len(segments))
+
+            if not options['loop']:
+                break
+
+            deadline = time.monotonic() + options['interval']
+            while not self.stopping and time.monotonic() < deadline:
+                time.sleep(1)
+
+    def _request_stop(self, signum, frame):
+        logger.info("Получен сигнал %s, архивация остановится после текущего сегмента", signum)
+        self.stopping = True
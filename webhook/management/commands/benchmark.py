@@ -0,0 +1,47 @@
+import json
+import platform
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from webhook import benchmarks, fastjson
+
+STAGES = {
+    'json_decode': benchmarks.run_json_decode,
+    'verify': benchmarks.run_verify,
+    'extract': benchmarks.run_extract,
+    'event_type': benchmarks.run_event_type,
+    'taxonomy': benchmarks.run_taxonomy,
+    'description': benchmarks.run_description,
+    'lead_payload': benchmarks.run_lead_payload,
+    'timestamp': benchmarks.run_timestamp,
+    'end_to_end': benchmarks.run_end_to_end,
+}
+
+
+class Command(BaseCommand):
+    help = 'Микробенчмарки этапов обработки вебхука'
+
+    def add_arguments(self, parser):
+        parser.add_argument('stages', nargs='*', help=f"Этапы: {', '.join(STAGES)} (по умолчанию все)")
+        parser.add_argument('--output', help='Записать результаты в JSON-файл (для сравнения между сборками)')
+
+    def handle(self, *args, **options):
+        stages = options['stages'] or list(STAGES)
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise CommandError(f"Неизвестные этапы: {', '.join(sorted(unknown))}")
+
+        results = {
+            'meta': {
+                'started_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'json_backend': 'orjson' if fastjson.orjson is not None else 'json',
+                'payload_sizes': {size: tickets for size, (tickets, _) in benchmarks.PAYLOAD_SIZES.items()},
+            },
+        }
+        results.update({stage: STAGES[stage]() for stage in stages})
+
+        report = json.dumps(results, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(report)
+        self.stdout.write(report)
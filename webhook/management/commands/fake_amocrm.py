@@ -0,0 +1,38 @@
+import logging
+from django.core.management.base import BaseCommand
+from webhook.fakeamocrm import FakeAmoCRMServer, FaultConfig
+
+logger = logging.getLogger('webhook.fakeamocrm')
+
+
+class Command(BaseCommand):
+    help = 'Локальный заменитель amoCRM API v4 с задержками и ошибками (для AMOCRM_BASE_URL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', help='fixed:50 | uniform:20:200 | lognormal:80:0.5 (мс)')
+        parser.add_argument('--error-429', type=float, default=0.0, help='Доля ответов 429')
+        parser.add_argument('--error-5xx', type=float, default=0.0, help='Доля ответов 500/502/503')
+        parser.add_argument('--rate-limit', type=float, help='Запросов в секунду, сверх - 429 (у amoCRM 7)')
+        parser.add_argument('--retry-after', type=int, default=1)
+
+    def handle(self, *args, **options):
+        faults = FaultConfig(
+            latency=options['latency'],
+            error_429=options['error_429'],
+            error_5xx=options['error_5xx'],
+            rate_limit=options['rate_limit'],
+            retry_after=options['retry_after'],
+        )
+        server = FakeAmoCRMServer((options['host'], options['port']), faults)
+        self.stdout.write(f"Fake amoCRM: AMOCRM_BASE_URL={server.base_url}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            state = server.state
+            logger.info("Fake amoCRM остановлен: запросов %s, контактов %s, сделок %s", state.requests, len(state.contacts), len(state.leads))
@@ -0,0 +1,102 @@
+import logging
+import signal
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from webhook.amocrm_client import AmoCRMClient
+from webhook.batching import LeadBatcher
+from webhook.breaker import CircuitOpenError, OPEN, HALF_OPEN, get_breaker
+from webhook.coalesce import coalesce_batch
+from webhook.ingest import (
+    make_worker_id, claim_pending, release_claims, release_stale_claims, requeue_due_retries,
+    worker_heartbeat, worker_stopped,
+)
+from webhook.processing import process_webhook_log
+
+logger = logging.getLogger('webhook.worker')
+
+
+class Command(BaseCommand):
+    help = 'Фоновый обработчик вебхуков Radario из очереди WebhookLog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.WEBHOOK_WORKER_BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=settings.WEBHOOK_WORKER_POLL_INTERVAL)
+        parser.add_argument('--stale-timeout', type=int, default=settings.WEBHOOK_WORKER_STALE_TIMEOUT)
+        parser.add_argument('--lead-batch-size', type=int, default=settings.WEBHOOK_LEAD_BATCH_SIZE)
+        parser.add_argument('--lead-batch-window', type=float, default=settings.WEBHOOK_LEAD_BATCH_WINDOW)
+        parser.add_argument('--once', action='store_true', help='Обработать одну пачку и выйти')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        worker_id = make_worker_id()
+        breaker = get_breaker()
+        amocrm = AmoCRMClient()
+        batcher = LeadBatcher(amocrm, options['lead_batch_size'], options['lead_batch_window'])
+        logger.info("Воркер %s запущен", worker_id)
+
+        worker_heartbeat(worker_id, force=True)
+        while not self.stopping:
+            worker_heartbeat(worker_id)
+            release_stale_claims(options['stale_timeout'])
+            requeue_due_retries()
+
+            # amoCRM недоступен: очередь копится и не трогается; в half-open
+            # берём по одному вебхуку - он же пробный запрос
+            breaker_state = breaker.state
+            if breaker_state == OPEN:
+                # накопленный пакет сразу упрётся в breaker и вернётся в очередь
+                batcher.flush()
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+            batch_size = 1 if breaker_state == HALF_OPEN else options['batch_size']
+
+            batch = claim_pending(worker_id, batch_size)
+            if batch:
+                self._process_batch(worker_id, coalesce_batch(batch), amocrm, batcher)
+
+            if options['once']:
+                break
+
+            if batcher.is_due():
+                batcher.flush()
+            elif not batch:
+                time_left = batcher.time_left()
+                poll_interval = options['poll_interval']
+                time.sleep(poll_interval if time_left is None else min(poll_interval, time_left))
+
+        batcher.flush()
+        worker_stopped(worker_id)
+        logger.info("Воркер %s остановлен", worker_id)
+
+    def _process_batch(self, worker_id, batch, amocrm, batcher):
+        for index, webhook_log in enumerate(batch):
+            if self.stopping:
+                rest = [row.id for row in batch[index:]]
+                released = release_claims(worker_id, rest)
+                logger.info("Остановка: возвращено в очередь %s вебхуков", released)
+                return
+
+            worker_heartbeat(worker_id)
+            try:
+                process_webhook_log(webhook_log, amocrm, batcher)
+            except CircuitOpenError:
+                # вебхук уже в очереди, остальные тоже упрутся в breaker
+                released = release_claims(worker_id, [row.id for row in batch[index + 1:]])
+                logger.info("amoCRM недоступен, возвращено в очередь %s вебхуков", released)
+                return
+            except Exception:
+                # ошибка уже записана в WebhookLog, переходим к следующему
+                continue
+
+            if batcher.is_due():
+                batcher.flush()
+
+    def _request_stop(self, signum, frame):
+        logger.info("Получен сигнал %s, завершаю текущую пачку", signum)
+        self.stopping = True
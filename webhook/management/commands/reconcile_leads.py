@@ -0,0 +1,34 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from webhook.amocrm_client import AmoCRMClient
+from webhook.reconcile import PIPELINE_ID, Reconciler
+
+
+class Command(BaseCommand):
+    help = 'Сверяет последний вебхук каждого заказа со сделками воронки amoCRM'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Только заказы с вебхуками начиная с (ISO 8601)')
+        parser.add_argument('--pipeline', type=int, default=PIPELINE_ID)
+        parser.add_argument('--details', type=int, default=50, help='Сколько примеров каждого расхождения выводить')
+        parser.add_argument('--fix', action='store_true', help='Поправить сделки, индекс и переотправить пропавшие')
+        parser.add_argument('--output', help='Записать отчёт в JSON-файл')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f"Не удалось разобрать дату: {options['since']}")
+
+        reconciler = Reconciler(AmoCRMClient(), pipeline_id=options['pipeline'], details=options['details'])
+        result = reconciler.run(since)
+        if options['fix']:
+            result['fixed'] = reconciler.fix()
+        report = json.dumps(result, ensure_ascii=False, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(report)
+        self.stdout.write(report)
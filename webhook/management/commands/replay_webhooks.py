@@ -0,0 +1,77 @@
+import json
+from contextlib import nullcontext
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from webhook.replay import Replayer, load_jsonl, load_webhook_logs
+from webhook.sandbox import isolated_environment
+
+
+class Command(BaseCommand):
+    help = 'Прогоняет записанные вебхуки Radario через radario_webhook и меряет задержки по этапам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help='JSONL-файлы: capture, сегменты архива (.gz) или payload построчно')
+        parser.add_argument('--from-db', action='store_true', help='Взять вебхуки из WebhookLog')
+        parser.add_argument('--since', help='Для --from-db: с какого момента (ISO 8601)')
+        parser.add_argument('--until', help='Для --from-db: до какого момента (ISO 8601)')
+        parser.add_argument('--status', action='append', help='Для --from-db: только строки с этим статусом')
+        parser.add_argument('--limit', type=int)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--preserve-timing', action='store_true', help='Сохранить интервалы между вебхуками')
+        parser.add_argument('--speed', type=float, default=1.0, help='Во сколько раз сжать время при --preserve-timing')
+        parser.add_argument('--async', dest='use_async', action='store_true', help='Через radario_webhook_async')
+        parser.add_argument('--isolated', action='store_true',
+                            help='Прогон в одноразовой БД (для --from-db включено всегда)')
+        parser.add_argument('--output', help='Записать отчёт в JSON-файл')
+        parser.add_argument('--live', action='store_true',
+                            help='Разрешить прогон в настоящий amoCRM, когда AMOCRM_BASE_URL не задан')
+
+    def handle(self, *args, **options):
+        if options['from_db'] == bool(options['files']):
+            raise CommandError('Укажите либо JSONL-файлы, либо --from-db')
+        # Без AMOCRM_BASE_URL клиент ходит в рабочий amoCRM: повтор создал бы
+        # там сделки и контакты заново
+        if not settings.AMOCRM_BASE_URL and not options['live']:
+            raise CommandError('AMOCRM_BASE_URL не задан: прогон ушёл бы в рабочий amoCRM. '
+                               'Запустите fake_amocrm и укажите AMOCRM_BASE_URL или передайте --live')
+
+        if options['from_db']:
+            items = load_webhook_logs(
+                since=self._datetime(options['since']),
+                until=self._datetime(options['until']),
+                statuses=options['status'],
+                limit=options['limit'],
+            )
+        else:
+            items = load_jsonl(options['files'])
+            if options['limit']:
+                items = items[:options['limit']]
+
+        if not items:
+            raise CommandError('Нет вебхуков для воспроизведения')
+
+        replayer = Replayer(
+            concurrency=options['concurrency'],
+            preserve_timing=options['preserve_timing'],
+            speed=options['speed'],
+            use_async=options['use_async'],
+        )
+        # Вебхуки из WebhookLog уже есть в рабочей БД вместе с отпечатками:
+        # там они вернулись бы как duplicate и не дошли до обработки
+        isolated = options['isolated'] or options['from_db']
+        with isolated_environment() if isolated else nullcontext():
+            report = json.dumps(replayer.run(items), ensure_ascii=False, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(report)
+        self.stdout.write(report)
+
+    def _datetime(self, value):
+        if not value:
+            return None
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise CommandError(f"Не удалось разобрать дату: {value}")
+        return parsed
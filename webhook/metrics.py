@@ -0,0 +1,273 @@
+import asyncio
+import atexit
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from .sharedstate import locked_state
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# имя -> (тип, описание); метки задаются при записи
+METRICS = {
+    'webhook_request_duration_seconds': ('histogram', 'Время ответа на вебхук Radario от приёма до ответа'),
+    'webhook_results_total': ('counter', 'Результаты обработки вебхуков'),
+    'amocrm_request_duration_seconds': ('histogram', 'Время запроса к amoCRM без ожидания лимита'),
+    'amocrm_rate_limit_wait_seconds_total': ('counter', 'Сколько запросы к amoCRM ждали лимитер'),
+    'amocrm_responses_total': ('counter', 'Ответы amoCRM по кодам'),
+    'sqlite_write_duration_seconds': ('histogram', 'Время пишущих запросов к SQLite'),
+    'sqlite_locked_total': ('counter', 'Запись не дождалась блокировки SQLite'),
+}
+
+DEAD_FILE = 'metrics-dead.json'
+
+
+def _labels_key(labels):
+    return ','.join(f"{name}={value}" for name, value in sorted(labels.items()))
+
+
+def _parse_key(key):
+    if not key:
+        return {}
+    return dict(item.split('=', 1) for item in key.split(','))
+
+
+class Registry:
+    # Метрики процесса в памяти. Каждый воркер gunicorn раз в
+    # METRICS_FLUSH_INTERVAL сбрасывает их в свой файл, /metrics складывает
+    # файлы всех процессов.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self._flushed_at = 0.0
+        self._path = None
+        self._pid = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # счётчики по корзинам плюс +Inf, затем сумма
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            index = 0
+            while index < len(LATENCY_BUCKETS) and value > LATENCY_BUCKETS[index]:
+                index += 1
+            histogram[index] += 1
+            histogram[-1] += value
+        self.maybe_flush()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, key, value] for (name, key), value in self.counters.items()],
+                'histograms': [[name, key, list(values)] for (name, key), values in self.histograms.items()],
+            }
+
+    def _file_path(self):
+        # после fork у ребёнка свой файл и пустые метрики: цифры родителя
+        # остаются в файле родителя
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._pid is not None:
+                with self._lock:
+                    self.counters.clear()
+                    self.histograms.clear()
+            self._pid = pid
+            # время старта в имени: pid, доставшийся новому процессу, не
+            # затрёт файл умершего
+            self._path = os.path.join(settings.METRICS_DIR, f"metrics-{pid}-{int(time.time() * 1000)}.json")
+        return self._path
+
+    def maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self._flushed_at = time.monotonic()
+        if not self.counters and not self.histograms:
+            # manage.py migrate и прочие команды без метрик файлов не оставляют
+            return
+        try:
+            path = self._file_path()
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error("Не удалось сохранить метрики: %s", e)
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def track_webhook(view_name):
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            async def wrapper(request, *args, **kwargs):
+                started = time.monotonic()
+                try:
+                    return await view(request, *args, **kwargs)
+                finally:
+                    observe('webhook_request_duration_seconds', time.monotonic() - started, view=view_name)
+        else:
+            def wrapper(request, *args, **kwargs):
+                started = time.monotonic()
+                try:
+                    return view(request, *args, **kwargs)
+                finally:
+                    observe('webhook_request_duration_seconds', time.monotonic() - started, view=view_name)
+        return functools.wraps(view)(wrapper)
+    return decorator
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(total, snapshot):
+    for name, key, value in snapshot.get('counters', []):
+        counter_key = (name, key)
+        total['counters'][counter_key] = total['counters'].get(counter_key, 0) + value
+    for name, key, values in snapshot.get('histograms', []):
+        histogram_key = (name, key)
+        current = total['histograms'].get(histogram_key)
+        if current is None:
+            total['histograms'][histogram_key] = list(values)
+        else:
+            total['histograms'][histogram_key] = [a + b for a, b in zip(current, values)]
+
+
+def _to_snapshot(total):
+    return {
+        'counters': [[name, key, value] for (name, key), value in total['counters'].items()],
+        'histograms': [[name, key, values] for (name, key), values in total['histograms'].items()],
+    }
+
+
+def _read(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def collect():
+    # Складывает файлы всех процессов. Файлы умерших процессов вливаются в
+    # metrics-dead.json, иначе после перезапуска воркеров счётчики
+    # уменьшились бы, а файлы копились бы без конца.
+    registry.flush()
+    total = {'counters': {}, 'histograms': {}}
+
+    with locked_state(os.path.join(settings.METRICS_DIR, DEAD_FILE)) as dead:
+        dead_total = {'counters': {}, 'histograms': {}}
+        _merge(dead_total, dead)
+
+        compacted = []
+        for path in glob.glob(os.path.join(settings.METRICS_DIR, 'metrics-*-*.json')):
+            pid = int(os.path.basename(path).split('-')[1])
+            snapshot = _read(path)
+            if snapshot is None:
+                continue
+            if _pid_alive(pid):
+                _merge(total, snapshot)
+            else:
+                _merge(dead_total, snapshot)
+                compacted.append(path)
+
+        if compacted:
+            dead.update(_to_snapshot(dead_total))
+
+    # файл удаляется только после того, как его цифры записаны в dead
+    for path in compacted:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    _merge(total, _to_snapshot(dead_total))
+    return total
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + items + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def render(total, gauges=()):
+    # текстовый формат Prometheus 0.0.4
+    by_name = {}
+    for (name, key), value in total['counters'].items():
+        by_name.setdefault(name, []).append((key, value))
+    for (name, key), values in total['histograms'].items():
+        by_name.setdefault(name, []).append((key, values))
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        series = by_name.get(name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        for key, value in sorted(series):
+            labels = _parse_key(key)
+            if kind == 'counter':
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(round(value[-1], 6))}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    for name, help_text, samples in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,90 @@
+import base64
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from .fastjson import dumps
+
+logger = logging.getLogger(__name__)
+
+
+def capture_record(request):
+    record = {
+        'ts': time.time(),
+        'method': request.method,
+        'path': request.path,
+        'content_type': request.content_type,
+    }
+    try:
+        record['body'] = request.body.decode('utf-8')
+    except UnicodeDecodeError:
+        record['body_b64'] = base64.b64encode(request.body).decode('ascii')
+    return record
+
+
+class CaptureWriter:
+    # Свой файл на процесс: строки разных воркеров gunicorn не перемешиваются,
+    # а ротация не мешает соседям. Ротация как у RotatingFileHandler:
+    # capture-<pid>.jsonl -> .1 -> .2 ...
+    def __init__(self, directory, max_bytes, backups):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"capture-{os.getpid()}.jsonl")
+
+    def _open(self):
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.path, 'ab')
+            self._pid = os.getpid()
+        return self._file
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        path = self.path
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{path}.{index}"):
+                os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+        if self.backups:
+            os.replace(path, f"{path}.1")
+        else:
+            os.remove(path)
+
+    def write(self, record):
+        line = dumps(record) + b'\n'
+        with self._lock:
+            f = self._open()
+            if f.tell() and f.tell() + len(line) > self.max_bytes:
+                self._rotate()
+                f = self._open()
+            f.write(line)
+            f.flush()
+
+
+class WebhookCaptureMiddleware:
+    # Пишет сырые входящие вебхуки в JSONL для replay_webhooks; без
+    # WEBHOOK_CAPTURE_DIR Django исключает middleware из цепочки.
+    def __init__(self, get_response):
+        if not settings.WEBHOOK_CAPTURE_DIR:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.writer = CaptureWriter(
+            settings.WEBHOOK_CAPTURE_DIR, settings.WEBHOOK_CAPTURE_MAX_BYTES, settings.WEBHOOK_CAPTURE_BACKUPS
+        )
+
+    def __call__(self, request):
+        if request.method == 'POST' and request.path.startswith(settings.WEBHOOK_CAPTURE_PATH):
+            try:
+                self.writer.write(capture_record(request))
+            except OSError as e:
+                logger.error("Не удалось записать вебхук в capture-файл: %s", e)
+        return self.get_response(request)
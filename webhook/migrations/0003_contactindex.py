@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook', '0002_webhook_ingest_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.CharField(max_length=254, unique=True, verbose_name='Email')),
+                ('amocrm_contact_id', models.IntegerField(verbose_name='ID контакта в amoCRM')),
+                ('last_seen_at', models.DateTimeField(verbose_name='Последнее обращение')),
+            ],
+            options={
+                'verbose_name': 'Контакт amoCRM',
+                'verbose_name_plural': 'Индекс контактов amoCRM',
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook', '0003_contactindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeadIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.CharField(max_length=100, unique=True, verbose_name='Заказ Radario')),
+                ('amocrm_lead_id', models.IntegerField(verbose_name='ID сделки в amoCRM')),
+                ('amocrm_contact_id', models.IntegerField(blank=True, null=True, verbose_name='ID контакта в amoCRM')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Сделка amoCRM',
+                'verbose_name_plural': 'Индекс сделок amoCRM',
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook', '0004_leadindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('webhook_log', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='webhook.webhooklog')),
+            ],
+            options={
+                'verbose_name': 'Отпечаток вебхука',
+                'verbose_name_plural': 'Отпечатки вебхуков',
+            },
+        ),
+    ]
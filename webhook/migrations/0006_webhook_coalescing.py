@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook', '0005_webhookfingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhooklog',
+            name='superseded_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='superseded', to='webhook.webhooklog', verbose_name='Заменён вебхуком'),
+        ),
+        migrations.AlterField(
+            model_name='webhooklog',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В обработке'), ('processing', 'Обрабатывается'), ('success', 'Успешно'), ('error', 'Ошибка'), ('coalesced', 'Объединён с более поздним')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook', '0006_webhook_coalescing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhooklog',
+            name='raw_body',
+            field=models.BinaryField(blank=True, null=True, verbose_name='Тело запроса'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='raw_body_compressed',
+            field=models.BooleanField(default=False, verbose_name='Тело сжато'),
+        ),
+        migrations.AlterField(
+            model_name='webhooklog',
+            name='payload',
+            field=models.JSONField(blank=True, null=True, verbose_name='Данные вебхука'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook', '0007_webhook_raw_body'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhooklog',
+            name='amount',
+            field=models.FloatField(blank=True, null=True, verbose_name='Сумма'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='email',
+            field=models.CharField(blank=True, db_index=True, max_length=254, null=True, verbose_name='Email'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='event_title',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Мероприятие'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='order_id',
+            field=models.CharField(blank=True, max_length=100, null=True, verbose_name='Заказ Radario'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='radario_status',
+            field=models.CharField(blank=True, max_length=50, null=True, verbose_name='Статус в Radario'),
+        ),
+        migrations.AddIndex(
+            model_name='webhooklog',
+            index=models.Index(fields=['status', 'created_at'], name='webhooklog_status_created'),
+        ),
+        migrations.AddIndex(
+            model_name='webhooklog',
+            index=models.Index(fields=['order_id', 'created_at'], name='webhooklog_order_created'),
+        ),
+    ]
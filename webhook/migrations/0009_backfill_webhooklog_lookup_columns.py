@@ -0,0 +1,92 @@
+import json
+import zlib
+from django.db import migrations, transaction
+
+CHUNK_SIZE = 500
+LOOKUP_FIELDS = ['order_id', 'email', 'event_title', 'radario_status', 'amount']
+
+
+def _payload(row):
+    if row.payload is not None:
+        return row.payload
+    if row.raw_body is None:
+        return None
+
+    raw_body = bytes(row.raw_body)
+    try:
+        return json.loads(zlib.decompress(raw_body) if row.raw_body_compressed else raw_body)
+    except (ValueError, zlib.error):
+        return None
+
+
+# Извлечение полей заказа - копия правил Order и WebhookLog.lookup_fields на
+# момент миграции: миграция не должна меняться вместе с кодом приложения.
+# Radario присылает поля то в PascalCase, то в camelCase; берётся первое
+# непустое значение.
+def _first(model, *paths):
+    for path in paths:
+        value = model
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value:
+            return value
+    return None
+
+
+def _text(value, max_length):
+    return str(value)[:max_length] if value not in (None, '') else None
+
+
+def _amount(value):
+    try:
+        return float(value) if value else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _lookup_fields(payload):
+    model = payload.get('model')
+    if not isinstance(model, dict):
+        model = {}
+
+    return {
+        'order_id': _text(_first(model, ('Id',), ('id',)), 100),
+        'email': _text(str(_first(model, ('Email',), ('email',)) or '').strip().lower(), 254),
+        'event_title': _text(_first(model, ('Event', 'Title'), ('event', 'title')), 255),
+        'radario_status': _text(_first(model, ('Status',), ('status',)), 50),
+        'amount': _amount(_first(model, ('Amount',), ('amount',))),
+    }
+
+
+def backfill(apps, schema_editor):
+    # У исторической модели нет методов WebhookLog, поэтому payload и поля
+    # собираются здесь; каждая пачка - отдельная короткая транзакция.
+    WebhookLog = apps.get_model('webhook', 'WebhookLog')
+    last_id = 0
+
+    while True:
+        rows = list(WebhookLog.objects.filter(id__gt=last_id, order_id__isnull=True).order_by('id')[:CHUNK_SIZE])
+        if not rows:
+            break
+
+        for row in rows:
+            payload = _payload(row)
+            if isinstance(payload, dict):
+                for name, value in _lookup_fields(payload).items():
+                    setattr(row, name, value)
+
+        with transaction.atomic():
+            WebhookLog.objects.bulk_update(rows, LOOKUP_FIELDS)
+        last_id = rows[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('webhook', '0008_webhooklog_lookup_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook', '0009_backfill_webhooklog_lookup_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhooklog',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='Неудачных попыток'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='last_error_class',
+            field=models.CharField(blank=True, max_length=100, null=True, verbose_name='Тип ошибки'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Следующая попытка'),
+        ),
+        migrations.AlterField(
+            model_name='webhooklog',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В обработке'), ('processing', 'Обрабатывается'), ('success', 'Успешно'), ('error', 'Ошибка'), ('coalesced', 'Объединён с более поздним'), ('retry', 'Ожидает повтора'), ('dead', 'Попытки исчерпаны')], default='pending', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='webhooklog',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='webhooklog_status_next_try'),
+        ),
+    ]
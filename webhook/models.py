@@ -1,25 +1,137 @@
+import zlib
+from django.conf import settings
 from django.db import models
+from .fastjson import loads
 
 
 class WebhookLog(models.Model):
     STATUS_CHOICES = [
         ('pending', 'В обработке'),
+        ('processing', 'Обрабатывается'),
         ('success', 'Успешно'),
         ('error', 'Ошибка'),
+        ('coalesced', 'Объединён с более поздним'),
+        ('retry', 'Ожидает повтора'),
+        ('dead', 'Попытки исчерпаны'),
     ]
 
-    payload = models.JSONField(verbose_name='Данные вебхука')
+    # Старые строки хранят разобранный payload, новые - исходное тело
+    # запроса как есть (крупное - сжатое zlib); разбирается при обращении.
+    payload = models.JSONField(blank=True, null=True, verbose_name='Данные вебхука')
+    raw_body = models.BinaryField(blank=True, null=True, verbose_name='Тело запроса')
+    raw_body_compressed = models.BooleanField(default=False, verbose_name='Тело сжато')
+    # Копии полей заказа из payload для фильтров и поиска в админке:
+    # заполняются при записи, чтобы не разбирать JSON каждой строки
+    order_id = models.CharField(max_length=100, blank=True, null=True, verbose_name='Заказ Radario')
+    email = models.CharField(max_length=254, blank=True, null=True, db_index=True, verbose_name='Email')
+    event_title = models.CharField(max_length=255, blank=True, null=True, verbose_name='Мероприятие')
+    radario_status = models.CharField(max_length=50, blank=True, null=True, verbose_name='Статус в Radario')
+    amount = models.FloatField(blank=True, null=True, verbose_name='Сумма')
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     error_message = models.TextField(blank=True, null=True)
+    # Повторы после временных ошибок amoCRM: process_webhooks возвращает
+    # строку в очередь, когда подходит next_attempt_at
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Неудачных попыток')
+    next_attempt_at = models.DateTimeField(blank=True, null=True, verbose_name='Следующая попытка')
+    last_error_class = models.CharField(max_length=100, blank=True, null=True, verbose_name='Тип ошибки')
     amocrm_contact_id = models.IntegerField(blank=True, null=True)
     amocrm_lead_id = models.IntegerField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     processed_at = models.DateTimeField(blank=True, null=True)
+    claimed_by = models.CharField(max_length=100, blank=True, null=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    superseded_by = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, blank=True, null=True, related_name='superseded',
+        verbose_name='Заменён вебхуком'
+    )
 
     class Meta:
         verbose_name = 'Лог вебхука'
         verbose_name_plural = 'Логи вебхуков'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='webhooklog_status_created'),
+            models.Index(fields=['order_id', 'created_at'], name='webhooklog_order_created'),
+            models.Index(fields=['status', 'next_attempt_at'], name='webhooklog_status_next_try'),
+        ]
 
     def __str__(self):
-        return f"Webhook {self.id} - {self.status}"
\ No newline at end of file
+        return f"Webhook {self.id} - {self.status}"
+
+    @staticmethod
+    def lookup_fields(customer_info):
+        def text(value, max_length):
+            return str(value)[:max_length] if value not in (None, '') else None
+
+        return {
+            'order_id': text(customer_info.get('order_id'), 100),
+            'email': text(str(customer_info.get('email') or '').strip().lower(), 254),
+            'event_title': text(customer_info.get('event_title'), 255),
+            'radario_status': text(customer_info.get('status'), 50),
+            'amount': customer_info.get('amount'),
+        }
+
+    @staticmethod
+    def pack_body(raw_body):
+        compressed = settings.WEBHOOK_COMPRESS_BODY and len(raw_body) >= settings.WEBHOOK_COMPRESS_MIN_SIZE
+        return {
+            'raw_body': zlib.compress(raw_body) if compressed else raw_body,
+            'raw_body_compressed': compressed,
+        }
+
+    def get_raw_body(self):
+        if self.raw_body is None:
+            return None
+        raw_body = bytes(self.raw_body)
+        return zlib.decompress(raw_body) if self.raw_body_compressed else raw_body
+
+    def get_payload(self):
+        if self.payload is not None:
+            return self.payload
+
+        # кэш в отдельном атрибуте: save() не должен сериализовать payload
+        # обратно в JSONField
+        parsed = self.__dict__.get('_parsed_payload')
+        if parsed is None and self.raw_body is not None:
+            parsed = self._parsed_payload = loads(self.get_raw_body())
+        return parsed
+
+
+class ContactIndex(models.Model):
+    email = models.CharField(max_length=254, unique=True, verbose_name='Email')
+    amocrm_contact_id = models.IntegerField(verbose_name='ID контакта в amoCRM')
+    last_seen_at = models.DateTimeField(verbose_name='Последнее обращение')
+
+    class Meta:
+        verbose_name = 'Контакт amoCRM'
+        verbose_name_plural = 'Индекс контактов amoCRM'
+
+    def __str__(self):
+        return f"{self.email} -> {self.amocrm_contact_id}"
+
+
+class LeadIndex(models.Model):
+    order_id = models.CharField(max_length=100, unique=True, verbose_name='Заказ Radario')
+    amocrm_lead_id = models.IntegerField(verbose_name='ID сделки в amoCRM')
+    amocrm_contact_id = models.IntegerField(blank=True, null=True, verbose_name='ID контакта в amoCRM')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Сделка amoCRM'
+        verbose_name_plural = 'Индекс сделок amoCRM'
+
+    def __str__(self):
+        return f"{self.order_id} -> {self.amocrm_lead_id}"
+
+
+class WebhookFingerprint(models.Model):
+    fingerprint = models.CharField(max_length=64, unique=True)
+    webhook_log = models.ForeignKey(WebhookLog, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = 'Отпечаток вебхука'
+        verbose_name_plural = 'Отпечатки вебхуков'
+
+    def __str__(self):
+        return self.fingerprint
@@ -0,0 +1,221 @@
+import json
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CUSTOMER_NAME = "Клиент Radario"
+
+# Схема заказа Radario: имя поля -> (пути в model, значение по умолчанию
+# или его фабрика, преобразование). Radario присылает одни и те же поля то в PascalCase, то
+# в camelCase, поэтому у каждого поля два пути; берётся первое непустое.
+ORDER_SCHEMA = {
+    'order_id': ((('Id',), ('id',)), None, None),
+    'email': ((('Email',), ('email',)), '', None),
+    'phone': ((('User', 'Phone'), ('user', 'phone')), '', None),
+    'status': ((('Status',), ('status',)), None, None),
+    'payment_system_status': ((('PaymentSystemStatus',), ('paymentSystemStatus',)), None, None),
+    'payment_system_status_description': ((('PaymentSystemStatusDescription',), ('paymentSystemStatusDescription',)), '', None),
+    'amount': ((('Amount',), ('amount',)), 0.0, 'float'),
+    'host_profit': ((('HostProfit',), ('hostProfit',)), 0.0, 'float'),
+    'creation_date': ((('CreationDate',), ('creationDate',)), '', None),
+    'payment_date': ((('PaymentDate',), ('paymentDate',)), '', None),
+    'update_date': ((('UpdateDate',), ('updateDate',)), '', None),
+    'event_title': ((('Event', 'Title'), ('event', 'title')), '', None),
+    'event_date': ((('Event', 'BeginDate'), ('event', 'beginDate')), '', None),
+    'tickets': ((('Tickets',), ('tickets',)), list, None),
+    'refund_details': ((('RefundDetails',), ('refundDetails',)), dict, None),
+    'payment_type': ((('PaymentType',), ('paymentType',)), '', None),
+    'promocode': ((('Promocode',), ('promocode',)), '', None),
+    'distribution_type': ((('DistributionType',), ('distributionType',)), '', None),
+    'currency': ((('Currency',), ('currency',)), 'RUB', None),
+    'utm_data': ((('UtmData',), ('utmData',)), dict, None),
+    'custom_data': ((('CustomData',), ('customData',)), '', None),
+}
+
+# Поля, которые нужны при каждой синхронизации; остальные вычисляются
+# при первом обращении.
+EAGER_FIELDS = (
+    'order_id', 'email', 'phone', 'status', 'payment_system_status', 'amount',
+    'payment_date', 'update_date', 'event_title', 'event_date', 'tickets',
+)
+
+DERIVED_FIELDS = ('name', 'tickets_count', 'refund_date', 'source')
+
+# Значения на случай, если поле не удалось разобрать
+DERIVED_DEFAULTS = {'name': DEFAULT_CUSTOMER_NAME, 'tickets_count': 0, 'refund_date': None, 'source': 'Radario'}
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        logger.warning("Не удалось преобразовать сумму заказа: %r", value)
+        return 0.0
+
+
+def _get_path(model, path):
+    value = model
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def _compile_field(paths, default, convert):
+    # Извлечение одного поля: первое непустое значение по путям схемы,
+    # иначе значение по умолчанию. Плоские поля (Email/email) - самые
+    # частые, для них отдельная функция без обхода путей.
+    convert = _to_float if convert == 'float' else None
+    factory = default if callable(default) else None
+
+    if all(len(path) == 1 for path in paths):
+        keys = tuple(path[0] for path in paths)
+
+        def extract(model):
+            for key in keys:
+                value = model.get(key)
+                if value:
+                    return convert(value) if convert else value
+            return factory() if factory else default
+    else:
+        def extract(model):
+            for path in paths:
+                value = _get_path(model, path)
+                if value:
+                    return convert(value) if convert else value
+            return factory() if factory else default
+
+    return extract
+
+
+_EXTRACTORS = {name: _compile_field(*spec) for name, spec in ORDER_SCHEMA.items()}
+FIELD_NAMES = tuple(ORDER_SCHEMA) + DERIVED_FIELDS
+_FIELD_SET = frozenset(FIELD_NAMES)
+_EAGER_EXTRACTORS = tuple((name, _EXTRACTORS[name]) for name in EAGER_FIELDS)
+
+
+def _first_of(data, *keys):
+    for key in keys:
+        if data.get(key):
+            return data[key]
+    return None
+
+
+def _full_name(data, last_key, first_key):
+    if data.get(first_key) and data.get(last_key):
+        return f"{data[last_key]} {data[first_key]}"
+    return None
+
+
+def customer_name(model, tickets, email):
+    if tickets and isinstance(tickets[0], dict):
+        ticket = tickets[0]
+        name = (_first_of(ticket, 'OwnerName', 'participantName')
+                or _full_name(ticket, 'lastName', 'firstName')
+                or _full_name(ticket, 'last_name', 'first_name'))
+        if name:
+            return name
+
+    user = model.get('User') or model.get('user') or {}
+    if isinstance(user, dict):
+        name = (_first_of(user, 'Name')
+                or _full_name(user, 'LastName', 'FirstName')
+                or _full_name(user, 'lastName', 'firstName')
+                or _full_name(user, 'last_name', 'first_name'))
+        if name:
+            return name
+
+    custom_data = model.get('CustomData') or model.get('customData', '')
+    if custom_data and isinstance(custom_data, str):
+        try:
+            custom_json = json.loads(custom_data)
+        except ValueError:
+            custom_json = None
+        if isinstance(custom_json, dict):
+            name = _first_of(custom_json, 'name', 'fio', 'full_name')
+            if name:
+                return name
+
+    if email:
+        return email.split('@')[0].capitalize()
+
+    return DEFAULT_CUSTOMER_NAME
+
+
+class Order:
+    # Поддерживает .get() и [] как прежний словарь customer_info, поэтому
+    # AmoCRMClient и processing работают с ним без изменений.
+    __slots__ = ('_model',) + FIELD_NAMES
+
+    def __init__(self, model):
+        self._model = model
+        try:
+            for name, extract in _EAGER_EXTRACTORS:
+                setattr(self, name, extract(model))
+        except Exception:
+            # медленный путь: каждое поле отдельно, битые - по умолчанию
+            for name in EAGER_FIELDS:
+                setattr(self, name, self._extract(name))
+
+    @classmethod
+    def from_payload(cls, webhook_data):
+        model = webhook_data.get('model') if isinstance(webhook_data, dict) else None
+        return cls(model if isinstance(model, dict) else {})
+
+    def __getattr__(self, name):
+        # вызывается только для ещё не заполненных слотов
+        if name not in _FIELD_SET:
+            raise AttributeError(name)
+        value = self._extract(name)
+        setattr(self, name, value)
+        return value
+
+    def _extract(self, name):
+        try:
+            if name in _EXTRACTORS:
+                return _EXTRACTORS[name](self._model)
+            if name == 'name':
+                return customer_name(self._model, self.tickets, self.email)
+            if name == 'tickets_count':
+                return len(self.tickets)
+            if name == 'refund_date':
+                return self._refund_date()
+            return 'Radario'
+        except Exception as e:
+            # битое поле не должно ронять весь заказ: как и раньше, вместо
+            # него - значение по умолчанию
+            logger.error("Error extracting customer info field %s: %s", name, e)
+            if name in DERIVED_DEFAULTS:
+                return DERIVED_DEFAULTS[name]
+            default = ORDER_SCHEMA[name][1]
+            return default() if callable(default) else default
+
+    def _refund_date(self):
+        refund_details = self.refund_details
+        refund_date = refund_details.get('RefundDate') if isinstance(refund_details, dict) else None
+
+        if (self.status == 'Refunded' or self.payment_system_status == 'Refund') and not refund_date:
+            refund_date = self.update_date or datetime.now().isoformat() + 'Z'
+        return refund_date
+
+    def __getitem__(self, key):
+        if key not in _FIELD_SET:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in _FIELD_SET
+
+    def get(self, key, default=None):
+        if key not in _FIELD_SET:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return FIELD_NAMES
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in FIELD_NAMES}
+
+    def __repr__(self):
+        return f"<Order {self.order_id} {self.status}/{self.payment_system_status}>"
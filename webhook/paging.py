@@ -0,0 +1,167 @@
+import asyncio
+import queue
+import threading
+from urllib.parse import urlencode
+
+MAX_PAGE_SIZE = 250
+
+_PAGE = 'page'
+_DONE = 'done'
+_ERROR = 'error'
+
+
+def _filter_params(name, value):
+    # {'pipeline_id': 1} -> filter[pipeline_id]=1, список -> filter[id][]=...,
+    # словарь -> filter[updated_at][from]=...
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _filter_params(f"{name}[{key}]", item)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            yield f"{name}[]", item
+    else:
+        yield name, value
+
+
+def collection_endpoint(collection, page, limit, filters=None, with_=None):
+    # Сортировка по id: новые записи добавляются в конец выдачи, и курсор
+    # (страница + последний id) остаётся верным между запусками.
+    params = [('page', page), ('limit', limit), ('order[id]', 'asc')]
+    if with_:
+        params.append(('with', with_ if isinstance(with_, str) else ','.join(with_)))
+    for key, value in (filters or {}).items():
+        params.extend(_filter_params(f"filter[{key}]", value))
+    return f"{collection}?{urlencode(params)}"
+
+
+class PageStream:
+    # Итератор по коллекции amoCRM (leads, contacts) без загрузки её целиком:
+    # фоновый поток тянет до prefetch страниц вперёд, пока вызывающий
+    # разбирает текущую; в памяти не больше prefetch + 2 страниц. Запросы
+    # идут через транспорт клиента и потому соблюдают общий лимит.
+    #
+    # cursor - {'page': ..., 'last_id': ...} после последней отданной записи.
+    # Его можно сохранить и передать в новый PageStream: обход продолжится с
+    # той же страницы, уже отданные id пропускаются. Удаления до курсора
+    # сдвигают записи к началу; пока их меньше limit, сдвинутые записи
+    # остаются на странице курсора и не теряются.
+    def __init__(self, fetch_page, collection, filters=None, with_=None, limit=MAX_PAGE_SIZE, prefetch=2, cursor=None):
+        self.fetch_page = fetch_page
+        self.collection = collection
+        self.filters = filters
+        self.with_ = with_
+        self.limit = min(limit, MAX_PAGE_SIZE)
+        self.prefetch = prefetch
+        self.cursor = dict(cursor) if cursor else {'page': 1, 'last_id': None}
+        self.pages = 0
+
+    def _endpoint(self, page):
+        return collection_endpoint(self.collection, page, self.limit, self.filters, self.with_)
+
+    def _items(self, data):
+        items = ((data or {}).get('_embedded') or {}).get(self.collection) or []
+        # последняя страница: меньше limit записей или нет ссылки next
+        last = len(items) < self.limit or not (data.get('_links') or {}).get('next')
+        return items, last
+
+    def _emit(self, page, items):
+        last_id = self.cursor.get('last_id')
+        for item in items:
+            if last_id is not None and item['id'] <= last_id:
+                continue
+            self.cursor = {'page': page, 'last_id': item['id']}
+            yield item
+
+    def _produce(self, pages, stop):
+        page = self.cursor['page']
+        try:
+            while not stop.is_set():
+                items, last = self._items(self.fetch_page(self._endpoint(page)))
+                if items and not self._put(pages, stop, (_PAGE, (page, items))):
+                    return
+                if last:
+                    break
+                page += 1
+        except Exception as e:
+            self._put(pages, stop, (_ERROR, e))
+            return
+        self._put(pages, stop, (_DONE, None))
+
+    def _put(self, pages, stop, message):
+        # вызывающий может бросить итерацию на середине: тогда поток не
+        # должен вечно ждать места в очереди
+        while not stop.is_set():
+            try:
+                pages.put(message, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        if not self.prefetch:
+            page = self.cursor['page']
+            while True:
+                items, last = self._items(self.fetch_page(self._endpoint(page)))
+                self.pages += 1
+                yield from self._emit(page, items)
+                if last:
+                    return
+                page += 1
+
+        pages = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce, args=(pages, stop), name=f"amocrm-{self.collection}-prefetch", daemon=True
+        )
+        thread.start()
+        try:
+            while True:
+                kind, value = pages.get()
+                if kind == _DONE:
+                    return
+                if kind == _ERROR:
+                    raise value
+                page, items = value
+                self.pages += 1
+                yield from self._emit(page, items)
+        finally:
+            stop.set()
+
+
+class AsyncPageStream(PageStream):
+    # То же для AsyncAmoCRMClient: вместо потока - задача в том же event loop
+    async def _aproduce(self, pages):
+        page = self.cursor['page']
+        try:
+            while True:
+                items, last = self._items(await self.fetch_page(self._endpoint(page)))
+                if items:
+                    await pages.put((_PAGE, (page, items)))
+                if last:
+                    break
+                page += 1
+        except Exception as e:
+            await pages.put((_ERROR, e))
+            return
+        await pages.put((_DONE, None))
+
+    async def __aiter__(self):
+        pages = asyncio.Queue(maxsize=max(self.prefetch, 1))
+        task = asyncio.ensure_future(self._aproduce(pages))
+        try:
+            while True:
+                kind, value = await pages.get()
+                if kind == _DONE:
+                    return
+                if kind == _ERROR:
+                    raise value
+                page, items = value
+                self.pages += 1
+                for item in self._emit(page, items):
+                    yield item
+        finally:
+            task.cancel()
+
+    def __iter__(self):
+        raise TypeError('AsyncPageStream: используйте async for')
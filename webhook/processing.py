@@ -0,0 +1,289 @@
+import logging
+import requests
+from django.db import transaction
+from django.utils import timezone
+from . import metrics
+from .amocrm_client import AmoCRMClient
+from .async_client import AsyncAmoCRMClient
+from .breaker import CircuitOpenError
+from .contacts import forget_contact, aforget_contact
+from .dedup import release_fingerprint, arelease_fingerprint
+from .retry import apply_failure
+from .utils import extract_customer_info
+
+logger = logging.getLogger(__name__)
+
+
+def is_refund(customer_info):
+    return customer_info.get('status') == 'Refunded' or customer_info.get('payment_system_status') == 'Refund'
+
+
+def is_paid(customer_info):
+    return customer_info.get('status') == 'Paid' and customer_info.get('payment_system_status') == 'Paid'
+
+
+# Решения по заказу - здесь, один раз для sync- и async-пути. Функции ниже
+# возвращают результат метода клиента как есть: у AsyncAmoCRMClient это
+# корутина, и async_order её ждёт.
+def update_existing_lead(amocrm, lead_id, customer_info):
+    if is_refund(customer_info):
+        logger.info("Processing refund for existing lead: %s", lead_id)
+        metrics.inc('webhook_results_total', result='refund')
+        return amocrm.update_lead_for_refund(lead_id, customer_info)
+
+    logger.info("Updating existing lead: %s", lead_id)
+    metrics.inc('webhook_results_total', result='updated')
+    if is_paid(customer_info):
+        return amocrm.update_lead(lead_id, customer_info, status_id=77419554)
+    return amocrm.update_lead(lead_id, customer_info)
+
+
+def log_new_lead(customer_info):
+    if is_refund(customer_info):
+        logger.info("Creating new lead for refund: %s", customer_info['order_id'])
+    else:
+        logger.info("Creating new lead: %s", customer_info['order_id'])
+
+
+def contact_may_be_gone(error):
+    # 400/404 при создании сделки по контакту из индекса: контакт могли
+    # удалить в amoCRM; это проверяется через get_contact
+    return isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code in (400, 404)
+
+
+def found_contact_id(contact):
+    if contact:
+        logger.info("Found existing contact: %s", contact['id'])
+        return contact['id']
+    return None
+
+
+def create_contact(amocrm, customer_info):
+    contact = amocrm.create_contact(
+        email=customer_info['email'],
+        name=customer_info['name'],
+        phone=customer_info['phone']
+    )
+    logger.info("Created new contact: %s", contact['id'])
+    return contact['id']
+
+
+def resolve_contact(amocrm, customer_info, use_index=True):
+    contact = amocrm.find_contact_by_email(customer_info['email'], use_index=use_index)
+    if contact:
+        return contact['id']
+    return create_contact(amocrm, customer_info)
+
+
+def create_lead(amocrm, contact_id, customer_info):
+    if contact_id is None:
+        lead = amocrm.create_lead_with_contact(customer_info)
+        return lead, lead['contact_id']
+
+    try:
+        lead = amocrm.create_lead_with_custom_fields(contact_id=contact_id, customer_info=customer_info)
+        return lead, contact_id
+    except requests.HTTPError as e:
+        if not contact_may_be_gone(e) or amocrm.get_contact(contact_id):
+            raise
+
+    # контакт из индекса удалён в amoCRM: ищем или создаём его заново
+    logger.warning("Контакт %s не найден в amoCRM, обновляю индекс", contact_id)
+    forget_contact(customer_info['email'])
+    contact_id = resolve_contact(amocrm, customer_info, use_index=False)
+    lead = amocrm.create_lead_with_custom_fields(contact_id=contact_id, customer_info=customer_info)
+    return lead, contact_id
+
+
+def sync_order(amocrm, customer_info, webhook_log=None, batcher=None):
+    # Контакт пока не создаём: если сделки тоже нет, контакт и сделка
+    # создаются одним запросом к leads/complex (contact_id=None).
+    contact_id = found_contact_id(amocrm.find_contact_by_email(customer_info['email']))
+    existing_lead = amocrm.find_lead_by_order_id(customer_info['order_id'])
+
+    if existing_lead:
+        lead_id = existing_lead['id']
+        if contact_id is None:
+            contact_id = create_contact(amocrm, customer_info)
+        update_existing_lead(amocrm, lead_id, customer_info)
+    elif batcher is not None:
+        logger.info("Сделка для заказа %s поставлена в пакет", customer_info['order_id'])
+        batcher.add(webhook_log, contact_id, customer_info)
+        lead_id = None
+    else:
+        log_new_lead(customer_info)
+        lead, contact_id = create_lead(amocrm, contact_id, customer_info)
+        lead_id = lead['id']
+        metrics.inc('webhook_results_total', result='created')
+
+    return contact_id, lead_id
+
+
+SUCCESS_FIELDS = ['status', 'amocrm_contact_id', 'amocrm_lead_id', 'processed_at', 'next_attempt_at']
+ERROR_FIELDS = ['status', 'error_message', 'attempts', 'next_attempt_at', 'last_error_class']
+SPOOL_FIELDS = ['status', 'error_message', 'claimed_by', 'claimed_at']
+
+
+def mark_success(webhook_log, contact_id, lead_id):
+    webhook_log.status = 'success'
+    webhook_log.amocrm_contact_id = contact_id
+    webhook_log.amocrm_lead_id = lead_id
+    webhook_log.processed_at = timezone.now()
+    webhook_log.next_attempt_at = None
+    # только изменившиеся колонки и одна транзакция: тело вебхука не
+    # перезаписывается, а блокировка SQLite берётся один раз
+    with transaction.atomic():
+        webhook_log.save(update_fields=SUCCESS_FIELDS)
+        webhook_log.superseded.update(amocrm_contact_id=contact_id, amocrm_lead_id=lead_id)
+
+
+def mark_error(webhook_log, error):
+    # retry оставляет отпечаток: повтор от Radario - дубль, вебхук и так
+    # будет обработан ещё раз
+    status = apply_failure(webhook_log, error)
+    metrics.inc('webhook_results_total', result=status)
+    with transaction.atomic():
+        webhook_log.save(update_fields=ERROR_FIELDS)
+        if status != 'retry':
+            release_fingerprint(webhook_log)
+
+
+def spool(webhook_log, error):
+    # amoCRM недоступен: вебхук возвращается в очередь, его обработает
+    # process_webhooks, когда breaker снова пропустит запросы. Отпечаток не
+    # освобождается - повтор от Radario останется дублем.
+    webhook_log.status = 'pending'
+    webhook_log.error_message = str(error)
+    webhook_log.claimed_by = None
+    webhook_log.claimed_at = None
+    metrics.inc('webhook_results_total', result='spooled')
+    webhook_log.save(update_fields=SPOOL_FIELDS)
+
+
+def process_webhook_log(webhook_log, amocrm=None, batcher=None):
+    # С batcher новые сделки не создаются сразу: строка остаётся в статусе
+    # processing, пока LeadBatcher.flush() не отправит пакет и не проставит
+    # итоговый статус.
+    try:
+        customer_info = extract_customer_info(webhook_log.get_payload())
+        if not customer_info['email']:
+            raise ValueError('No email provided')
+
+        if batcher is not None and batcher.has_order(customer_info['order_id']):
+            batcher.flush()
+
+        contact_id, lead_id = sync_order(amocrm or AmoCRMClient(), customer_info, webhook_log, batcher)
+    except CircuitOpenError as e:
+        logger.warning("Webhook %s отложен: %s", webhook_log.id, e)
+        spool(webhook_log, e)
+        raise
+    except Exception as e:
+        logger.error("Webhook %s processing error: %s", webhook_log.id, e, exc_info=True)
+        mark_error(webhook_log, e)
+        raise
+
+    if lead_id is not None:
+        mark_success(webhook_log, contact_id, lead_id)
+    return contact_id, lead_id
+
+
+async def acreate_contact(amocrm, customer_info):
+    contact = await amocrm.create_contact(
+        email=customer_info['email'],
+        name=customer_info['name'],
+        phone=customer_info['phone']
+    )
+    logger.info("Created new contact: %s", contact['id'])
+    return contact['id']
+
+
+async def aresolve_contact(amocrm, customer_info, use_index=True):
+    contact = await amocrm.find_contact_by_email(customer_info['email'], use_index=use_index)
+    if contact:
+        return contact['id']
+    return await acreate_contact(amocrm, customer_info)
+
+
+async def acreate_lead(amocrm, contact_id, customer_info):
+    if contact_id is None:
+        lead = await amocrm.create_lead_with_contact(customer_info)
+        return lead, lead['contact_id']
+
+    try:
+        lead = await amocrm.create_lead_with_custom_fields(contact_id=contact_id, customer_info=customer_info)
+        return lead, contact_id
+    except requests.HTTPError as e:
+        if not contact_may_be_gone(e) or await amocrm.get_contact(contact_id):
+            raise
+
+    logger.warning("Контакт %s не найден в amoCRM, обновляю индекс", contact_id)
+    await aforget_contact(customer_info['email'])
+    contact_id = await aresolve_contact(amocrm, customer_info, use_index=False)
+    lead = await amocrm.create_lead_with_custom_fields(contact_id=contact_id, customer_info=customer_info)
+    return lead, contact_id
+
+
+async def async_order(amocrm, customer_info):
+    # та же последовательность, что в sync_order, без пакетов
+    contact_id = found_contact_id(await amocrm.find_contact_by_email(customer_info['email']))
+    existing_lead = await amocrm.find_lead_by_order_id(customer_info['order_id'])
+
+    if existing_lead:
+        lead_id = existing_lead['id']
+        if contact_id is None:
+            contact_id = await acreate_contact(amocrm, customer_info)
+        await update_existing_lead(amocrm, lead_id, customer_info)
+    else:
+        log_new_lead(customer_info)
+        lead, contact_id = await acreate_lead(amocrm, contact_id, customer_info)
+        lead_id = lead['id']
+        metrics.inc('webhook_results_total', result='created')
+
+    return contact_id, lead_id
+
+
+async def amark_success(webhook_log, contact_id, lead_id):
+    webhook_log.status = 'success'
+    webhook_log.amocrm_contact_id = contact_id
+    webhook_log.amocrm_lead_id = lead_id
+    webhook_log.processed_at = timezone.now()
+    webhook_log.next_attempt_at = None
+    await webhook_log.asave(update_fields=SUCCESS_FIELDS)
+    await webhook_log.superseded.aupdate(amocrm_contact_id=contact_id, amocrm_lead_id=lead_id)
+
+
+async def amark_error(webhook_log, error):
+    status = apply_failure(webhook_log, error)
+    metrics.inc('webhook_results_total', result=status)
+    await webhook_log.asave(update_fields=ERROR_FIELDS)
+    if status != 'retry':
+        await arelease_fingerprint(webhook_log)
+
+
+async def aspool(webhook_log, error):
+    webhook_log.status = 'pending'
+    webhook_log.error_message = str(error)
+    webhook_log.claimed_by = None
+    webhook_log.claimed_at = None
+    metrics.inc('webhook_results_total', result='spooled')
+    await webhook_log.asave(update_fields=SPOOL_FIELDS)
+
+
+async def aprocess_webhook_log(webhook_log, amocrm=None):
+    try:
+        customer_info = extract_customer_info(webhook_log.get_payload())
+        if not customer_info['email']:
+            raise ValueError('No email provided')
+
+        contact_id, lead_id = await async_order(amocrm or AsyncAmoCRMClient(), customer_info)
+    except CircuitOpenError as e:
+        logger.warning("Webhook %s отложен: %s", webhook_log.id, e)
+        await aspool(webhook_log, e)
+        raise
+    except Exception as e:
+        logger.error("Webhook %s processing error: %s", webhook_log.id, e, exc_info=True)
+        await amark_error(webhook_log, e)
+        raise
+
+    await amark_success(webhook_log, contact_id, lead_id)
+    return contact_id, lead_id
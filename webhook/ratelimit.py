@@ -0,0 +1,83 @@
+import logging
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from django.conf import settings
+from .sharedstate import locked_state
+
+logger = logging.getLogger(__name__)
+
+
+# Token bucket, общий для всех процессов на хосте. Токены резервируются
+# заранее: счётчик может уйти в минус, и тогда вызывающий ждёт, пока его
+# токен «дорастёт». Так ожидающие выстраиваются с шагом 1/rate, а не
+# срываются пачкой после паузы.
+class RateLimiter:
+    def __init__(self, rate, burst, path):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.path = path
+
+    def _refill(self, state, now):
+        tokens = state.get('tokens', self.burst)
+        updated = state.get('updated', now)
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def reserve(self):
+        with locked_state(self.path) as state:
+            now = time.time()
+            tokens = self._refill(state, now) - 1
+            state['tokens'] = tokens
+            state['updated'] = now
+
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def block_for(self, seconds):
+        with locked_state(self.path) as state:
+            now = time.time()
+            tokens = min(self._refill(state, now), 0) - seconds * self.rate
+            state['tokens'] = tokens
+            state['updated'] = now
+
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    base = settings.AMOCRM_BACKOFF_BASE if base is None else base
+    cap = settings.AMOCRM_BACKOFF_MAX if cap is None else cap
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        path = os.path.join(settings.AMOCRM_STATE_DIR, f"{settings.AMOCRM_SUBDOMAIN}.ratelimit")
+        _limiter = RateLimiter(settings.AMOCRM_RATE_LIMIT, settings.AMOCRM_RATE_BURST, path)
+    return _limiter
@@ -0,0 +1,208 @@
+import logging
+import re
+from django.db.models import Count, Max
+from .coalesce import latest_by_order
+from .ingest import requeue
+from .leads import forget_lead
+from .models import LeadIndex, WebhookLog
+from .processing import is_paid, is_refund
+from .utils import extract_customer_info, make_order_key
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_ID = 9713218
+STATUS_PAID = 77419554
+STATUS_REFUNDED = 143
+ORDER_KEY_FIELD_ID = 986103
+
+# строки, которые ещё обрабатываются: отсутствие сделки для них нормально
+IN_FLIGHT_STATUSES = ('pending', 'processing', 'retry')
+# сделка пропала после успеха или после исчерпанных повторов временной
+# ошибки (dead) - такой вебхук можно отправить заново; error - ошибка
+# постоянная (400, битый payload), повтор её не исправит
+REQUEUE_STATUSES = ('success', 'dead')
+
+_NAME_ORDER_RE = re.compile(r'\(#([^)]+)\)\s*$')
+
+
+def expected_status_id(customer_info):
+    # то же правило, что в sync_order: возврат - 143, оплачен - 77419554,
+    # остальные статусы сделку не двигают
+    if is_refund(customer_info):
+        return STATUS_REFUNDED
+    if is_paid(customer_info):
+        return STATUS_PAID
+    return None
+
+
+class PipelineLeads:
+    # Индекс сделок воронки в памяти за один проход iter_leads. Храним только
+    # (id, status_id, price): на сотни тысяч сделок это десятки мегабайт.
+    # Номер заказа берётся из названия "... (#order_id)"; у сделок без него -
+    # ключ из поля 986103 (сам номер или его хеш, см. make_order_key).
+    def __init__(self):
+        self.by_order = {}
+        self.by_key = {}
+        self.total = 0
+
+    def add(self, lead):
+        self.total += 1
+        entry = (lead['id'], lead.get('status_id'), lead.get('price'))
+
+        match = _NAME_ORDER_RE.search(lead.get('name') or '')
+        if match:
+            self.by_order.setdefault(match.group(1), []).append(entry)
+            return
+
+        for field in lead.get('custom_fields_values') or []:
+            if field.get('field_id') == ORDER_KEY_FIELD_ID:
+                for value in field.get('values') or []:
+                    self.by_key.setdefault(str(value.get('value')), []).append(entry)
+                return
+
+    def find(self, order_id):
+        leads = self.by_order.get(order_id)
+        if leads:
+            return leads
+        return self.by_key.get(make_order_key(order_id), [])
+
+    @classmethod
+    def load(cls, amocrm, pipeline_id=PIPELINE_ID):
+        index = cls()
+        for lead in amocrm.iter_leads({'pipeline_id': pipeline_id}):
+            index.add(lead)
+        logger.info("Сверка: загружено сделок воронки %s: %s", pipeline_id, index.total)
+        return index
+
+
+def latest_webhook_ids(since=None, chunk_size=500):
+    # Последний вебхук каждого заказа - по UpdateDate, как в coalesce_batch:
+    # Radario может прислать старое состояние позже нового. GROUP BY по
+    # индексу (order_id, created_at) отдаёт заказы с одним вебхуком сразу,
+    # тела читаются только у заказов, где вебхуков несколько.
+    # coalesced - заведомо не последние.
+    queryset = WebhookLog.objects.exclude(order_id=None).exclude(status='coalesced')
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+
+    ids = []
+    contested = []
+    for row in queryset.values('order_id').annotate(last_id=Max('id'), rows=Count('id')):
+        if row['rows'] == 1:
+            ids.append(row['last_id'])
+        else:
+            contested.append(row['order_id'])
+
+    for start in range(0, len(contested), chunk_size):
+        webhook_logs = list(queryset.filter(order_id__in=contested[start:start + chunk_size]))
+        ids.extend(webhook_log.id for webhook_log in latest_by_order(webhook_logs).values())
+    return sorted(ids)
+
+
+def iter_latest_webhooks(since=None, chunk_size=500):
+    ids = latest_webhook_ids(since)
+    for start in range(0, len(ids), chunk_size):
+        yield from WebhookLog.objects.filter(id__in=ids[start:start + chunk_size]).order_by('id')
+
+
+class Reconciler:
+    def __init__(self, amocrm, pipeline_id=PIPELINE_ID, details=50):
+        self.amocrm = amocrm
+        self.pipeline_id = pipeline_id
+        self.details = details
+        self.counts = {'orders': 0, 'ok': 0, 'missing': 0, 'failed': 0, 'in_flight': 0, 'duplicate': 0, 'stale': 0}
+        self.samples = {'missing': [], 'failed': [], 'duplicate': [], 'stale': []}
+        self.missing_ids = []
+        self.duplicates = []
+        self.updates = []
+
+    def _sample(self, kind, item):
+        self.counts[kind] += 1
+        if len(self.samples[kind]) < self.details:
+            self.samples[kind].append(item)
+
+    def check(self, webhook_log, leads):
+        self.counts['orders'] += 1
+        order_id = self.amocrm._clean_order_id(webhook_log.order_id)
+
+        if not leads:
+            if webhook_log.status in IN_FLIGHT_STATUSES:
+                self.counts['in_flight'] += 1
+                return
+            sample = {'order_id': order_id, 'webhook_id': webhook_log.id, 'status': webhook_log.status}
+            if webhook_log.status not in REQUEUE_STATUSES:
+                # разбирается вручную: --fix такие не переотправляет
+                sample['error'] = webhook_log.error_message
+                self._sample('failed', sample)
+                return
+            self.missing_ids.append((webhook_log.id, order_id))
+            self._sample('missing', sample)
+            return
+
+        # основная сделка - с наименьшим id, как в find_lead_by_order_id
+        leads = sorted(leads)
+        lead_id, status_id, price = leads[0]
+        if len(leads) > 1:
+            self.duplicates.append((order_id, lead_id))
+            self._sample('duplicate', {'order_id': order_id, 'lead_ids': [lead[0] for lead in leads]})
+
+        customer_info = extract_customer_info(webhook_log.get_payload() or {})
+        expected_status = expected_status_id(customer_info)
+        expected_price = None
+        if expected_status != STATUS_REFUNDED and customer_info.get('amount') is not None:
+            expected_price = int(float(customer_info['amount']))
+
+        problems = []
+        if expected_status is not None and status_id != expected_status:
+            problems.append(f"status_id {status_id} != {expected_status}")
+        if expected_price is not None and price != expected_price:
+            problems.append(f"price {price} != {expected_price}")
+
+        if problems:
+            self.updates.append(self._update_data(lead_id, customer_info, expected_status))
+            self._sample('stale', {'order_id': order_id, 'lead_id': lead_id, 'problems': problems})
+        elif len(leads) == 1:
+            self.counts['ok'] += 1
+
+    def _update_data(self, lead_id, customer_info, expected_status):
+        # те же PATCH, что отправила бы обработка вебхука
+        if expected_status == STATUS_REFUNDED:
+            return self.amocrm.build_refund_update_data(lead_id, customer_info)
+        return self.amocrm.build_update_data(lead_id, customer_info, status_id=expected_status)
+
+    def run(self, since=None):
+        index = PipelineLeads.load(self.amocrm, self.pipeline_id)
+        for webhook_log in iter_latest_webhooks(since):
+            order_id = self.amocrm._clean_order_id(webhook_log.order_id)
+            self.check(webhook_log, index.find(order_id))
+        self.counts['leads'] = index.total
+        return self.report()
+
+    def fix(self):
+        # Устаревшие сделки - пакетными PATCH; дубли - индекс сделок
+        # указывает на основную; пропавшие - вебхук заново в очередь, а
+        # запись индекса, ведущая на удалённую сделку, забывается.
+        fixed = {'patched': 0, 'patch_errors': 0, 'requeued': 0, 'reindexed': 0}
+        if self.updates:
+            updated, errors = self.amocrm.update_leads_batch(self.updates)
+            fixed['patched'] = updated
+            fixed['patch_errors'] = len(errors)
+            for error in errors[:self.details]:
+                logger.error("Сверка: PATCH не прошёл: %s", error)
+
+        for order_id, lead_id in self.duplicates:
+            fixed['reindexed'] += LeadIndex.objects.filter(order_id=order_id).exclude(amocrm_lead_id=lead_id).update(
+                amocrm_lead_id=lead_id
+            )
+
+        if self.missing_ids:
+            for _, order_id in self.missing_ids:
+                forget_lead(order_id)
+            fixed['requeued'] = requeue(
+                [webhook_id for webhook_id, _ in self.missing_ids],
+                statuses=REQUEUE_STATUSES,
+            )
+        return fixed
+
+    def report(self):
+        return {'counts': self.counts, **self.samples}
@@ -0,0 +1,231 @@
+import asyncio
+import base64
+import functools
+import gzip
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from django.test import RequestFactory
+from django.urls import reverse
+from . import views
+from .fastjson import dumps, loads
+from .models import WebhookLog
+
+# Этапы view, время которых меряется отдельно; request - вызов view целиком.
+SYNC_STAGES = {
+    'parse': 'parse_webhook',
+    'dedup': 'find_duplicate',
+    'store': 'store_webhook',
+    'process': 'process_webhook_log',
+}
+ASYNC_STAGES = {
+    'parse': 'parse_webhook',
+    'dedup': 'afind_duplicate',
+    'store': 'store_webhook',
+    'process': 'aprocess_webhook_log',
+}
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def record_to_item(record):
+    # Понимает три формата строк: capture-файл middleware, запись архива
+    # archive_webhooks и голый payload Radario.
+    if 'body' in record:
+        return record.get('ts'), record['body'].encode('utf-8')
+    if 'body_b64' in record:
+        return record.get('ts'), base64.b64decode(record['body_b64'])
+    if 'payload' in record:
+        return _timestamp(record.get('created_at')), dumps(record['payload'])
+    return None, dumps(record)
+
+
+def load_jsonl(paths):
+    items = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    items.append(record_to_item(loads(line)))
+    return items
+
+
+def load_webhook_logs(since=None, until=None, statuses=None, limit=None):
+    queryset = WebhookLog.objects.order_by('created_at', 'id')
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+    if until:
+        queryset = queryset.filter(created_at__lt=until)
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    if limit:
+        queryset = queryset[:limit]
+
+    items = []
+    for webhook_log in queryset.iterator(chunk_size=500):
+        body = webhook_log.get_raw_body()
+        if body is None:
+            body = dumps(webhook_log.payload)
+        items.append((webhook_log.created_at.timestamp(), body))
+    return items
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, stage, elapsed):
+        with self._lock:
+            self.samples[stage].append(elapsed)
+
+    def wrap(self, stage, func):
+        if asyncio.iscoroutinefunction(func):
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+        else:
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+        return functools.wraps(func)(timed)
+
+    @contextmanager
+    def instrument(self, module, stages):
+        # view находит эти функции через глобальные имена модуля, поэтому
+        # подменяем их на время прогона и возвращаем обратно
+        originals = {name: getattr(module, name) for name in stages.values()}
+        try:
+            for stage, name in stages.items():
+                setattr(module, name, self.wrap(stage, originals[name]))
+            yield self
+        finally:
+            for name, func in originals.items():
+                setattr(module, name, func)
+
+    def report(self):
+        report = {}
+        for stage, values in sorted(self.samples.items()):
+            values = sorted(values)
+            report[stage] = {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+                'max_ms': round(values[-1] * 1000, 3),
+            }
+        return report
+
+
+class Replayer:
+    def __init__(self, concurrency=8, preserve_timing=False, speed=1.0, use_async=False):
+        self.concurrency = max(1, concurrency)
+        self.preserve_timing = preserve_timing
+        self.speed = speed if speed and speed > 0 else 1.0
+        self.use_async = use_async
+        self.factory = RequestFactory()
+        self.path = reverse('radario_webhook_async' if use_async else 'radario_webhook')
+        self.timer = StageTimer()
+        self.outcomes = Counter()
+        self._lock = threading.Lock()
+
+    def schedule(self, items):
+        # Смещения от первого вебхука, сжатые в speed раз; без
+        # preserve_timing всё отправляется сразу, упираясь в concurrency.
+        if not self.preserve_timing:
+            return [(0.0, body) for _, body in items]
+
+        items = sorted(items, key=lambda item: item[0] or 0)
+        first = next((ts for ts, _ in items if ts is not None), None)
+        return [
+            ((ts - first) / self.speed if ts is not None and first is not None else 0.0, body)
+            for ts, body in items
+        ]
+
+    def _request(self, body):
+        return self.factory.post(self.path, data=body, content_type='application/json')
+
+    def _record(self, response, lag):
+        try:
+            status = loads(response.content).get('status')
+        except (ValueError, AttributeError):
+            status = None
+        with self._lock:
+            self.outcomes[f"{response.status_code} {status}"] += 1
+        self.timer.add('schedule_lag', max(lag, 0.0))
+
+    def _send(self, started, offset, body):
+        lag = time.monotonic() - started - offset
+        if lag < 0:
+            time.sleep(-lag)
+            lag = 0.0
+
+        request_started = time.perf_counter()
+        response = views.radario_webhook(self._request(body))
+        self.timer.add('request', time.perf_counter() - request_started)
+        self._record(response, lag)
+
+    async def _asend(self, semaphore, started, offset, body):
+        delay = started + offset - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        async with semaphore:
+            lag = time.monotonic() - started - offset
+            request_started = time.perf_counter()
+            response = await views.radario_webhook_async(self._request(body))
+            self.timer.add('request', time.perf_counter() - request_started)
+            self._record(response, lag)
+
+    async def _run_async(self, schedule):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
+        await asyncio.gather(*(self._asend(semaphore, started, offset, body) for offset, body in schedule))
+
+    def run(self, items):
+        schedule = self.schedule(items)
+        started = time.monotonic()
+
+        with self.timer.instrument(views, ASYNC_STAGES if self.use_async else SYNC_STAGES):
+            if self.use_async:
+                asyncio.run(self._run_async(schedule))
+            else:
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    # очередь пула FIFO, а schedule отсортирован по времени:
+                    # поток берёт следующий вебхук и ждёт его момента
+                    futures = [executor.submit(self._send, started, offset, body) for offset, body in schedule]
+                    for future in futures:
+                        future.result()
+
+        elapsed = time.monotonic() - started
+        return {
+            'webhooks': len(schedule),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round(len(schedule) / elapsed, 2) if elapsed else None,
+            'outcomes': dict(self.outcomes),
+            'stages': self.timer.report(),
+        }
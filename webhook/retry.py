@@ -0,0 +1,49 @@
+from datetime import timedelta
+import httpx
+import requests
+from django.conf import settings
+from django.utils import timezone
+from .breaker import CircuitOpenError
+from .ratelimit import backoff_delay
+
+# Сеть, таймауты, 429 и 5xx лечатся временем - такие ошибки повторяем.
+# Остальное (400 валидации, нет email, битый payload) повтор не исправит.
+RETRYABLE_EXCEPTIONS = (
+    CircuitOpenError,
+    requests.ConnectionError,
+    requests.Timeout,
+    httpx.TransportError,
+)
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_EXCEPTIONS):
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(error, (requests.HTTPError, httpx.HTTPStatusError)) and response is not None:
+        return response.status_code == 429 or response.status_code >= 500
+    return False
+
+
+def retry_delay(attempts):
+    return backoff_delay(attempts - 1, settings.WEBHOOK_RETRY_BASE_DELAY, settings.WEBHOOK_RETRY_MAX_DELAY)
+
+
+def apply_failure(webhook_log, error):
+    # Проставляет поля неудачной попытки и возвращает новый статус:
+    # retry - повторим в next_attempt_at, dead - попытки кончились,
+    # error - повторять бессмысленно.
+    webhook_log.attempts += 1
+    webhook_log.error_message = str(error)
+    webhook_log.last_error_class = type(error).__name__ if isinstance(error, BaseException) else None
+
+    if not is_retryable(error):
+        webhook_log.status = 'error'
+        webhook_log.next_attempt_at = None
+    elif webhook_log.attempts >= settings.WEBHOOK_RETRY_MAX_ATTEMPTS:
+        webhook_log.status = 'dead'
+        webhook_log.next_attempt_at = None
+    else:
+        webhook_log.status = 'retry'
+        webhook_log.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(webhook_log.attempts))
+    return webhook_log.status
@@ -0,0 +1,41 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from django.db import connections
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from . import breaker, metrics, ratelimit, transport
+from .contacts import _cache as contact_cache
+
+
+@contextmanager
+def isolated_environment():
+    # Прогон (replay, бенчмарки) в одноразовой БД SQLite со своими каталогами
+    # метрик и состояния amoCRM. Рабочие строки и отпечатки не видны и не
+    # трогаются, блокировка рабочей БД не берётся, breaker, лимитер и
+    # метрики процесса остаются прежними. Таблицы создаются миграциями, как
+    # в тестах.
+    with tempfile.TemporaryDirectory(prefix='webhook-sandbox-') as tmp:
+        test_settings = connections['default'].settings_dict['TEST']
+        previous_name = test_settings.get('NAME')
+        test_settings['NAME'] = os.path.join(tmp, 'db.sqlite3')
+
+        # каталоги подменяются первыми: миграции одноразовой БД уже пишут
+        # метрики SQLite
+        paths = override_settings(METRICS_DIR=os.path.join(tmp, 'metrics'), AMOCRM_STATE_DIR=os.path.join(tmp, 'state'))
+        paths.enable()
+        previous = (metrics.registry, breaker._breaker, ratelimit._limiter, transport._transport, transport._transport_pid)
+        metrics.registry = metrics.Registry()
+        breaker._breaker = ratelimit._limiter = transport._transport = transport._transport_pid = None
+        contact_cache.clear()
+
+        old_config = None
+        try:
+            old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'}, serialized_aliases=set())
+            yield tmp
+        finally:
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+            test_settings['NAME'] = previous_name
+            metrics.registry, breaker._breaker, ratelimit._limiter, transport._transport, transport._transport_pid = previous
+            contact_cache.clear()
+            paths.disable()
@@ -0,0 +1,48 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _thread_lock(path):
+    with _thread_locks_guard:
+        lock = _thread_locks.get(path)
+        if lock is None:
+            lock = _thread_locks[path] = threading.Lock()
+        return lock
+
+
+@contextmanager
+def locked_state(path):
+    # JSON-словарь в файле, общий для всех процессов на хосте; изменения
+    # записываются обратно под той же блокировкой. Без fcntl (Windows)
+    # состояние общее только для потоков одного процесса.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with _thread_lock(path), open(path, 'a+', encoding='utf-8') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+        f.seek(0)
+        raw = f.read()
+        try:
+            state = json.loads(raw) if raw else {}
+        except ValueError:
+            state = {}
+
+        before = dict(state)
+        yield state
+
+        if state != before:
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
@@ -0,0 +1,156 @@
+import logging
+import re
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Порядок задаёт приоритет: если в названии есть несколько ключей, выигрывает
+# тот, что выше. Составные ключи стоят раньше слов, которые в них входят
+# («кинофестиваль» раньше «фестиваль», «литературная встреча» раньше «встреча»).
+EVENT_KEYWORDS = (
+    ('мастер-класс', 'Мастер-класс'),
+    ('мастер класс', 'Мастер-класс'),
+    ('программа', 'Программа'),
+    ('лекция', 'Лекция'),
+    ('театральное занятие', 'Театральное занятие'),
+    ('игра', 'Игра'),
+    ('резиденция', 'Резиденция'),
+    ('выставка', 'Выставка'),
+    ('спектакль', 'Спектакль'),
+    ('экскурсия', 'Экскурсия'),
+    ('концерт', 'Концерт'),
+    ('шоу', 'Шоу'),
+    ('комбо', 'Комбо'),
+    ('кинопоказ', 'Кинопоказ'),
+    ('конференция', 'Конференция'),
+    ('кинофестиваль', 'Кинофестиваль'),
+    ('фестиваль', 'Фестиваль'),
+    ('творческая встреча', 'Творческая встреча'),
+    ('открытый разговор', 'Открытый разговор'),
+    ('митап', 'Митап'),
+    ('мит-ап', 'Митап'),
+    ('дискуссия', 'Дискуссия'),
+    ('литературная встреча', 'Книжный клуб'),
+    ('встреча', 'Встреча'),
+    ('перформанс', 'Перформанс'),
+    ('workshop', 'Workshop'),
+    ('воркшоп', 'Воркшоп'),
+    ('арт-терапия', 'Арт-терапия'),
+    ('занятие', 'Занятие'),
+    ('паблик-ток', 'Паблик-топ'),
+    ('ted-talk', 'TED-talk'),
+    ('показ', 'Показ'),
+    ('диалог', 'Диалог'),
+    ('книжный клуб', 'Книжный клуб'),
+    ('book club', 'Книжный клуб'),
+    ('bookclub', 'Книжный клуб'),
+    ('литературный клуб', 'Книжный клуб'),
+    ('чтение', 'Книжный клуб'),
+    ('литературный вечер', 'Книжный клуб'),
+    ('обсуждение книги', 'Книжный клуб'),
+)
+
+DEFAULT_EVENT_TYPE = 'Другое'
+
+EVENT_TYPE_ENUM_IDS = {
+    'Мастер-класс': 985177,
+    'Программа': 985179,
+    'Лекция': 985181,
+    'Театральное занятие': 985183,
+    'Игра': 985185,
+    'Резиденция': 985187,
+    'Выставка': 985189,
+    'Спектакль': 985191,
+    'Экскурсия': 985193,
+    'Концерт': 985195,
+    'Шоу': 985197,
+    'Комбо': 985199,
+    'Кинопоказ': 985201,
+    'Конференция': 985203,
+    'Фестиваль': 985205,
+    'Творческая встреча': 985207,
+    'Кинофестиваль': 985209,
+    'Открытый разговор': 985211,
+    'Митап': 985213,
+    'Дискуссия': 985215,
+    'Встреча': 985217,
+    'Перформанс': 985219,
+    'Workshop': 985221,
+    'Воркшоп': 985223,
+    'Арт-терапия': 985225,
+    'Занятие': 985227,
+    'Паблик-топ': 985229,
+    'TED-talk': 985231,
+    'Показ': 985233,
+    'Диалог': 985235,
+    'Книжный клуб': 986271,
+    'Другое': None,
+}
+
+FALLBACK_EVENT_TYPE_ENUM_ID = 985177
+
+# В поле «Статус оплаты» amoCRM всего два значения: всё, что не возврат,
+# уходит как «Оплачено».
+PAYMENT_STATUS_ENUM_IDS = {
+    'Оплачен': 985097,
+    'Возврат': 985099,
+    'В обработке': 985097,
+    'Отменен': 985097,
+    'Неизвестно': 985097,
+}
+
+DEFAULT_PAYMENT_STATUS_ENUM_ID = 985097
+
+
+def _compile_keywords():
+    # Ключи с дефисом дополнительно ищутся через пробел, но с приоритетом
+    # ниже всех основных ключей.
+    ranks = {}
+    for rank, (keyword, event_type) in enumerate(EVENT_KEYWORDS):
+        ranks.setdefault(keyword, (rank, event_type))
+    for rank, (keyword, event_type) in enumerate(EVENT_KEYWORDS, start=len(EVENT_KEYWORDS)):
+        ranks.setdefault(keyword.replace('-', ' '), (rank, event_type))
+
+    # Одна альтернатива на все ключи, длинные первыми: на одной позиции
+    # выигрывает самый длинный ключ, а вложенные в него слова и так имеют
+    # более низкий приоритет (см. порядок EVENT_KEYWORDS).
+    alternatives = '|'.join(re.escape(keyword) for keyword in sorted(ranks, key=len, reverse=True))
+    return re.compile(alternatives), ranks
+
+
+_KEYWORD_RE, _KEYWORD_RANKS = _compile_keywords()
+_ENUM_IDS_BY_LOWER = {event_type.lower(): enum_id for event_type, enum_id in EVENT_TYPE_ENUM_IDS.items()}
+
+
+@lru_cache(maxsize=2048)
+def event_type(event_title):
+    best = None
+    for match in _KEYWORD_RE.finditer((event_title or '').lower()):
+        candidate = _KEYWORD_RANKS[match.group()]
+        if best is None or candidate[0] < best[0]:
+            best = candidate
+            if best[0] == 0:
+                break
+    return best[1] if best else DEFAULT_EVENT_TYPE
+
+
+def event_type_enum_id(event_type_name):
+    if event_type_name in EVENT_TYPE_ENUM_IDS:
+        return EVENT_TYPE_ENUM_IDS[event_type_name]
+
+    key = (event_type_name or '').lower()
+    if key in _ENUM_IDS_BY_LOWER:
+        return _ENUM_IDS_BY_LOWER[key]
+
+    logger.warning("Не найден enum_id для типа события: %s, использую 'Мастер-класс'", event_type_name)
+    return FALLBACK_EVENT_TYPE_ENUM_ID
+
+
+@lru_cache(maxsize=2048)
+def classify_event(event_title):
+    name = event_type(event_title)
+    return name, event_type_enum_id(name)
+
+
+def payment_status_enum_id(payment_status):
+    return PAYMENT_STATUS_ENUM_IDS.get(payment_status, DEFAULT_PAYMENT_STATUS_ENUM_ID)
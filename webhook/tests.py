@@ -0,0 +1,939 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+import zlib
+from datetime import timedelta
+from email.utils import formatdate
+from itertools import islice
+from unittest import mock
+import httpx
+import requests
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from . import archive, breaker, contacts, metrics, models, orders, ratelimit, transport
+from .amocrm_client import AmoCRMClient
+from .archive import SegmentWriter, archive_record, archive_webhooks, find_archived, read_index, read_segment
+from .async_client import AsyncAmoCRMClient
+from .batching import LeadBatcher
+from .breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, get_breaker
+from .coalesce import coalesce_batch
+from .contacts import ContactCache, forget_contact, lookup_contact_id, remember_contact
+from .contacts import _cache as contact_cache
+from .dedup import find_duplicate, register_fingerprint, webhook_fingerprint
+from .leads import remember_lead
+from .fakeamocrm import FakeAmoCRMState, FaultConfig, start_fake_server
+from .ingest import claim_pending, release_claims
+from .models import ContactIndex, LeadIndex, WebhookLog
+from .orders import DEFAULT_CUSTOMER_NAME, Order
+from .processing import mark_error, process_webhook_log
+from .ratelimit import RateLimiter, retry_after_seconds
+from .reconcile import PIPELINE_ID, STATUS_PAID, STATUS_REFUNDED, Reconciler
+from .retry import apply_failure
+from .utils import extract_customer_info, lead_matches_order, make_order_key
+
+
+def radario_payload(order_id, email='buyer@example.com', status='Paid', payment_status='Paid', amount=500,
+                    update_date='2025-12-08T03:00:00Z'):
+    return {'model': {
+        'Id': order_id,
+        'Email': email,
+        'Status': status,
+        'PaymentSystemStatus': payment_status,
+        'Amount': amount,
+        'UpdateDate': update_date,
+        'Event': {'Title': 'Концерт', 'BeginDate': '2025-12-20T18:00:00Z'},
+        'Tickets': [{'OwnerName': 'Иван Петров'}],
+    }}
+
+
+def http_error(status_code, error_class=requests.HTTPError):
+    if error_class is httpx.HTTPStatusError:
+        request = httpx.Request('GET', 'http://amocrm.test/api/v4/leads')
+        return httpx.HTTPStatusError('error', request=request, response=httpx.Response(status_code, request=request))
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
+
+def make_log(payload, status='pending', **fields):
+    raw_body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return WebhookLog.objects.create(
+        **WebhookLog.pack_body(raw_body), **WebhookLog.lookup_fields(extract_customer_info(payload)),
+        status=status, **fields
+    )
+
+
+class Clock:
+    # подменяет модуль time в проверяемом модуле: время двигают только
+    # тест (clock.now) и sleep()
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def patch_time(test, module):
+    clock = Clock()
+    patcher = mock.patch.object(module, 'time', clock)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return clock
+
+
+def temp_dir(test):
+    tmp = tempfile.TemporaryDirectory(prefix='webhook-tests-')
+    test.addCleanup(tmp.cleanup)
+    return tmp.name
+
+
+class FakeAmoCRMTestCase(TestCase):
+    # Клиент ходит в фейковый amoCRM; breaker, лимитер, транспорт и метрики
+    # свои на каждый тест, их файлы - во временном каталоге
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = start_fake_server()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.tmp = temp_dir(self)
+
+        paths = override_settings(
+            AMOCRM_BASE_URL=self.server.base_url,
+            AMOCRM_STATE_DIR=os.path.join(self.tmp, 'state'),
+            METRICS_DIR=os.path.join(self.tmp, 'metrics'),
+            WEBHOOK_ARCHIVE_DIR=os.path.join(self.tmp, 'archive'),
+            AMOCRM_RATE_LIMIT=1000,
+            AMOCRM_RATE_BURST=1000,
+            AMOCRM_MAX_RETRIES=0,
+        )
+        paths.enable()
+        self.addCleanup(paths.disable)
+
+        previous = (metrics.registry, breaker._breaker, ratelimit._limiter, transport._transport, transport._transport_pid)
+        metrics.registry = metrics.Registry()
+        breaker._breaker = ratelimit._limiter = transport._transport = transport._transport_pid = None
+        self.addCleanup(self._restore, previous)
+
+        contact_cache.clear()
+        self.server.state = FakeAmoCRMState()
+        self.server.faults = FaultConfig()
+        self.state = self.server.state
+
+    def _restore(self, previous):
+        metrics.registry, breaker._breaker, ratelimit._limiter, transport._transport, transport._transport_pid = previous
+        contact_cache.clear()
+
+    def post(self, payload, path='/webhook/radario/'):
+        body = payload if isinstance(payload, str) else json.dumps(payload)
+        return self.client.post(path, data=body, content_type='application/json')
+
+
+class ClaimPendingTests(TestCase):
+    def test_claims_oldest_rows_once(self):
+        logs = [make_log(radario_payload(f"A-{index}")) for index in range(3)]
+
+        first = claim_pending('worker-1', 2)
+        second = claim_pending('worker-2', 5)
+
+        self.assertEqual([log.id for log in first], [logs[0].id, logs[1].id])
+        self.assertEqual([log.id for log in second], [logs[2].id])
+        self.assertEqual({log.claimed_by for log in first}, {'worker-1'})
+        self.assertEqual(claim_pending('worker-3', 5), [])
+
+    def test_release_only_own_claims(self):
+        make_log(radario_payload('A-1'))
+        claimed = [log.id for log in claim_pending('worker-1', 5)]
+
+        self.assertEqual(release_claims('worker-2', claimed), 0)
+        self.assertEqual(release_claims('worker-1', claimed), 1)
+
+        log = WebhookLog.objects.get(id=claimed[0])
+        self.assertEqual((log.status, log.claimed_by, log.claimed_at), ('pending', None, None))
+
+
+class IngestViewTests(FakeAmoCRMTestCase):
+    @override_settings(WEBHOOK_ASYNC_INGEST=True)
+    def test_async_ingest_acknowledges_without_amocrm(self):
+        response = self.post(radario_payload('A-1'))
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(WebhookLog.objects.get(id=response.json()['webhook_id']).status, 'pending')
+        self.assertEqual(self.state.requests, 0)
+
+    def test_non_object_payload_is_rejected(self):
+        for body in ('[1, 2]', '"abc"', '{"model": "x"}'):
+            with self.subTest(body=body):
+                response = self.post(body)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()['message'], 'Invalid payload structure')
+
+
+class RateLimiterTests(TestCase):
+    def setUp(self):
+        self.clock = patch_time(self, ratelimit)
+        self.path = os.path.join(temp_dir(self), 'test.ratelimit')
+        self.limiter = RateLimiter(rate=2, burst=2, path=self.path)
+
+    def test_burst_then_waits_spaced_by_rate(self):
+        waits = [self.limiter.reserve() for _ in range(4)]
+        self.assertEqual(waits, [0.0, 0.0, 0.5, 1.0])
+
+    def test_tokens_refill_over_time(self):
+        for _ in range(2):
+            self.limiter.reserve()
+        self.clock.now += 1
+        self.assertEqual(self.limiter.reserve(), 0.0)
+
+    def test_acquire_sleeps_for_reserved_wait(self):
+        for _ in range(2):
+            self.limiter.acquire()
+        started = self.clock.now
+        self.assertEqual(self.limiter.acquire(), 0.5)
+        self.assertEqual(self.clock.now - started, 0.5)
+
+    def test_limit_is_shared_through_state_file(self):
+        other = RateLimiter(rate=2, burst=2, path=self.path)
+        for _ in range(2):
+            self.limiter.reserve()
+        self.assertEqual(other.reserve(), 0.5)
+
+    def test_block_for_pauses_every_caller(self):
+        RateLimiter(rate=2, burst=2, path=self.path).block_for(3)
+        self.assertEqual(self.limiter.reserve(), 3.5)
+
+
+class RetryAfterTests(TestCase):
+    def response(self, value=None):
+        response = requests.Response()
+        response.status_code = 429
+        if value is not None:
+            response.headers['Retry-After'] = value
+        return response
+
+    def test_seconds(self):
+        self.assertEqual(retry_after_seconds(self.response('7')), 7.0)
+        self.assertEqual(retry_after_seconds(self.response('-3')), 0.0)
+
+    def test_http_date(self):
+        delay = retry_after_seconds(self.response(formatdate(time.time() + 30, usegmt=True)))
+        self.assertAlmostEqual(delay, 30, delta=2)
+
+    def test_missing_or_garbage(self):
+        self.assertIsNone(retry_after_seconds(self.response()))
+        self.assertIsNone(retry_after_seconds(self.response('soon')))
+
+
+class ContactCacheTests(TestCase):
+    def setUp(self):
+        self.clock = patch_time(self, contacts)
+        self.cache = ContactCache(maxsize=2, ttl=60)
+
+    def test_entry_expires_after_ttl(self):
+        self.cache.put('a@example.com', 1)
+        self.clock.now += 59
+        self.assertEqual(self.cache.get('a@example.com'), 1)
+        self.clock.now += 2
+        self.assertIsNone(self.cache.get('a@example.com'))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('a@example.com', 1)
+        self.cache.put('b@example.com', 2)
+        self.cache.get('a@example.com')
+        self.cache.put('c@example.com', 3)
+
+        self.assertEqual(self.cache.get('a@example.com'), 1)
+        self.assertIsNone(self.cache.get('b@example.com'))
+        self.assertEqual(self.cache.get('c@example.com'), 3)
+
+
+class ContactIndexTests(FakeAmoCRMTestCase):
+    def test_repeat_buyer_skips_search(self):
+        amocrm = AmoCRMClient()
+        contact = self.state.add_contacts([amocrm.build_contact_data('buyer@example.com', 'Иван Петров')])[0]
+
+        self.assertEqual(amocrm.find_contact_by_email('buyer@example.com')['id'], contact['id'])
+        requests_made = self.state.requests
+        contact_cache.clear()
+
+        self.assertEqual(amocrm.find_contact_by_email(' Buyer@Example.com '), {'id': contact['id']})
+        self.assertEqual(self.state.requests, requests_made)
+
+    def test_forget_contact_drops_cache_and_index(self):
+        remember_contact('Buyer@example.com', 5)
+        self.assertEqual(lookup_contact_id('buyer@example.com'), 5)
+
+        forget_contact('buyer@example.com')
+
+        self.assertIsNone(lookup_contact_id('buyer@example.com'))
+        self.assertFalse(ContactIndex.objects.exists())
+
+
+class OrderKeyTests(TestCase):
+    def test_numeric_id_is_kept(self):
+        self.assertEqual(make_order_key(' 1765169600 '), '1765169600')
+        self.assertEqual(make_order_key(1765169600), '1765169600')
+
+    def test_prefixed_id_keeps_number(self):
+        self.assertEqual(make_order_key('ABC-123'), '123')
+
+    def test_other_ids_use_full_crc32(self):
+        self.assertEqual(make_order_key('заказ 7'), str(zlib.crc32('заказ 7'.encode('utf-8'))))
+
+    def test_lead_matches_by_name_or_key_field(self):
+        by_name = {'name': 'Концерт (#A-1)'}
+        by_key = {'name': 'Сделка', 'custom_fields_values': [{'field_id': 986103, 'values': [{'value': '1765169600'}]}]}
+
+        self.assertTrue(lead_matches_order(by_name, 'A-1'))
+        self.assertFalse(lead_matches_order({'name': 'Концерт (#A-10)'}, 'A-1'))
+        self.assertTrue(lead_matches_order(by_key, 1765169600))
+        self.assertFalse(lead_matches_order(by_key, 1765169601))
+
+
+class LeadIndexTests(FakeAmoCRMTestCase):
+    def test_index_hit_skips_search(self):
+        remember_lead('A-1', 777)
+
+        self.assertEqual(AmoCRMClient().find_lead_by_order_id('A-1'), {'id': 777})
+        self.assertEqual(self.state.requests, 0)
+
+    def test_search_ignores_other_orders(self):
+        # полнотекстовый поиск "A-1" находит и A-10
+        _, lead = self.state.add_leads([{'name': 'Концерт (#A-10)'}, {'name': 'Концерт (#A-1)'}])
+
+        self.assertEqual(AmoCRMClient().find_lead_by_order_id('A-1')['id'], lead['id'])
+        self.assertEqual(LeadIndex.objects.get(order_id='A-1').amocrm_lead_id, lead['id'])
+
+    def test_no_matching_lead(self):
+        self.state.add_leads([{'name': 'Концерт (#A-10)'}])
+
+        self.assertIsNone(AmoCRMClient().find_lead_by_order_id('A-1'))
+        self.assertFalse(LeadIndex.objects.exists())
+
+
+class LeadBatcherTests(FakeAmoCRMTestCase):
+    def add(self, batcher, payload):
+        log = make_log(payload, status='processing')
+        batcher.add(log, None, extract_customer_info(payload))
+        return log
+
+    def test_rejected_lead_does_not_fail_batch(self):
+        batcher = LeadBatcher(AmoCRMClient(), window=0)
+        good = [self.add(batcher, radario_payload(f"A-{index}", email=f"buyer{index}@example.com")) for index in range(2)]
+        bad = self.add(batcher, radario_payload('A-9', email='buyer9@example.com', amount=-100))
+
+        batcher.flush()
+
+        for log in good:
+            log.refresh_from_db()
+            self.assertEqual(log.status, 'success')
+            self.assertIn(log.amocrm_lead_id, self.state.leads)
+        bad.refresh_from_db()
+        self.assertEqual((bad.status, bad.last_error_class), ('error', 'HTTPError'))
+        self.assertEqual(len(self.state.leads), 2)
+
+
+class ComplexLeadTests(FakeAmoCRMTestCase):
+    def test_new_buyer_is_created_with_lead_in_one_call(self):
+        log = make_log(radario_payload('A-1'), status='processing')
+
+        contact_id, lead_id = process_webhook_log(log, AmoCRMClient())
+
+        # поиск контакта, поиск сделки и один leads/complex
+        self.assertEqual(self.state.requests, 3)
+        self.assertEqual(self.state.leads[lead_id]['_embedded']['contacts'], [{'id': contact_id}])
+        self.assertEqual(lookup_contact_id('buyer@example.com'), contact_id)
+
+    def test_one_contact_per_new_buyer_in_batch(self):
+        amocrm = AmoCRMClient()
+        batcher = LeadBatcher(amocrm, window=0)
+        logs = [make_log(radario_payload(f"A-{index}"), status='processing') for index in range(3)]
+
+        for log in logs:
+            process_webhook_log(log, amocrm, batcher)
+        batcher.flush()
+
+        self.assertEqual(len(self.state.contacts), 1)
+        self.assertEqual(len(self.state.leads), 3)
+        contact_ids = {WebhookLog.objects.get(id=log.id).amocrm_contact_id for log in logs}
+        self.assertEqual(contact_ids, set(self.state.contacts))
+
+
+class AsyncClientTests(FakeAmoCRMTestCase):
+    def test_transport_is_closed_with_its_loop(self):
+        async def find_lead():
+            amocrm = AsyncAmoCRMClient()
+            return amocrm.transport, await amocrm.find_lead_by_order_id('A-1', use_index=False)
+
+        transport, lead = asyncio.run(find_lead())
+
+        self.assertIsNone(lead)
+        self.assertEqual(self.state.requests, 1)
+        self.assertTrue(transport.client.is_closed)
+
+    def test_batch_methods_are_sync_only(self):
+        for name in ('create_lead', 'create_leads_batch', 'update_leads_batch'):
+            self.assertFalse(hasattr(AsyncAmoCRMClient, name))
+
+
+class DedupTests(FakeAmoCRMTestCase):
+    def test_duplicate_webhook_is_not_processed_again(self):
+        payload = radario_payload('A-1')
+
+        first = self.post(payload).json()
+        second = self.post(payload).json()
+
+        self.assertEqual(first['status'], 'success')
+        self.assertEqual(second['status'], 'duplicate')
+        self.assertEqual(second['webhook_id'], WebhookLog.objects.get().id)
+        self.assertEqual(second['lead_id'], first['lead_id'])
+        self.assertEqual(len(self.state.leads), 1)
+
+    def test_new_update_date_is_not_duplicate(self):
+        self.post(radario_payload('A-1'))
+        response = self.post(radario_payload('A-1', status='Refunded', update_date='2025-12-09T03:00:00Z')).json()
+
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(self.state.leads[response['lead_id']]['status_id'], STATUS_REFUNDED)
+
+    def test_fingerprint_released_after_permanent_error(self):
+        payload = radario_payload('A-1')
+        fingerprint = webhook_fingerprint(extract_customer_info(payload))
+        log = make_log(payload, status='processing')
+        register_fingerprint(fingerprint, log)
+
+        mark_error(log, ValueError('broken payload'))
+
+        self.assertEqual(log.status, 'error')
+        self.assertIsNone(find_duplicate(fingerprint))
+
+
+class CoalesceTests(TestCase):
+    def test_latest_update_date_wins_over_arrival_order(self):
+        newer = make_log(radario_payload('A-1', status='Refunded', update_date='2025-12-08T05:00:00Z'))
+        older = make_log(radario_payload('A-1', update_date='2025-12-08T03:00:00Z'))
+        other = make_log(radario_payload('B-2'))
+
+        result = coalesce_batch(claim_pending('worker-1', 5))
+
+        self.assertEqual([log.id for log in result], [newer.id, other.id])
+        older.refresh_from_db()
+        self.assertEqual((older.status, older.superseded_by_id), ('coalesced', newer.id))
+
+    def test_pending_rows_outside_batch_are_merged(self):
+        older = make_log(radario_payload('A-1', update_date='2025-12-08T03:00:00Z'))
+        newer = make_log(radario_payload('A-1', status='Refunded', update_date='2025-12-08T05:00:00Z'))
+
+        result = coalesce_batch(claim_pending('worker-1', 1))
+
+        self.assertEqual([log.id for log in result], [newer.id])
+        self.assertEqual(result[0].claimed_by, 'worker-1')
+        older.refresh_from_db()
+        self.assertEqual((older.status, older.superseded_by_id), ('coalesced', newer.id))
+
+
+class OrderSchemaTests(TestCase):
+    def test_camel_case_only(self):
+        order = Order({
+            'id': 5, 'email': 'a@example.com', 'status': 'Paid', 'paymentSystemStatus': 'Paid', 'amount': '12.5',
+            'updateDate': '2025-12-08T03:00:00Z', 'event': {'title': 'Концерт', 'beginDate': '2025-12-20T18:00:00Z'},
+            'user': {'phone': '+79001234567'}, 'tickets': [{'participantName': 'Иван Петров'}],
+        })
+
+        self.assertEqual(
+            (order.order_id, order.email, order.payment_system_status, order.amount, order.event_title, order.phone),
+            (5, 'a@example.com', 'Paid', 12.5, 'Концерт', '+79001234567'),
+        )
+        self.assertEqual((order.name, order.tickets_count), ('Иван Петров', 1))
+
+    def test_mixed_casing_takes_first_non_empty(self):
+        order = Order({'Id': 5, 'Email': '', 'email': 'a@example.com', 'amount': 10, 'Event': {'Title': 'Концерт'}})
+
+        self.assertEqual((order.email, order.amount, order.event_title), ('a@example.com', 10.0, 'Концерт'))
+        self.assertEqual(order['currency'], 'RUB')
+
+    def test_non_dict_nested_objects(self):
+        order = Order({'Id': 5, 'Email': 'ivan@example.com', 'Event': 'Концерт', 'User': ['+7900']})
+
+        self.assertEqual((order.event_title, order.event_date, order.phone), ('', '', ''))
+        self.assertEqual(order.name, 'Ivan')
+
+    def test_unparsable_amount(self):
+        self.assertEqual(Order({'Amount': 'много'}).amount, 0.0)
+
+    def test_derived_fields_are_lazy(self):
+        with mock.patch.object(orders, 'customer_name', wraps=orders.customer_name) as customer_name:
+            order = Order({'Id': 5})
+            customer_name.assert_not_called()
+
+            self.assertEqual(order.name, DEFAULT_CUSTOMER_NAME)
+            self.assertEqual(order.get('name'), DEFAULT_CUSTOMER_NAME)
+            customer_name.assert_called_once()
+
+    def test_refund_date(self):
+        update_date = '2025-12-09T03:00:00Z'
+        refunded = Order({'Status': 'Refunded', 'UpdateDate': update_date})
+        explicit = Order({'PaymentSystemStatus': 'Refund', 'RefundDetails': {'RefundDate': '2025-12-10T00:00:00Z'}})
+
+        self.assertEqual(refunded.refund_date, update_date)
+        self.assertEqual(explicit.refund_date, '2025-12-10T00:00:00Z')
+        self.assertIsNone(Order({'Status': 'Paid', 'UpdateDate': update_date}).refund_date)
+
+    def test_payload_without_model(self):
+        for payload in ([], {'model': 'x'}, {}):
+            with self.subTest(payload=payload):
+                order = Order.from_payload(payload)
+                self.assertEqual((order.order_id, order.email, order.tickets), (None, '', []))
+
+
+@override_settings(WEBHOOK_COMPRESS_BODY=True, WEBHOOK_COMPRESS_MIN_SIZE=1024)
+class RawBodyTests(TestCase):
+    def test_small_body_is_stored_as_is(self):
+        raw_body = json.dumps(radario_payload('A-1')).encode('utf-8')
+        self.assertEqual(WebhookLog.pack_body(raw_body), {'raw_body': raw_body, 'raw_body_compressed': False})
+
+    def test_large_body_is_compressed_and_round_trips(self):
+        payload = radario_payload('A-1')
+        payload['model']['Tickets'] = [{'OwnerName': 'Иван Петров', 'Barcode': str(index)} for index in range(50)]
+        raw_body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+        log = make_log(payload)
+        log = WebhookLog.objects.get(id=log.id)
+
+        self.assertTrue(log.raw_body_compressed)
+        self.assertLess(len(log.raw_body), len(raw_body))
+        self.assertEqual(log.get_raw_body(), raw_body)
+        self.assertEqual(log.get_payload(), payload)
+
+    @override_settings(WEBHOOK_COMPRESS_BODY=False)
+    def test_compression_can_be_disabled(self):
+        self.assertFalse(WebhookLog.pack_body(b'x' * 4096)['raw_body_compressed'])
+
+    def test_payload_is_parsed_once_and_not_saved(self):
+        log = WebhookLog.objects.get(id=make_log(radario_payload('A-1')).id)
+
+        with mock.patch.object(models, 'loads', wraps=models.loads) as loads:
+            self.assertEqual(log.get_payload(), radario_payload('A-1'))
+            log.get_payload()
+        loads.assert_called_once()
+
+        log.status = 'success'
+        log.save()
+        self.assertIsNone(WebhookLog.objects.get(id=log.id).payload)
+
+    def test_legacy_payload_column_wins(self):
+        log = WebhookLog.objects.create(payload={'model': {'Id': 'A-1'}}, status='success')
+        self.assertEqual(log.get_payload(), {'model': {'Id': 'A-1'}})
+
+
+class ReplayCommandTests(TestCase):
+    @override_settings(AMOCRM_BASE_URL=None)
+    def test_refuses_live_amocrm_without_flag(self):
+        make_log(radario_payload('A-1'), status='success')
+
+        with self.assertRaisesMessage(CommandError, 'AMOCRM_BASE_URL'):
+            call_command('replay_webhooks', '--from-db')
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.archive_dir = temp_dir(self)
+        self.cutoff = timezone.now() + timedelta(minutes=1)
+
+    def archive(self, **kwargs):
+        return archive_webhooks(cutoff=self.cutoff, archive_dir=self.archive_dir, **kwargs)
+
+    def test_archives_final_rows_and_deletes_them(self):
+        done = [make_log(radario_payload(f"A-{index}"), status=status) for index, status in enumerate(('success', 'error', 'coalesced'))]
+        pending = make_log(radario_payload('B-1'))
+
+        segments = self.archive()
+
+        self.assertEqual(len(segments), 1)
+        records = list(read_segment(self.archive_dir, segments[0]))
+        self.assertEqual([record['id'] for record in records], [log.id for log in done])
+        self.assertEqual(list(WebhookLog.objects.values_list('id', flat=True)), [pending.id])
+        self.assertEqual([record['id'] for record in find_archived('A-1', archive_dir=self.archive_dir)], [done[1].id])
+        self.assertTrue(read_index(self.archive_dir)[0]['deleted'])
+
+    def test_rows_newer_than_cutoff_stay(self):
+        make_log(radario_payload('A-1'), status='success')
+
+        self.assertEqual(archive_webhooks(cutoff=timezone.now() - timedelta(days=1), archive_dir=self.archive_dir), [])
+        self.assertEqual(WebhookLog.objects.count(), 1)
+
+    def test_resume_after_crash_before_delete(self):
+        logs = [make_log(radario_payload(f"A-{index}"), status='success') for index in range(3)]
+
+        with mock.patch.object(archive, 'delete_archived', side_effect=RuntimeError('killed')):
+            with self.assertRaises(RuntimeError):
+                self.archive()
+        self.assertEqual(WebhookLog.objects.count(), 3)
+        self.assertFalse(read_index(self.archive_dir)[0]['deleted'])
+
+        self.assertEqual(self.archive(), [])
+
+        segments = read_index(self.archive_dir)
+        self.assertEqual(len(segments), 1)
+        self.assertTrue(segments[0]['deleted'])
+        self.assertEqual([record['id'] for record in read_segment(self.archive_dir, segments[0]['file'])], [log.id for log in logs])
+        self.assertFalse(WebhookLog.objects.exists())
+
+    def test_resume_after_crash_before_rename(self):
+        make_log(radario_payload('A-1'), status='success')
+
+        with mock.patch.object(SegmentWriter, 'commit', side_effect=RuntimeError('killed')):
+            with self.assertRaises(RuntimeError):
+                self.archive()
+        name = read_index(self.archive_dir)[0]['file']
+        self.assertTrue(os.path.exists(os.path.join(self.archive_dir, name + '.tmp')))
+
+        self.assertEqual(self.archive(), [])
+
+        self.assertTrue(os.path.exists(os.path.join(self.archive_dir, name)))
+        self.assertFalse(os.path.exists(os.path.join(self.archive_dir, name + '.tmp')))
+        self.assertEqual(len(read_index(self.archive_dir)), 1)
+        self.assertFalse(WebhookLog.objects.exists())
+
+    def test_segment_missing_from_index_is_adopted(self):
+        log = make_log(radario_payload('A-1'), status='success')
+        name = 'webhooks-20250101-000000-1.jsonl.gz'
+        with gzip.open(os.path.join(self.archive_dir, name), 'wt', encoding='utf-8') as f:
+            f.write(json.dumps(archive_record(log)) + '\n')
+
+        self.assertEqual(self.archive(), [])
+
+        self.assertEqual([segment['file'] for segment in read_index(self.archive_dir)], [name])
+        self.assertEqual([record['id'] for record in find_archived('A-1', archive_dir=self.archive_dir)], [log.id])
+        self.assertFalse(WebhookLog.objects.exists())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.metrics_dir = temp_dir(self)
+        paths = override_settings(METRICS_DIR=self.metrics_dir)
+        paths.enable()
+        self.addCleanup(paths.disable)
+
+        previous = metrics.registry
+        metrics.registry = metrics.Registry()
+        self.addCleanup(setattr, metrics, 'registry', previous)
+
+    def write(self, pid, counters=(), histograms=()):
+        path = os.path.join(self.metrics_dir, f"metrics-{pid}-1.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'counters': list(counters), 'histograms': list(histograms)}, f)
+        return path
+
+    def test_collect_compacts_files_of_dead_processes(self):
+        buckets = [0] * (len(metrics.LATENCY_BUCKETS) + 1) + [0.0]
+        live = self.write(100, [['webhook_results_total', 'result=created', 2]])
+        dead = self.write(200, [['webhook_results_total', 'result=created', 3]],
+                          [['webhook_request_duration_seconds', 'view=sync', [1] + buckets[1:-1] + [0.004]]])
+
+        with mock.patch.object(metrics, '_pid_alive', lambda pid: pid == 100):
+            first = metrics.collect()
+            second = metrics.collect()
+
+        self.assertEqual(first, second)
+        self.assertEqual(first['counters'][('webhook_results_total', 'result=created')], 5)
+        self.assertEqual(first['histograms'][('webhook_request_duration_seconds', 'view=sync')][0], 1)
+        self.assertTrue(os.path.exists(live))
+        self.assertFalse(os.path.exists(dead))
+        self.assertTrue(os.path.exists(os.path.join(self.metrics_dir, metrics.DEAD_FILE)))
+
+    def test_collect_includes_own_process(self):
+        metrics.inc('webhook_results_total', result='duplicate')
+        self.assertEqual(metrics.collect()['counters'][('webhook_results_total', 'result=duplicate')], 1)
+
+    def test_render_prometheus_text(self):
+        registry = metrics.Registry()
+        registry.inc('amocrm_responses_total', 2, endpoint='leads', status='200')
+        registry.observe('amocrm_request_duration_seconds', 0.02, endpoint='leads')
+        registry.observe('amocrm_request_duration_seconds', 100, endpoint='leads')
+        total = {'counters': {}, 'histograms': {}}
+        metrics._merge(total, registry.snapshot())
+
+        text = metrics.render(total, [('webhook_backlog', 'Очередь', [({'status': 'pending'}, 3)])])
+
+        self.assertIn('# TYPE amocrm_responses_total counter', text)
+        self.assertIn('amocrm_responses_total{endpoint="leads",status="200"} 2', text)
+        self.assertIn('amocrm_request_duration_seconds_bucket{endpoint="leads",le="0.01"} 0', text)
+        self.assertIn('amocrm_request_duration_seconds_bucket{endpoint="leads",le="0.025"} 1', text)
+        self.assertIn('amocrm_request_duration_seconds_bucket{endpoint="leads",le="+Inf"} 2', text)
+        self.assertIn('amocrm_request_duration_seconds_sum{endpoint="leads"} 100.02', text)
+        self.assertIn('amocrm_request_duration_seconds_count{endpoint="leads"} 2', text)
+        self.assertIn('# TYPE webhook_backlog gauge', text)
+        self.assertIn('webhook_backlog{status="pending"} 3', text)
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.clock = patch_time(self, breaker)
+        path = os.path.join(temp_dir(self), 'test.breaker')
+        self.breaker = CircuitBreaker(path, failures=2, slow_call=5, reset_timeout=30, probes=2)
+
+    def trip(self):
+        self.breaker.record(0.1, failed=True)
+        self.breaker.record(0.1, failed=True)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record(0.1, failed=True)
+        self.breaker.record(0.1, failed=False)
+        self.breaker.record(0.1, failed=True)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+        # медленный ответ - тоже сбой
+        self.breaker.record(6, failed=False)
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_request()
+
+    def test_half_open_lets_one_probe_through(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+        self.breaker.before_request()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_request()
+
+    def test_successful_probes_close(self):
+        self.trip()
+        self.clock.now += 30
+
+        for _ in range(2):
+            self.breaker.before_request()
+            self.breaker.record(0.1, failed=False)
+
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.before_request()
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.clock.now += 30
+
+        self.breaker.before_request()
+        self.breaker.record(0.1, failed=True)
+
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.snapshot()['trips'], 2)
+
+
+class SpoolTests(FakeAmoCRMTestCase):
+    def trip(self):
+        for _ in range(settings.AMOCRM_BREAKER_FAILURES):
+            get_breaker().record(0.1, failed=True)
+
+    def test_open_breaker_spools_webhook(self):
+        self.trip()
+
+        response = self.post(radario_payload('A-1'))
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(WebhookLog.objects.get().status, 'pending')
+        self.assertEqual(self.state.requests, 0)
+        health = self.client.get('/health/').json()
+        self.assertEqual((health['status'], health['queued'], health['workers']), ('degraded', 1, 0))
+
+    def test_half_open_probe_is_sent_from_request(self):
+        self.trip()
+        clock = patch_time(self, breaker)
+        clock.now = time.time() + settings.AMOCRM_BREAKER_RESET_TIMEOUT
+
+        response = self.post(radario_payload('A-1'))
+
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(len(self.state.leads), 1)
+
+    def test_webhook_waits_behind_unfinished_rows_of_its_order(self):
+        for order_id, status in (('A-1', 'processing'), ('B-2', 'retry')):
+            with self.subTest(status=status):
+                make_log(radario_payload(order_id, update_date='2025-12-08T03:00:00Z'), status=status)
+
+                response = self.post(radario_payload(
+                    order_id, status='Refunded', payment_status='Refund', update_date='2025-12-08T05:00:00Z'))
+
+                self.assertEqual(response.status_code, 202)
+                self.assertEqual(WebhookLog.objects.get(id=response.json()['webhook_id']).status, 'pending')
+                self.assertEqual(self.state.requests, 0)
+
+
+@override_settings(WEBHOOK_RETRY_MAX_ATTEMPTS=3)
+class ApplyFailureTests(TestCase):
+    def assertStatus(self, error, expected, attempts=0):
+        log = WebhookLog(attempts=attempts)
+        self.assertEqual(apply_failure(log, error), expected)
+        return log
+
+    def test_transient_errors_are_retried(self):
+        for error in (
+            requests.ConnectionError('reset'),
+            requests.Timeout('timeout'),
+            httpx.ConnectError('refused'),
+            CircuitOpenError('open'),
+            http_error(429),
+            http_error(503),
+            http_error(502, httpx.HTTPStatusError),
+        ):
+            with self.subTest(error=error):
+                log = self.assertStatus(error, 'retry')
+                self.assertEqual(log.attempts, 1)
+                self.assertGreater(log.next_attempt_at, timezone.now())
+
+    def test_permanent_errors_are_not_retried(self):
+        for error in (http_error(400), http_error(404), ValueError('No email provided')):
+            with self.subTest(error=error):
+                log = self.assertStatus(error, 'error')
+                self.assertIsNone(log.next_attempt_at)
+
+    def test_exhausted_retries_are_dead(self):
+        log = self.assertStatus(http_error(503), 'dead', attempts=2)
+        self.assertEqual((log.attempts, log.last_error_class), (3, 'HTTPError'))
+        self.assertIsNone(log.next_attempt_at)
+
+
+class RetryTests(FakeAmoCRMTestCase):
+    def test_fingerprint_kept_while_retry_is_scheduled(self):
+        payload = radario_payload('A-1')
+        fingerprint = webhook_fingerprint(extract_customer_info(payload))
+        log = make_log(payload, status='processing')
+        register_fingerprint(fingerprint, log)
+
+        mark_error(log, requests.ConnectionError('connection reset'))
+
+        self.assertEqual(log.status, 'retry')
+        self.assertEqual(find_duplicate(fingerprint).webhook_log_id, log.id)
+
+    def test_failed_lookup_schedules_retry_without_creating_lead(self):
+        self.server.faults = FaultConfig(error_5xx=1.0)
+
+        response = self.post(radario_payload('A-1'))
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(WebhookLog.objects.get().status, 'retry')
+        self.assertEqual((len(self.state.leads), len(self.state.contacts)), (0, 0))
+
+    def test_due_retry_does_not_overwrite_newer_state(self):
+        process_webhook_log(make_log(radario_payload(
+            'A-1', status='Pending', payment_status='Pending', update_date='2025-12-08T01:00:00Z')))
+        self.server.faults = FaultConfig(error_5xx=1.0)
+        paid = make_log(radario_payload('A-1', update_date='2025-12-08T03:00:00Z'))
+        with self.assertRaises(requests.HTTPError):
+            process_webhook_log(paid)
+        paid.refresh_from_db()
+        self.assertEqual(paid.status, 'retry')
+
+        self.server.faults = FaultConfig()
+        refunded = make_log(radario_payload(
+            'A-1', status='Refunded', payment_status='Refund', update_date='2025-12-08T05:00:00Z'))
+        process_webhook_log(refunded)
+        [lead] = self.state.leads.values()
+        self.assertEqual(lead['status_id'], STATUS_REFUNDED)
+
+        WebhookLog.objects.filter(id=paid.id).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        call_command('process_webhooks', '--once')
+
+        self.assertEqual(lead['status_id'], STATUS_REFUNDED)
+        paid.refresh_from_db()
+        self.assertEqual((paid.status, paid.superseded_by_id), ('coalesced', refunded.id))
+
+    def test_dead_rows_use_own_archive_retention(self):
+        archive_dir = temp_dir(self)
+        cutoff = timezone.now() + timedelta(minutes=1)
+        dead = make_log(radario_payload('A-1'), status='dead')
+
+        self.assertEqual(archive_webhooks(cutoff=cutoff, archive_dir=archive_dir), [])
+        self.assertTrue(WebhookLog.objects.filter(id=dead.id).exists())
+
+        self.assertEqual(len(archive_webhooks(cutoff=cutoff, dead_cutoff=cutoff, archive_dir=archive_dir)), 1)
+        self.assertFalse(WebhookLog.objects.exists())
+
+
+class PageStreamTests(FakeAmoCRMTestCase):
+    def setUp(self):
+        super().setUp()
+        leads = self.state.add_leads([{'name': f"Сделка {index}"} for index in range(7)])
+        self.ids = [lead['id'] for lead in leads]
+
+    def test_iterates_all_pages(self):
+        for prefetch in (0, 2):
+            with self.subTest(prefetch=prefetch):
+                stream = AmoCRMClient().iter_leads(limit=3, prefetch=prefetch)
+                self.assertEqual([lead['id'] for lead in stream], self.ids)
+                self.assertEqual(stream.pages, 3)
+
+    def test_resume_from_cursor(self):
+        stream = AmoCRMClient().iter_leads(limit=3)
+        first = [lead['id'] for lead in islice(iter(stream), 4)]
+        self.assertEqual(stream.cursor, {'page': 2, 'last_id': self.ids[3]})
+
+        # удаление до курсора сдвигает записи к началу выдачи
+        del self.state.leads[self.ids[0]]
+        resumed = AmoCRMClient().iter_leads(limit=3, prefetch=0, cursor=stream.cursor)
+
+        self.assertEqual(first + [lead['id'] for lead in resumed], self.ids)
+
+
+class ReconcilerTests(FakeAmoCRMTestCase):
+    def lead(self, order_id, status_id=STATUS_PAID, price=500):
+        return self.state.add_leads([{
+            'name': f"Концерт (#{order_id})", 'price': price, 'status_id': status_id, 'pipeline_id': PIPELINE_ID,
+        }])[0]
+
+    def test_classifies_and_fixes(self):
+        make_log(radario_payload('OK-1'), status='success')
+        self.lead('OK-1')
+        make_log(radario_payload('MISS-1'), status='success')
+        make_log(radario_payload('DEAD-1'), status='dead')
+        failed = make_log(radario_payload('FAIL-1'), status='error')
+        make_log(radario_payload('FLY-1'), status='retry')
+        make_log(radario_payload('DUP-1'), status='success')
+        duplicates = [self.lead('DUP-1'), self.lead('DUP-1')]
+        make_log(radario_payload('STALE-1', amount=700), status='success')
+        stale = self.lead('STALE-1')
+
+        reconciler = Reconciler(AmoCRMClient())
+        report = reconciler.run()
+
+        self.assertEqual(report['counts'], {
+            'orders': 7, 'ok': 1, 'missing': 2, 'failed': 1, 'in_flight': 1, 'duplicate': 1, 'stale': 1, 'leads': 4,
+        })
+        self.assertEqual(report['duplicate'][0]['lead_ids'], [lead['id'] for lead in duplicates])
+        self.assertEqual(report['failed'][0]['webhook_id'], failed.id)
+
+        fixed = reconciler.fix()
+
+        self.assertEqual((fixed['patched'], fixed['requeued']), (1, 2))
+        self.assertEqual(self.state.leads[stale['id']]['price'], 700)
+        self.assertEqual(
+            set(WebhookLog.objects.filter(status='pending').values_list('order_id', flat=True)), {'MISS-1', 'DEAD-1'}
+        )
+        failed.refresh_from_db()
+        self.assertEqual(failed.status, 'error')
+
+    def test_latest_webhook_is_chosen_by_update_date(self):
+        make_log(radario_payload('A-1', status='Refunded', update_date='2025-12-08T05:00:00Z'), status='success')
+        make_log(radario_payload('A-1', update_date='2025-12-08T03:00:00Z'), status='success')
+        self.lead('A-1', status_id=STATUS_REFUNDED)
+
+        report = Reconciler(AmoCRMClient()).run()
+
+        self.assertEqual((report['counts']['ok'], report['counts']['stale']), (1, 0))
@@ -0,0 +1,145 @@
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from . import metrics
+from .breaker import get_breaker
+from .ratelimit import get_rate_limiter, retry_after_seconds, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+_ID_RE = re.compile(r'/\d+(?=/|$)')
+
+
+def endpoint_name(endpoint):
+    path = endpoint.split('?', 1)[0]
+    return _ID_RE.sub('/{id}', '/' + path)[1:]
+
+
+RETRY_STATUSES = (429, 503)
+
+
+class BaseTransport:
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None, limiter=None, max_retries=None, breaker=None):
+        self.limiter = limiter or get_rate_limiter()
+        self.breaker = breaker or get_breaker()
+        self.max_retries = settings.AMOCRM_MAX_RETRIES if max_retries is None else max_retries
+        self.pool_size = pool_size or settings.AMOCRM_POOL_SIZE
+        self.connect_timeout = connect_timeout or settings.AMOCRM_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or settings.AMOCRM_READ_TIMEOUT
+
+        self._lock = threading.Lock()
+        self.timings = {}
+
+    def _retry_delay(self, key, response, attempt):
+        if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+            return None
+
+        delay = retry_after_seconds(response)
+        if delay is None:
+            delay = backoff_delay(attempt)
+
+        # пауза общая: остальные процессы тоже притормозят через лимитер
+        self.limiter.block_for(delay)
+        logger.warning("amoCRM %s: %s, повтор %s через %.1f с", key, response.status_code, attempt + 1, delay)
+        return delay
+
+    def _record(self, key, waited, elapsed, status):
+        # 429 - это лимит, а не отказ amoCRM: его разруливает лимитер
+        self.breaker.record(elapsed, failed=status == 'error' or status >= 500)
+
+        with self._lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = {'count': 0, 'total': 0.0, 'max': 0.0, 'wait': 0.0}
+            timing['count'] += 1
+            timing['total'] += elapsed
+            timing['wait'] += waited
+            if elapsed > timing['max']:
+                timing['max'] = elapsed
+
+        method, endpoint = key.split(' ', 1)
+        metrics.observe('amocrm_request_duration_seconds', elapsed, method=method, endpoint=endpoint)
+        metrics.inc('amocrm_responses_total', method=method, endpoint=endpoint, code=status)
+        if waited:
+            metrics.inc('amocrm_rate_limit_wait_seconds_total', waited, method=method, endpoint=endpoint)
+
+        logger.debug("amoCRM %s: %.0f мс, ожидание лимита %.0f мс", key, elapsed * 1000, waited * 1000)
+
+    def timings_snapshot(self):
+        with self._lock:
+            return {key: dict(value) for key, value in self.timings.items()}
+
+
+class AmoCRMTransport(BaseTransport):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Connection'] = 'keep-alive'
+
+    def request(self, method, url, endpoint, headers=None, body=None):
+        key = f"{method} {endpoint_name(endpoint)}"
+
+        for attempt in range(self.max_retries + 1):
+            self.breaker.before_request()
+            waited = self.limiter.acquire()
+
+            started = time.monotonic()
+            status = 'error'
+            try:
+                response = self.session.request(method, url, headers=headers, data=body, timeout=self.timeout)
+                status = response.status_code
+            finally:
+                self._record(key, waited, time.monotonic() - started, status)
+
+            if self._retry_delay(key, response, attempt) is None:
+                return response
+
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+_transport = None
+_transport_pid = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    global _transport, _transport_pid
+
+    # после fork (gunicorn --preload) пул сокетов родителя использовать нельзя
+    pid = os.getpid()
+    if _transport is None or _transport_pid != pid:
+        with _transport_lock:
+            if _transport is None or _transport_pid != pid:
+                _transport = AmoCRMTransport()
+                _transport_pid = pid
+    return _transport
+
+
+@contextmanager
+def override_transport(transport):
+    # Подменяет транспорт процесса (бенчмарки, прогоны без сети): клиенты,
+    # созданные внутри блока через AmoCRMClient(), ходят через transport
+    global _transport, _transport_pid
+
+    with _transport_lock:
+        previous = _transport, _transport_pid
+        _transport, _transport_pid = transport, os.getpid()
+    try:
+        yield transport
+    finally:
+        with _transport_lock:
+            _transport, _transport_pid = previous
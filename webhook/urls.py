@@ -3,5 +3,7 @@ from . import views
 
 urlpatterns = [
     path('webhook/radario/', views.radario_webhook, name='radario_webhook'),
+    path('webhook/radario/async/', views.radario_webhook_async, name='radario_webhook_async'),
     path('health/', views.health_check, name='health_check'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -1,120 +1,252 @@
-import json
 import logging
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Min
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils import timezone
+from . import metrics
+from .breaker import OPEN, CircuitOpenError, get_breaker
 from .models import WebhookLog
-from .amocrm_client import AmoCRMClient
-from .utils import verify_radario_webhook, extract_customer_info, create_lead_name, should_process_order
+from .fastjson import loads
+from .dedup import webhook_fingerprint, find_duplicate, afind_duplicate, register_fingerprint, purge_expired
+from .ingest import enqueue, has_pending, live_workers
+from .processing import process_webhook_log, aprocess_webhook_log
+from .utils import verify_radario_webhook, extract_customer_info
 
 logger = logging.getLogger(__name__)
 
 
+def parse_webhook(request):
+    # Возвращает (payload, customer_info, ошибка) и не трогает БД, чтобы
+    # одинаково работать в sync- и async-view.
+    # В БД потом ложатся эти же байты, а не повторно сериализованный payload
+    # сырое тело - только в DEBUG: на INFO его не декодируем вовсе
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received Radario webhook: %s...", request.body[:500].decode('utf-8', 'replace'))
+
+    try:
+        payload = loads(request.body)
+    except ValueError as e:
+        logger.error("Invalid JSON: %s", e)
+        return None, None, 'Invalid JSON'
+
+    # [1,2], "abc", {"model": "x"} - валидный JSON, но не вебхук Radario
+    if not isinstance(payload, dict) or ('model' in payload and not isinstance(payload['model'], dict)):
+        logger.error("Payload is not a Radario webhook object: %s", type(payload).__name__)
+        return payload, None, 'Invalid payload structure'
+
+    if not verify_radario_webhook(payload):
+        return payload, None, 'Missing required fields'
+
+    customer_info = extract_customer_info(payload)
+    if not customer_info['email']:
+        return payload, None, 'No email provided'
+
+    return payload, customer_info, None
+
+
+def error_response(message, status=400):
+    if status == 400:
+        # ошибки обработки (500) уже посчитаны в mark_error
+        metrics.inc('webhook_results_total', result='rejected')
+    return JsonResponse({'status': 'error', 'message': message}, status=status)
+
+
+def error_log_fields(raw_body, payload, error):
+    return {
+        **WebhookLog.pack_body(raw_body),
+        **WebhookLog.lookup_fields(extract_customer_info(payload)),
+        'status': 'error',
+        'error_message': error,
+    }
+
+
+def should_queue(customer_info):
+    # Вебхук ложится в очередь и уйдёт в amoCRM через process_webhooks:
+    # - при WEBHOOK_ASYNC_INGEST;
+    # - пока breaker открыт - amoCRM не дёргаем;
+    # - если у заказа уже есть необработанные вебхуки (в очереди, у воркера
+    #   или на повторе): иначе новое состояние обогнало бы отложенное.
+    # В half-open вебхук обрабатывается в запросе: один из них становится
+    # пробным запросом (before_request), остальные получают CircuitOpenError
+    # и откладываются с ответом 202. Так breaker закрывается и без воркера.
+    if settings.WEBHOOK_ASYNC_INGEST:
+        return True
+    if get_breaker().state == OPEN:
+        logger.warning("amoCRM недоступен, вебхук отложен в очередь")
+        return True
+    if has_pending(customer_info['order_id']):
+        logger.info("У заказа %s есть необработанные вебхуки, этот тоже отложен", customer_info['order_id'])
+        return True
+    return False
+
+
+def store_webhook(raw_body, payload, customer_info, fingerprint, queued):
+    # None - такой же вебхук параллельно записал другой воркер
+    try:
+        with transaction.atomic():
+            if queued:
+                webhook_log = enqueue(raw_body, customer_info)
+            else:
+                webhook_log = WebhookLog.objects.create(
+                    **WebhookLog.pack_body(raw_body), **WebhookLog.lookup_fields(customer_info),
+                    status='processing', claimed_at=timezone.now()
+                )
+            register_fingerprint(fingerprint, webhook_log)
+    except IntegrityError:
+        return None
+
+    # тело уже разобрано, process_webhook_log не будет разбирать его снова
+    webhook_log._parsed_payload = payload
+    purge_expired()
+    return webhook_log
+
+
+def accepted_response(webhook_log):
+    metrics.inc('webhook_results_total', result='accepted')
+    return JsonResponse({'status': 'accepted', 'webhook_id': webhook_log.id}, status=202)
+
+
+def success_response(contact_id, lead_id):
+    return JsonResponse({
+        'status': 'success',
+        'contact_id': contact_id,
+        'lead_id': lead_id
+    })
+
+
+def duplicate_response(duplicate):
+    webhook_log = duplicate.webhook_log if duplicate else None
+    metrics.inc('webhook_results_total', result='duplicate')
+    logger.info("Duplicate Radario webhook, original: %s", webhook_log.id if webhook_log else None)
+
+    return JsonResponse({
+        'status': 'duplicate',
+        'webhook_id': webhook_log.id if webhook_log else None,
+        'contact_id': webhook_log.amocrm_contact_id if webhook_log else None,
+        'lead_id': webhook_log.amocrm_lead_id if webhook_log else None,
+    })
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@metrics.track_webhook('sync')
 def radario_webhook(request):
+    payload, customer_info, error = parse_webhook(request)
+    if error is not None:
+        if payload is not None:
+            WebhookLog.objects.create(**error_log_fields(request.body, payload, error))
+        return error_response(error)
 
-    raw_body = request.body.decode('utf-8')
-    logger.info(f"Received Radario webhook: {raw_body[:500]}...")
+    fingerprint = webhook_fingerprint(customer_info)
+    duplicate = find_duplicate(fingerprint)
+    if duplicate is not None:
+        return duplicate_response(duplicate)
 
-    try:
-        payload = json.loads(raw_body)
-    except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON: {e}")
-        return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+    queued = should_queue(customer_info)
+    webhook_log = store_webhook(request.body, payload, customer_info, fingerprint, queued)
+    if webhook_log is None:
+        return duplicate_response(find_duplicate(fingerprint))
 
-    webhook_log = WebhookLog.objects.create(payload=payload)
+    if queued:
+        return accepted_response(webhook_log)
 
     try:
-        if not verify_radario_webhook(payload):
-            webhook_log.status = 'error'
-            webhook_log.error_message = 'Missing required fields'
-            webhook_log.save()
-            return JsonResponse({'status': 'error', 'message': 'Missing required fields'}, status=400)
-
-        customer_info = extract_customer_info(payload)
-        if not customer_info['email']:
-            webhook_log.status = 'error'
-            webhook_log.error_message = 'No email provided'
-            webhook_log.save()
-            return JsonResponse({'status': 'error', 'message': 'No email provided'}, status=400)
-
-        amocrm = AmoCRMClient()
-
-        contact = amocrm.find_contact_by_email(customer_info['email'])
-
-        if contact:
-            contact_id = contact['id']
-            logger.info(f"Found existing contact: {contact_id}")
-        else:
-            contact = amocrm.create_contact(
-                email=customer_info['email'],
-                name=customer_info['name'],
-                phone=customer_info['phone']
-            )
-            contact_id = contact['id']
-            logger.info(f"Created new contact: {contact_id}")
-
-        model = payload.get('model', {})
-        event_data = model.get('Event', {}) or model.get('event', {})
-
-        status = customer_info.get('status')
-        payment_status = customer_info.get('payment_system_status')
-
-        existing_lead = amocrm.find_lead_by_order_id(customer_info['order_id'])
-
-        if existing_lead:
-            lead_id = existing_lead['id']
-
-            if status == 'Refunded' or payment_status == 'Refund':
-                logger.info(f"Processing refund for existing lead: {lead_id}")
-                amocrm.update_lead_for_refund(lead_id, customer_info)
-            else:
-                logger.info(f"Updating existing lead: {lead_id}")
-
-                if status == 'Paid' and payment_status == 'Paid':
-                    amocrm.update_lead(lead_id, customer_info, status_id=77419554)
-                else:
-                    amocrm.update_lead(lead_id, customer_info)
-        else:
-            lead_name = create_lead_name(event_data, customer_info['order_id'])
-
-            if status == 'Refunded' or payment_status == 'Refund':
-                logger.info(f"Creating new lead for refund: {customer_info['order_id']}")
-                lead = amocrm.create_lead_with_custom_fields(
-                    contact_id=contact_id,
-                    customer_info=customer_info
-                )
-            else:
-                logger.info(f"Creating new lead: {customer_info['order_id']}")
-                lead = amocrm.create_lead_with_custom_fields(
-                    contact_id=contact_id,
-                    customer_info=customer_info
-                )
+        contact_id, lead_id = process_webhook_log(webhook_log)
+    except CircuitOpenError:
+        return accepted_response(webhook_log)
+    except Exception as e:
+        if webhook_log.status == 'retry':
+            return accepted_response(webhook_log)
+        return error_response(str(e), status=500)
 
-            lead_id = lead['id']
+    return success_response(contact_id, lead_id)
 
-        webhook_log.status = 'success'
-        webhook_log.amocrm_contact_id = contact_id
-        webhook_log.amocrm_lead_id = lead_id
-        webhook_log.processed_at = timezone.now()
-        webhook_log.save()
 
-        return JsonResponse({
-            'status': 'success',
-            'contact_id': contact_id,
-            'lead_id': lead_id
-        })
+@csrf_exempt
+@require_http_methods(["POST"])
+@metrics.track_webhook('async')
+async def radario_webhook_async(request):
+    # Пока ждём amoCRM, поток не занят: один процесс под ASGI держит сотни
+    # вебхуков одновременно.
+    payload, customer_info, error = parse_webhook(request)
+    if error is not None:
+        if payload is not None:
+            await WebhookLog.objects.acreate(**error_log_fields(request.body, payload, error))
+        return error_response(error)
+
+    fingerprint = webhook_fingerprint(customer_info)
+    duplicate = await afind_duplicate(fingerprint)
+    if duplicate is not None:
+        return duplicate_response(duplicate)
+
+    queued = await sync_to_async(should_queue)(customer_info)
+    webhook_log = await sync_to_async(store_webhook)(request.body, payload, customer_info, fingerprint, queued)
+    if webhook_log is None:
+        return duplicate_response(await afind_duplicate(fingerprint))
+
+    if queued:
+        return accepted_response(webhook_log)
 
+    try:
+        contact_id, lead_id = await aprocess_webhook_log(webhook_log)
+    except CircuitOpenError:
+        return accepted_response(webhook_log)
     except Exception as e:
-        logger.error(f"Webhook processing error: {e}", exc_info=True)
-        webhook_log.status = 'error'
-        webhook_log.error_message = str(e)
-        webhook_log.save()
-        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+        if webhook_log.status == 'retry':
+            return accepted_response(webhook_log)
+        return error_response(str(e), status=500)
+
+    return success_response(contact_id, lead_id)
 
 
 @require_http_methods(["GET"])
 def health_check(request):
-    return JsonResponse({'status': 'ok', 'service': 'oktavachecks'})
\ No newline at end of file
+    # открытый breaker - не повод снимать сервис с балансировщика: вебхуки
+    # принимаются и копятся в очереди, поэтому ответ всё равно 200.
+    # degraded - и когда очередь есть, а разбирать её некому.
+    breaker = get_breaker().snapshot()
+    queued = WebhookLog.objects.filter(status='pending').count()
+    workers = len(live_workers())
+    healthy = breaker['state'] == 'closed' and (not queued or workers)
+    return JsonResponse({
+        'status': 'ok' if healthy else 'degraded',
+        'service': 'oktavachecks',
+        'amocrm': breaker,
+        'queued': queued,
+        'workers': workers,
+    })
+
+
+def state_gauges():
+    # очередь и breaker читаются в момент запроса: они общие для всех процессов
+    rows = (
+        WebhookLog.objects.filter(status__in=['pending', 'processing'])
+        .values('status')
+        .annotate(count=Count('id'), oldest=Min('created_at'))
+    )
+    counts = {'pending': 0, 'processing': 0}
+    oldest = None
+    for row in rows:
+        counts[row['status']] = row['count']
+        if row['status'] == 'pending':
+            oldest = row['oldest']
+
+    age = (timezone.now() - oldest).total_seconds() if oldest else 0
+    breaker_state = get_breaker().state
+    return [
+        ('amocrm_breaker_state', 'Состояние breaker amoCRM', [({'state': state}, int(state == breaker_state)) for state in ('closed', 'open', 'half_open')]),
+        ('webhook_backlog', 'Вебхуки в очереди по статусу', [({'status': status}, count) for status, count in counts.items()]),
+        ('webhook_backlog_oldest_age_seconds', 'Возраст самого старого вебхука в очереди', [({}, round(age, 3))]),
+    ]
+
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    return HttpResponse(
+        metrics.render(metrics.collect(), state_gauges()),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )